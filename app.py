@@ -1,90 +1,188 @@
-from flask import Flask, render_template, redirect, url_for, session
-from cli_funcs import get_latest_version_cli, get_versions_cli, get_module_names_cli
-from serve_files_cli import serve_latest_version, serve_specified_version
-from database import db
-from models import User, Module
-from webui_funcs import login_webui, signup_user_webui, change_password_webui, main_page_webui, upload_modules_webui, delete_module_webui, update_module_webui, get_module_info_webui, get_profile_webui
-
-# initializing and configuring the flask app
-app = Flask(__name__)
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///cul_db.db'
-app.secret_key = "Atri Thakar"
-db.init_app(app)
-
-with app.app_context():
-    db.create_all()
+import os
+from flask import Flask, Blueprint, render_template, redirect, url_for, session, jsonify, Response
+from cli_funcs import get_latest_version_cli, get_versions_cli, get_module_names_cli, search_modules_cli, get_batch_versions_cli, resolve_dependencies_cli, get_bundle_cli, get_job_status_cli, get_tokens_cli
+from serve_files_cli import serve_latest_version, serve_specified_version, serve_version_file, serve_version_manifest, serve_version_delta
+from artifact_cache import get_cache_stats
+from mirror import get_mirror_stats
+from page_cache import get_page_stats
+from metrics import init_metrics, render_metrics, profiler_control
+from db_config import configure_database, create_schema, ensure_schema, CREATE_SCHEMA
+from startup import get_startup_times
+from webui_funcs import login_webui, signup_user_webui, change_password_webui, main_page_webui, upload_modules_webui, delete_module_webui, update_module_webui, get_module_info_webui, get_profile_webui, create_token_webui, revoke_token_webui
+from auth import invalidate_profile
 
 BASE_DIR = "c_cpp_modules"  # Directory containing all modules and versions
 
+registry = Blueprint('registry', __name__)
+
+def create_app():
+    '''
+    Creates and configures the flask app. Creating the app does not touch the database, the missing tables are created before its first request (unless CUL_CREATE_SCHEMA=0), by the startup of wsgi.py or by flask --app app init-db.
+
+    Args:
+        None
+
+    Returns:
+        app: the flask app with every route of the registry
+
+    Raises:
+        ValueError: If the database settings are invalid
+    '''
+    app = Flask(__name__)
+    app.secret_key = "Atri Thakar"
+    # let a front-end server (nginx, apache) send files and archives with X-Sendfile instead of the worker
+    app.config['USE_X_SENDFILE'] = os.environ.get("CUL_USE_X_SENDFILE", "0") == "1"
+    configure_database(app)
+    init_metrics(app)
+    app.register_blueprint(registry)
+
+    if CREATE_SCHEMA:
+        @app.before_request
+        def _create_schema():
+            # deployments that do not start through wsgi.py (Vercel, flask run, gunicorn app:app) get the tables they are missing too
+            ensure_schema(app)
+
+    @app.cli.command('init-db')
+    def init_db():
+        """Create the database tables that do not exist yet."""
+        create_schema(app)
+        print("Database schema created.")
+
+    return app
+
 # for all the below routes, if you want to view the docstring, please refer to the respective function that is being called.
-@app.route('/', methods=['GET'])
+@registry.route('/', methods=['GET'])
 def index():
     return render_template('index.html')
 
-@app.route('/',methods=['POST'])
+@registry.route('/',methods=['POST'])
 def login():
     return login_webui()
 
-@app.route('/signup',methods=['GET'])
+@registry.route('/signup',methods=['GET'])
 def signup():
     return render_template('signup.html')
 
-@app.route('/signup',methods=['POST'])
+@registry.route('/signup',methods=['POST'])
 def signup_user():
     return signup_user_webui()
 
-@app.route('/logout', methods=['POST','GET'])
+@registry.route('/logout', methods=['POST','GET'])
 def logout():
-    session.pop('email', None)
-    return redirect(url_for('index'))
+    invalidate_profile(session.pop('email', None))
+    return redirect(url_for('registry.index'))
 
-@app.route('/change_password',methods=['POST'])
+@registry.route('/change_password',methods=['POST'])
 def change_password():
     return change_password_webui()
 
-@app.route('/profile',methods=['GET'])
+@registry.route('/profile',methods=['GET'])
 def get_profile():
     return get_profile_webui()
 
-@app.route('/main_page', methods=['GET', 'POST'])
+@registry.route('/tokens', methods=['POST'])
+def create_token():
+    return create_token_webui()
+
+@registry.route('/tokens', methods=['GET'])
+def get_tokens():
+    return get_tokens_cli()
+
+@registry.route('/revoke_token/<token_id>', methods=['POST'])
+def revoke_token(token_id):
+    return revoke_token_webui(token_id)
+
+@registry.route('/main_page', methods=['GET', 'POST'])
 def main_page():
     return main_page_webui()
 
-@app.route('/upload_modules', methods=['GET','POST'])
+@registry.route('/upload_modules', methods=['GET','POST'])
 def upload_modules():
     return upload_modules_webui()
     
-@app.route('/delete_module/<module_id>', methods=['GET','POST'])
+@registry.route('/delete_module/<module_id>', methods=['GET','POST'])
 def delete_module(module_id):
     return delete_module_webui(module_id)
 
-@app.route('/update_module/<module_id>', methods=['GET','POST'])
+@registry.route('/update_module/<module_id>', methods=['GET','POST'])
 def update_module(module_id):
     return update_module_webui(module_id)
 
-@app.route('/info/<module>/<version>')
+@registry.route('/jobs/<job_id>', methods=['GET'])
+def get_job_status(job_id):
+    return get_job_status_cli(job_id)
+
+@registry.route('/info/<module>/<version>')
 def get_module_info(module, version):
     return get_module_info_webui(module, version)
 
-@app.route('/files/<module_name>/<version>', methods=['GET'])
+@registry.route('/files/<module_name>/<version>', methods=['GET'])
 def serve_files(module_name, version):
     return serve_specified_version(module_name, version)
 
-@app.route('/files/<module_name>/', methods=['GET'])
+@registry.route('/files/<module_name>/<version>/<path:file_path>', methods=['GET'])
+def serve_file(module_name, version, file_path):
+    return serve_version_file(module_name, version, file_path)
+
+@registry.route('/manifest/<module_name>/<version>', methods=['GET'])
+def get_manifest(module_name, version):
+    return serve_version_manifest(module_name, version)
+
+@registry.route('/delta/<module_name>/<from_version>/<to_version>', methods=['GET'])
+def get_delta(module_name, from_version, to_version):
+    return serve_version_delta(module_name, from_version, to_version)
+
+@registry.route('/files/<module_name>/', methods=['GET'])
 def serve_files_2(module_name):
     return serve_latest_version(module_name)
 
-@app.route('/versions/<module_name>', methods=['GET'])
+@registry.route('/cache_stats', methods=['GET'])
+def cache_stats():
+    return jsonify(get_cache_stats())
+
+@registry.route('/versions/<module_name>', methods=['GET'])
 def get_versions(module_name):
     return get_versions_cli(module_name)
 
-@app.route('/latest_version/<module_name>', methods=['GET'])
+@registry.route('/latest_version/<module_name>', methods=['GET'])
 def get_latest_version(module_name):
     return get_latest_version_cli(module_name)
 
-@app.route('/modules', methods=['GET'])
+@registry.route('/batch_versions', methods=['POST'])
+def get_batch_versions():
+    return get_batch_versions_cli()
+
+@registry.route('/resolve', methods=['POST'])
+def resolve_dependencies():
+    return resolve_dependencies_cli()
+
+@registry.route('/bundle', methods=['POST'])
+def get_bundle():
+    return get_bundle_cli()
+
+@registry.route('/modules', methods=['GET'])
 def get_module_names():
     return get_module_names_cli()
 
+@registry.route('/search', methods=['GET'])
+def search_modules():
+    return search_modules_cli()
+
+@registry.route('/metrics', methods=['GET'])
+def metrics():
+    stats = {f"artifact_cache_{key}": value for key, value in get_cache_stats().items()}
+    stats.update({f"mirror_{key}": value for key, value in get_mirror_stats().items()})
+    stats.update({f"page_cache_{key}": value for key, value in get_page_stats().items()})
+    stats.update({f"startup_{key}_seconds": value for key, value in get_startup_times().items()})
+    return Response(render_metrics(stats), mimetype='text/plain; version=0.0.4')
+
+@registry.route('/debug/profiler', methods=['GET', 'POST'])
+def profiler():
+    return profiler_control()
+
+# the only app of the process: used by the development server, Vercel, scripts, benchmarks, asgi_app.py and wsgi.py
+app = create_app()
+
 if __name__ == '__main__':
+    create_schema(app)
     app.run(host='0.0.0.0', port=5000, debug=True)
@@ -0,0 +1,475 @@
+'''
+This file contains the on-disk artifact cache used to serve module archives. Every version is zipped once, stored under a name derived from the content hash of its directory and served straight from disk afterwards.
+'''
+
+import os
+import json
+import time
+import zlib
+import bisect
+import hashlib
+import zipfile
+import threading
+from collections import OrderedDict
+import registry_index
+from compression import STORED, DEFAULT_COMPRESSION
+from metrics import record_fs_read, record_zip_build
+from zip_stream import stream_directory_zip, ZipStreamWriter
+
+BASE_DIR = "c_cpp_modules"
+CACHE_DIR = os.environ.get("CUL_ARTIFACT_CACHE_DIR", "artifact_cache")
+MAX_CACHE_BYTES = int(os.environ.get("CUL_ARTIFACT_CACHE_MAX_BYTES", 512 * 1024 * 1024))
+# archives are written by zip_stream and are byte-identical to a streamed archive of the same tree, so ranges of
+# either can be served from the cached file. Bump when the layout changes so that old archives are not served.
+LAYOUT_VERSION = 3
+DELTA_DIR = "_delta"  # <module>/_delta/<from>..<to>/ holds the delta archives of a version pair
+DELTA_SUMMARY_NAME = ".cul_delta.json"  # entry of a delta archive listing the added, changed and removed files
+# bump when the files chosen for a delta archive or its summary change, together with LAYOUT_VERSION it names and tags delta archives
+DELTA_VERSION = 2
+# an evicted or stale archive stays on disk this long, so that a request that was just given its path can still open it
+REMOVAL_GRACE_SECONDS = 60
+
+_lock = threading.Lock()
+_entries = OrderedDict()  # artifact path -> size in bytes, least recently used first
+_doomed = OrderedDict()  # artifact path -> time it was dropped from the cache, removed from disk after REMOVAL_GRACE_SECONDS
+_tree_hashes = {}  # module directory -> (fingerprint, tree hash, relative path -> file sha256, last change in ns)
+_stats = {"hits": 0, "misses": 0, "builds": 0, "evictions": 0, "build_seconds": 0.0}
+_loaded = False
+
+def _fingerprint(module_dir):
+    '''
+    Returns a cheap fingerprint of a version directory built from the relative path, size, modification time and executable bit of every file in it, together with the time of the last change in the directory. Used to detect changes without reading file contents.
+
+    Args:
+        module_dir: The path of the version directory
+
+    Returns:
+        fingerprint: a (sorted tuple of (relative path, size, mtime, executable) entries, last change) tuple. The last change is the latest modification or status change time (ns) of any file or directory, so renaming, deleting or chmod'ing a file moves it forward even though no file mtime does
+
+    Raises:
+        OSError: If a file disappears while the directory is being walked
+    '''
+    entries = []
+    last_change = 0
+    for root, dirs, files in os.walk(module_dir):
+        stat = os.stat(root)
+        last_change = max(last_change, stat.st_mtime_ns, stat.st_ctime_ns)
+        for file in files:
+            file_path = os.path.join(root, file)
+            stat = os.stat(file_path)
+            last_change = max(last_change, stat.st_mtime_ns, stat.st_ctime_ns)
+            entries.append((os.path.relpath(file_path, module_dir), stat.st_size, stat.st_mtime_ns, bool(stat.st_mode & 0o111)))
+    return tuple(sorted(entries)), last_change
+
+def compute_tree_hash(module_dir):
+    '''
+    Returns the content hash of a version directory. The hash covers the relative path, contents and executable bit of every file, everything an archive of the directory is built from, and is only recomputed when the directory fingerprint changes.
+
+    Args:
+        module_dir: The path of the version directory
+
+    Returns:
+        tree hash: a hex encoded sha256 digest
+
+    Raises:
+        OSError: If a file cannot be read
+    '''
+    return _hash_tree(module_dir)[1]
+
+def _hash_tree(module_dir):
+    '''
+    Returns the memoized (fingerprint, tree hash, file hashes, last change) entry of a version directory, rehashing the files if the fingerprint changed.
+    '''
+    fingerprint, last_change = _fingerprint(module_dir)
+    with _lock:
+        cached = _tree_hashes.get(module_dir)
+    if cached and cached[0] == fingerprint:
+        if cached[3] != last_change:
+            cached = cached[:3] + (last_change,)
+            with _lock:
+                _tree_hashes[module_dir] = cached
+        return cached
+
+    tree_hash = hashlib.sha256()
+    file_hashes = {}
+    for rel_path, size, mtime, executable in fingerprint:
+        file_hash = hashlib.sha256()
+        with open(os.path.join(module_dir, rel_path), 'rb') as file:
+            for chunk in iter(lambda: file.read(65536), b''):
+                file_hash.update(chunk)
+        tree_hash.update(rel_path.replace(os.sep, '/').encode('utf-8') + (b'\1' if executable else b'\0'))
+        tree_hash.update(file_hash.digest())
+        file_hashes[rel_path.replace(os.sep, '/')] = file_hash.hexdigest()
+
+    record_fs_read("tree_hash", len(fingerprint))
+    entry = (fingerprint, tree_hash.hexdigest(), file_hashes, last_change)
+    with _lock:
+        _tree_hashes[module_dir] = entry
+    return entry
+
+def get_manifest(module_dir):
+    '''
+    Returns the manifest of a version directory: the size, sha256 and executable bit of every file. It is computed together with the tree hash, so it costs no extra reads once the version was hashed.
+
+    Args:
+        module_dir: The path of the version directory
+
+    Returns:
+        manifest: a (tree hash, files) tuple, files maps the relative path (with / separators) to a (size, sha256 hex digest, executable) tuple
+
+    Raises:
+        OSError: If a file cannot be read
+    '''
+    fingerprint, tree_hash, file_hashes, last_change = _hash_tree(module_dir)
+    files = {}
+    for rel_path, size, mtime, executable in fingerprint:
+        rel_path = rel_path.replace(os.sep, '/')
+        files[rel_path] = (size, file_hashes[rel_path], executable)
+    return tree_hash, files
+
+def get_file_digest(module_dir, rel_path):
+    '''
+    Returns the size and sha256 of a single file of a version directory without walking the directory. Only the file is stat'ed: its sha256 is taken from the memoized manifest of the directory when its size, modification time and executable bit still match, otherwise the file alone is hashed.
+
+    Args:
+        module_dir: The path of the version directory
+        rel_path: The path of the file relative to the version directory, with / separators
+
+    Returns:
+        digest: a (size, sha256 hex digest) tuple
+
+    Raises:
+        OSError: If the file cannot be read
+    '''
+    file_path = os.path.join(module_dir, *rel_path.split('/'))
+    stat = os.stat(file_path)
+    key = os.path.relpath(file_path, module_dir)
+    with _lock:
+        cached = _tree_hashes.get(module_dir)
+    if cached:
+        fingerprint, tree_hash, file_hashes, last_change = cached
+        position = bisect.bisect_left(fingerprint, (key,))
+        if position < len(fingerprint) and fingerprint[position] == (key, stat.st_size, stat.st_mtime_ns, bool(stat.st_mode & 0o111)):
+            return stat.st_size, file_hashes[key.replace(os.sep, '/')]
+    file_hash = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(65536), b''):
+            file_hash.update(chunk)
+    record_fs_read("tree_hash")
+    return stat.st_size, file_hash.hexdigest()
+
+def get_tree_validators(module_dir):
+    '''
+    Returns the validators used for conditional requests on the archive of a version directory. Only the directory fingerprint is read when the tree hash is already known, nothing is zipped. The last modified timestamp is the last change of any file or directory of the version, so it moves forward whenever the tree hash changes, including renames and deletes.
+
+    Args:
+        module_dir: The path of the version directory
+
+    Returns:
+        validators: a (tree hash, last modified timestamp) tuple
+
+    Raises:
+        OSError: If the version directory cannot be read
+    '''
+    fingerprint, tree_hash, file_hashes, last_change = _hash_tree(module_dir)
+    return tree_hash, last_change // 10**9
+
+def _load_existing_artifacts():
+    '''
+    Registers the artifacts already present in the cache directory (e.g. from a previous run), oldest access first. Must be called with the lock held.
+    '''
+    global _loaded
+    if _loaded:
+        return
+    found = []
+    if os.path.isdir(CACHE_DIR):
+        for root, dirs, files in os.walk(CACHE_DIR):
+            for file in files:
+                if file.endswith('.zip'):
+                    path = os.path.join(root, file)
+                    stat = os.stat(path)
+                    found.append((stat.st_atime, path, stat.st_size))
+    for atime, path, size in sorted(found):
+        _entries[path] = size
+    _loaded = True
+    _evict_locked()
+
+def load_index():
+    '''
+    Registers the artifacts already present in the cache directory. Called once by the preloading startup so that forked workers inherit the index, otherwise it is loaded on first use.
+    '''
+    with _lock:
+        _load_existing_artifacts()
+
+def _discard_locked(path):
+    '''
+    Drops an artifact from the cache. The file is only removed from disk REMOVAL_GRACE_SECONDS later, since get_artifact may have just returned its path to a request that has not opened it yet. Must be called with the lock held.
+    '''
+    _entries.pop(path, None)
+    _doomed[path] = time.monotonic()
+    _doomed.move_to_end(path)
+    _remove_doomed_locked()
+
+def _remove_doomed_locked():
+    '''
+    Removes the dropped artifacts whose grace period is over. Must be called with the lock held.
+    '''
+    while _doomed:
+        path, dropped = next(iter(_doomed.items()))
+        if time.monotonic() - dropped < REMOVAL_GRACE_SECONDS:
+            break
+        del _doomed[path]
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+def _evict_locked():
+    '''
+    Drops least recently used artifacts until the cache fits in MAX_CACHE_BYTES. The most recently used artifact is always kept so that it can still be served. Must be called with the lock held.
+    '''
+    total = sum(_entries.values())
+    while total > MAX_CACHE_BYTES and len(_entries) > 1:
+        path, size = next(iter(_entries.items()))
+        total -= size
+        _stats["evictions"] += 1
+        _discard_locked(path)
+
+def _artifact_path(module_name, version, tree_hash, compression):
+    '''
+    Returns the path of the archive of a version tree built with the given compression mode, e.g. <tree hash>.v3.zip for stored archives and <tree hash>.deflate9.v3.zip for deflated ones.
+    '''
+    suffix = '' if compression.compress_type == zipfile.ZIP_STORED else f".deflate{compression.level}"
+    return os.path.join(CACHE_DIR, module_name, version, f"{tree_hash}{suffix}.v{LAYOUT_VERSION}.zip")
+
+def _write_atomically(artifact_path, chunks):
+    '''
+    Writes the chunks of an archive to artifact_path. The archive is written to a temporary file first and moved into place so that readers never see a partial archive.
+    '''
+    os.makedirs(os.path.dirname(artifact_path), exist_ok=True)
+    tmp_path = f"{artifact_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_path, 'wb') as file:
+            for chunk in chunks:
+                file.write(chunk)
+        os.replace(tmp_path, artifact_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def _build_zip(module_dir, artifact_path, compression):
+    '''
+    Zips the version directory into artifact_path with the streaming writer, so the file has exactly the bytes a streamed download of the same tree has.
+    '''
+    _write_atomically(artifact_path, stream_directory_zip(module_dir, compression.compress_type, compression.level))
+
+def _store_artifact(artifact_path, current_prefix, build):
+    '''
+    Builds an archive with build(artifact_path) and registers it in the cache. Other archives in the same directory whose name does not start with current_prefix were built from previous contents and are removed.
+    '''
+    with _lock:
+        _stats["misses"] += 1
+        # the archive is rebuilt under the same name, a pending removal must not delete the new file
+        _doomed.pop(artifact_path, None)
+
+    start = time.perf_counter()
+    build(artifact_path)
+    elapsed = time.perf_counter() - start
+    record_zip_build(elapsed)
+
+    cache_dir = os.path.dirname(artifact_path)
+    with _lock:
+        _stats["builds"] += 1
+        _stats["build_seconds"] += elapsed
+        for path in [p for p in _entries if os.path.dirname(p) == cache_dir and not os.path.basename(p).startswith(current_prefix)]:
+            _discard_locked(path)
+        _entries[artifact_path] = os.path.getsize(artifact_path)
+        _entries.move_to_end(artifact_path)
+        _evict_locked()
+
+def _lookup_path(artifact_path):
+    with _lock:
+        _load_existing_artifacts()
+        _remove_doomed_locked()
+        if artifact_path in _entries and os.path.exists(artifact_path):
+            _entries.move_to_end(artifact_path)
+            _stats["hits"] += 1
+            return artifact_path
+    return None
+
+def lookup_artifact(module_name, version, module_dir, tree_hash=None, compression=STORED):
+    '''
+    Returns the path of the cached zip archive for the specified module version without building it.
+
+    Args:
+        module_name: The name of the module
+        version: The version of the module
+        module_dir: The path of the version directory
+        tree_hash: The content hash of the version directory, if the caller already computed it
+        compression: The CompressionMode the archive was built with
+
+    Returns:
+        artifact path: the path of the zip archive on disk, or None if the current contents of the version are not cached
+
+    Raises:
+        OSError: If the version directory cannot be read
+    '''
+    if tree_hash is None:
+        tree_hash = compute_tree_hash(module_dir)
+    return _lookup_path(_artifact_path(module_name, version, tree_hash, compression))
+
+def get_artifact(module_name, version, module_dir, tree_hash=None, compression=STORED):
+    '''
+    Returns the path of the zip archive for the specified module version, building it if it is not cached yet or if the version directory has changed since it was built. Stale archives of the same version are removed.
+
+    Args:
+        module_name: The name of the module
+        version: The version of the module
+        module_dir: The path of the version directory
+        tree_hash: The content hash of the version directory, if the caller already computed it
+        compression: The CompressionMode to build the archive with
+
+    Returns:
+        artifact path: the path of the zip archive on disk
+
+    Raises:
+        OSError: If the version directory cannot be read or the archive cannot be written
+    '''
+    if tree_hash is None:
+        tree_hash = compute_tree_hash(module_dir)
+    cached_path = lookup_artifact(module_name, version, module_dir, tree_hash, compression)
+    if cached_path:
+        return cached_path
+
+    # archives built from previous contents of this version are dropped
+    artifact_path = _artifact_path(module_name, version, tree_hash, compression)
+    _store_artifact(artifact_path, tree_hash, lambda path: _build_zip(module_dir, path, compression))
+    return artifact_path
+
+def diff_manifests(from_files, to_files):
+    '''
+    Compares two manifests returned by get_manifest. A file is changed if its contents or its executable bit differ, the tree hash covers both.
+
+    Args:
+        from_files: The files of the old version
+        to_files: The files of the new version
+
+    Returns:
+        diff: a dictionary with the sorted "added", "changed" and "removed" relative paths, and the "executable" paths among the added and changed ones
+
+    Raises:
+        None
+    '''
+    added = sorted(path for path in to_files if path not in from_files)
+    changed = sorted(path for path in to_files if path in from_files and from_files[path][1:] != to_files[path][1:])
+    return {
+        "added": added,
+        "changed": changed,
+        "removed": sorted(path for path in from_files if path not in to_files),
+        # zip extractors that ignore the unix mode of the entries can restore it from here
+        "executable": sorted(path for path in added + changed if to_files[path][2]),
+    }
+
+def _build_delta(to_dir, diff, summary, artifact_path, compression):
+    def chunks():
+        writer = ZipStreamWriter()
+        for rel_path in diff["added"] + diff["changed"]:
+            yield from writer.add_file(rel_path, os.path.join(to_dir, rel_path), compression.compress_type, compression.level)
+        data = json.dumps(summary, indent=4).encode('utf-8')
+        yield writer.add_precompressed(DELTA_SUMMARY_NAME, data, zlib.crc32(data), len(data), zipfile.ZIP_STORED)
+        yield writer.finish()
+    _write_atomically(artifact_path, chunks())
+
+def get_delta_artifact(module_name, from_version, to_version, compression=STORED):
+    '''
+    Returns the archive that upgrades a module from one version to another: the files added or changed in to_version, plus a DELTA_SUMMARY_NAME entry listing the added, changed, removed and executable paths. The files are compared by the sha256 and executable bit of their manifests, and the archive is cached per version pair until either version changes.
+
+    Args:
+        module_name: The name of the module
+        from_version: The version the client has
+        to_version: The version the client wants
+        compression: The CompressionMode to build the archive with
+
+    Returns:
+        delta: an (artifact path, summary) tuple, summary is the content of the DELTA_SUMMARY_NAME entry
+
+    Raises:
+        OSError: If a version directory cannot be read or the archive cannot be written
+    '''
+    from_hash, from_files = get_manifest(os.path.join(BASE_DIR, module_name, from_version))
+    to_dir = os.path.join(BASE_DIR, module_name, to_version)
+    to_hash, to_files = get_manifest(to_dir)
+    diff = diff_manifests(from_files, to_files)
+    summary = {"module": module_name, "from": from_version, "to": to_version,
+               "from_tree_hash": from_hash, "to_tree_hash": to_hash, **diff}
+
+    suffix = '' if compression.compress_type == zipfile.ZIP_STORED else f".deflate{compression.level}"
+    pair_hash = f"{from_hash}-{to_hash}"
+    artifact_path = os.path.join(CACHE_DIR, module_name, DELTA_DIR, f"{from_version}..{to_version}", f"{pair_hash}{suffix}.v{LAYOUT_VERSION}.{DELTA_VERSION}.zip")
+    if _lookup_path(artifact_path):
+        return artifact_path, summary
+    _store_artifact(artifact_path, pair_hash, lambda path: _build_delta(to_dir, diff, summary, path, compression))
+    return artifact_path, summary
+
+def invalidate_module(module_name):
+    '''
+    Removes every cached archive of the specified module. Called when a module is updated or deleted.
+
+    Args:
+        module_name: The name of the module
+
+    Returns:
+        None
+
+    Raises:
+        None
+    '''
+    module_cache_dir = os.path.join(CACHE_DIR, module_name)
+    with _lock:
+        for path in [p for p in _entries if p.startswith(module_cache_dir + os.sep)]:
+            _discard_locked(path)
+        module_dir = os.path.join(BASE_DIR, module_name)
+        for key in [k for k in _tree_hashes if k.startswith(module_dir + os.sep)]:
+            del _tree_hashes[key]
+
+def prebuild_module(module_name):
+    '''
+    Builds the archives of every version listed in the versions.json file of the specified module with the default compression of the deployment, so that the first download does not pay for zipping. Errors are printed and otherwise ignored, the archive will be built on first request instead.
+
+    Args:
+        module_name: The name of the module
+
+    Returns:
+        None
+
+    Raises:
+        None
+    '''
+    try:
+        data = registry_index.get_versions_data(module_name) or {}
+        for item in data.get('versions', []):
+            module_dir = os.path.join(BASE_DIR, item['path'])
+            if os.path.isdir(module_dir):
+                get_artifact(module_name, item['version'], module_dir, compression=DEFAULT_COMPRESSION)
+    except Exception as e:
+        print(f"Error prebuilding archives for '{module_name}': {e}")
+
+def get_cache_stats():
+    '''
+    Returns the hit/miss counters and the current size of the artifact cache.
+
+    Args:
+        None
+
+    Returns:
+        stats: a dictionary with hits, misses, builds, evictions, build_seconds, artifacts, size_bytes and max_size_bytes
+
+    Raises:
+        None
+    '''
+    with _lock:
+        stats = dict(_stats)
+        stats["artifacts"] = len(_entries)
+        stats["size_bytes"] = sum(_entries.values())
+        stats["max_size_bytes"] = MAX_CACHE_BYTES
+    return stats
@@ -0,0 +1,147 @@
+'''
+This file contains the ASGI app serving the CLI facing endpoints (/files, /versions, /latest_version and /modules) and /metrics for high-concurrency download traffic. Run it next to (or instead of) the Flask app with an ASGI server, e.g. `uvicorn asgi_app:app --host 0.0.0.0 --port 5001`, and route the CLI paths to it.
+
+Every request runs the same functions as the Flask routes (cli_funcs.py, serve_files_cli.py) on a thread pool, inside a Flask request context built from the ASGI request, so lookups, conditional requests, compression negotiation and error messages are identical. Only the archive itself is sent differently: cached archives are read in chunks by FileResponse (which answers Range requests) and streamed archives by StreamingResponse, both offloading file I/O to threads, so a slow client downloading a zip holds a coroutine instead of a worker thread. The Flask request hooks do not run here, so every request is recorded in the per-route metrics under the same route as the Flask app.
+'''
+
+import os
+import time
+from contextlib import asynccontextmanager
+from email.utils import formatdate
+from anyio import to_thread, CapacityLimiter
+from starlette.applications import Starlette
+from starlette.responses import Response, FileResponse, StreamingResponse
+from starlette.routing import Route
+from app import app as flask_app, metrics as metrics_view
+from cli_funcs import get_latest_version_cli, get_versions_cli, get_module_names_cli
+from serve_files_cli import serve_latest_version, serve_specified_version, prepare_module_zip
+from zip_stream import stream_directory_zip
+from startup import preload, report
+from metrics import record_request, record_bytes
+
+ASGI_THREADS = int(os.environ.get("CUL_ASGI_THREADS", 40))
+
+_limiter = None
+
+def _get_limiter():
+    # created on first use, the limiter belongs to the event loop of the server
+    global _limiter
+    if _limiter is None:
+        _limiter = CapacityLimiter(ASGI_THREADS)
+    return _limiter
+
+def _to_starlette(response):
+    '''
+    Copies a buffered Flask response (JSON bodies, 304 and error responses) into a Starlette response, keeping every header.
+    '''
+    converted = Response(response.get_data(), status_code=response.status_code)
+    converted.raw_headers = [(key.lower().encode('latin-1'), value.encode('latin-1')) for key, value in response.headers.items()]
+    return converted
+
+def _call_registry(request, function, *args):
+    '''
+    Runs a registry function of the Flask app inside a Flask request context carrying the method, path, query string and headers of the ASGI request. Runs on the thread pool.
+
+    Args:
+        request: The Starlette request
+        function: The function called by the matching Flask route
+        args: Its arguments
+
+    Returns:
+        result: the archive dictionary of prepare_module_zip or mirror.serve, or the response converted to a Starlette response
+
+    Raises:
+        None
+    '''
+    with flask_app.test_request_context(request.url.path, method=request.method, query_string=request.url.query,
+                                        headers=list(request.headers.items())):
+        result = function(*args)
+        if isinstance(result, dict):
+            return result
+        return _to_starlette(flask_app.make_response(result))
+
+def _send_archive(archive):
+    '''
+    Sends the archive chosen by prepare_module_zip, or the mirrored archive chosen by mirror.serve, without holding a thread while the client downloads it.
+    '''
+    headers = {
+        "content-disposition": f"attachment; filename={archive['download_name']}",
+        "vary": "Accept",
+    }
+    if archive['etag'] is not None:
+        headers["etag"] = f'"{archive["etag"]}"'
+    if archive['last_modified'] is not None:
+        headers["last-modified"] = formatdate(int(archive['last_modified']), usegmt=True)
+    if archive['artifact_path'] is not None:
+        return FileResponse(archive['artifact_path'], headers=headers, media_type=archive.get('content_type', 'application/zip'))
+    compression = archive['compression']
+    headers["accept-ranges"] = "bytes"
+    # the synchronous generator is advanced on the thread pool chunk by chunk
+    return StreamingResponse(stream_directory_zip(archive['module_dir'], compression.compress_type, compression.level),
+                             headers=headers, media_type='application/zip')
+
+class _Recorded:
+    '''
+    Wraps a response to record the request in the per-route metrics once the status line is sent (the status of a FileResponse answering a range is only known then), and counts the body bytes actually sent.
+    '''
+
+    def __init__(self, response, route, method, start):
+        self.response = response
+        self.route = route
+        self.method = method
+        self.start = start
+
+    async def __call__(self, scope, receive, send):
+        async def recording_send(message):
+            if message['type'] == 'http.response.start':
+                record_request(self.route, self.method, message['status'], time.perf_counter() - self.start)
+            elif message['type'] == 'http.response.body':
+                record_bytes(self.route, len(message.get('body', b'')))
+            await send(message)
+        await self.response(scope, receive, recording_send)
+
+async def _respond(request, route, function, *args):
+    '''
+    Runs a registry function on the thread pool and returns its response. route is the rule of the matching Flask route, e.g. /versions/<module_name>, so the metrics of both apps add up.
+    '''
+    start = time.perf_counter()
+    result = await to_thread.run_sync(_call_registry, request, function, *args, limiter=_get_limiter())
+    if isinstance(result, dict):
+        result = _send_archive(result)
+    return _Recorded(result, route, request.method, start)
+
+# for all the below routes, if you want to view the docstring, please refer to the respective function that is being called.
+async def serve_files(request):
+    return await _respond(request, '/files/<module_name>/<version>', serve_specified_version,
+                          request.path_params['module_name'], request.path_params['version'], prepare_module_zip)
+
+async def serve_files_2(request):
+    return await _respond(request, '/files/<module_name>/', serve_latest_version, request.path_params['module_name'], prepare_module_zip)
+
+async def get_versions(request):
+    return await _respond(request, '/versions/<module_name>', get_versions_cli, request.path_params['module_name'])
+
+async def get_latest_version(request):
+    return await _respond(request, '/latest_version/<module_name>', get_latest_version_cli, request.path_params['module_name'])
+
+async def get_module_names(request):
+    return await _respond(request, '/modules', get_module_names_cli)
+
+async def metrics(request):
+    return await _respond(request, '/metrics', metrics_view)
+
+@asynccontextmanager
+async def lifespan(app):
+    # uvicorn starts its workers as new processes, so every worker runs the startup phases once before serving
+    await to_thread.run_sync(preload, flask_app)
+    report()
+    yield
+
+app = Starlette(lifespan=lifespan, routes=[
+    Route('/files/{module_name}/', serve_files_2, methods=['GET']),
+    Route('/files/{module_name}/{version}', serve_files, methods=['GET']),
+    Route('/versions/{module_name}', get_versions, methods=['GET']),
+    Route('/latest_version/{module_name}', get_latest_version, methods=['GET']),
+    Route('/modules', get_module_names, methods=['GET']),
+    Route('/metrics', metrics, methods=['GET']),
+])
@@ -0,0 +1,175 @@
+'''
+This file contains the authentication helpers of the registry. Profile pages are built from a per-user cache filled by a single joined query of the user and their modules, and dropped on logout or when the user's modules change. CLI clients authenticate with API tokens sent as "Authorization: Bearer <token>": only the sha256 of a token is stored, so checking one is an indexed lookup (usually a dictionary hit) instead of a password hash.
+'''
+
+import os
+import time
+import hashlib
+import secrets
+import threading
+from collections import OrderedDict
+from flask import request, session
+from database import db
+from models import User, Module, ApiToken
+
+PROFILE_CACHE_SECONDS = float(os.environ.get("CUL_PROFILE_CACHE_SECONDS", 30))
+TOKEN_CACHE_SECONDS = float(os.environ.get("CUL_TOKEN_CACHE_SECONDS", 60))
+MAX_CACHED = 10000
+TOKEN_PREFIX = "cul_"
+
+_lock = threading.Lock()
+_profiles = OrderedDict()  # email -> (expires, profile, modules)
+_tokens = OrderedDict()  # token hash -> (expires, email)
+
+def _remember(cache, key, value):
+    with _lock:
+        cache[key] = value
+        cache.move_to_end(key)
+        while len(cache) > MAX_CACHED:
+            cache.popitem(last=False)
+
+def load_profile(email):
+    '''
+    Returns the profile of a user and the modules they published, read with one joined query and cached for PROFILE_CACHE_SECONDS.
+
+    Args:
+        email: The email of the user
+
+    Returns:
+        profile: a (profile, modules) tuple of plain dictionaries, (None, []) if the user does not exist
+
+    Raises:
+        None
+    '''
+    now = time.monotonic()
+    cached = _profiles.get(email)
+    if cached and cached[0] > now:
+        return cached[1], cached[2]
+    rows = db.session.query(User, Module).outerjoin(Module, Module.associated_user == User.email) \
+        .filter(User.email == email).order_by(Module.module_id).all()
+    if not rows:
+        return None, []
+    user = rows[0][0]
+    profile = {"email": user.email, "username": user.username, "first_name": user.first_name, "last_name": user.last_name}
+    modules = [{"module_id": module.module_id, "module_name": module.module_name, "module_url": module.module_url}
+               for user, module in rows if module is not None]
+    _remember(_profiles, email, (now + PROFILE_CACHE_SECONDS, profile, modules))
+    return profile, modules
+
+def invalidate_profile(email):
+    '''
+    Drops the cached profile of a user, called on logout and when a module of the user is added or removed.
+    '''
+    with _lock:
+        _profiles.pop(email, None)
+
+def hash_token(token):
+    '''
+    Returns the sha256 hex digest a token is stored under.
+    '''
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+def create_token(email, name=None):
+    '''
+    Creates an API token for a user. The token is returned once and only its hash is stored.
+
+    Args:
+        email: The email of the user
+        name: An optional label, e.g. the machine the CLI runs on
+
+    Returns:
+        token: a (token id, token) tuple
+
+    Raises:
+        None
+    '''
+    token = TOKEN_PREFIX + secrets.token_urlsafe(32)
+    api_token = ApiToken(token_hash=hash_token(token), email=email, name=name)
+    db.session.add(api_token)
+    db.session.commit()
+    return api_token.token_id, token
+
+def authenticate_token(token):
+    '''
+    Returns the email of the user a token belongs to, or None if the token is unknown or revoked. Known tokens are cached for TOKEN_CACHE_SECONDS, so a token revoked in another worker process stays valid there for at most that long.
+
+    Args:
+        token: The token sent by the client
+
+    Returns:
+        email: the email of the token's user, or None
+
+    Raises:
+        None
+    '''
+    token_hash = hash_token(token)
+    now = time.monotonic()
+    cached = _tokens.get(token_hash)
+    if cached and cached[0] > now:
+        return cached[1]
+    email = db.session.query(ApiToken.email).filter_by(token_hash=token_hash).scalar()
+    if email is not None:
+        _remember(_tokens, token_hash, (now + TOKEN_CACHE_SECONDS, email))
+    return email
+
+def list_tokens(email):
+    '''
+    Returns the tokens of a user (without the secret part) as {"token_id", "name", "created"} dictionaries.
+    '''
+    return [{"token_id": token_id, "name": name, "created": created.isoformat()}
+            for token_id, name, created in db.session.query(ApiToken.token_id, ApiToken.name, ApiToken.created).filter_by(email=email)]
+
+def revoke_token(email, token_id):
+    '''
+    Deletes one of the user's tokens.
+
+    Args:
+        email: The email of the user
+        token_id: The id of the token
+
+    Returns:
+        revoked: False if the user has no such token
+
+    Raises:
+        None
+    '''
+    api_token = ApiToken.query.filter_by(token_id=token_id, email=email).first()
+    if api_token is None:
+        return False
+    with _lock:
+        _tokens.pop(api_token.token_hash, None)
+    db.session.delete(api_token)
+    db.session.commit()
+    return True
+
+def revoke_all_tokens(email):
+    '''
+    Deletes every token of a user, e.g. when their password changes so that a leaked token does not outlive it. Tokens cached by other worker processes stay valid there for at most TOKEN_CACHE_SECONDS. The deletion is committed by the caller.
+
+    Args:
+        email: The email of the user
+
+    Returns:
+        count: the number of tokens revoked
+
+    Raises:
+        None
+    '''
+    token_hashes = [token_hash for token_hash, in db.session.query(ApiToken.token_hash).filter_by(email=email)]
+    with _lock:
+        for token_hash in token_hashes:
+            _tokens.pop(token_hash, None)
+    ApiToken.query.filter_by(email=email).delete()
+    return len(token_hashes)
+
+def current_user_email():
+    '''
+    Returns the email of the user making the request: the logged in user of the web session, or the owner of the bearer token sent by a CLI client. None if the request is not authenticated.
+    '''
+    email = session.get('email')
+    if email:
+        return email
+    scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+    if scheme.lower() == 'bearer' and token.strip():
+        return authenticate_token(token.strip())
+    return None
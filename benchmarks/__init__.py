@@ -0,0 +1,3 @@
+'''
+Benchmarks for the registry. Run them from the repository root, e.g. python -m benchmarks.bench_serve_modes
+'''
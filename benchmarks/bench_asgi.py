@@ -0,0 +1,168 @@
+'''
+Compares how many concurrent downloads the Flask app and the ASGI app (asgi_app.py) can hold. Each app runs in its own server process: the Flask app on a WSGI server with a fixed number of worker threads (like gunicorn --threads), the ASGI app on uvicorn. Slow clients keep downloading archives while a probe measures the latency of /versions requests, which stays low only if the server does not run out of threads.
+
+Usage: python -m benchmarks.bench_asgi [--slow-clients N] [--seconds S] [--flask-threads N] [--files N] [--file-size BYTES]
+'''
+
+import os
+import sys
+import time
+import socket
+import asyncio
+import argparse
+import tempfile
+import subprocess
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from benchmarks.synthetic import generate_tree
+from benchmarks.bench_endpoints import _seed_database
+
+READ_SIZE = 16384
+READ_DELAY = 0.01  # a slow client reads READ_SIZE bytes every READ_DELAY seconds
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def _serve(kind, port, threads):
+    '''
+    Runs one of the servers in this process, called in the server subprocess.
+    '''
+    if kind == 'flask':
+        from concurrent.futures import ThreadPoolExecutor
+        from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+        from app import app
+
+        class QuietHandler(WSGIRequestHandler):
+            def log_request(self, *args, **kwargs):
+                pass
+
+        class PooledServer(BaseWSGIServer):
+            # a fixed pool of worker threads, a connection waits in the queue until a thread is free
+            executor = ThreadPoolExecutor(max_workers=threads)
+
+            def process_request(self, request, client_address):
+                self.executor.submit(self._handle, request, client_address)
+
+            def _handle(self, request, client_address):
+                try:
+                    self.finish_request(request, client_address)
+                except Exception:
+                    self.handle_error(request, client_address)
+                finally:
+                    self.shutdown_request(request)
+
+        PooledServer('127.0.0.1', port, app, handler=QuietHandler).serve_forever()
+    else:
+        import uvicorn
+        uvicorn.run('asgi_app:app', host='127.0.0.1', port=port, log_level='warning')
+
+async def _get(port, path, slow=False, timeout=None):
+    '''
+    Sends a GET request and reads the whole response, READ_SIZE bytes every READ_DELAY seconds for slow clients. Returns the number of bytes read.
+    '''
+    sock = socket.socket()
+    # a small receive buffer so that the kernel cannot absorb the archive for a slow client
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 65536)
+    sock.setblocking(False)
+    await asyncio.get_running_loop().sock_connect(sock, ('127.0.0.1', port))
+    reader, writer = await asyncio.open_connection(sock=sock)
+    try:
+        writer.write(f"GET {path} HTTP/1.1\r\nHost: bench\r\nConnection: close\r\n\r\n".encode())
+        await writer.drain()
+        total = 0
+        while True:
+            chunk = await asyncio.wait_for(reader.read(READ_SIZE), timeout)
+            if not chunk:
+                return total
+            total += len(chunk)
+            if slow:
+                await asyncio.sleep(READ_DELAY)
+    finally:
+        writer.close()
+
+async def _load(port, module_names, slow_clients, seconds):
+    stop = time.monotonic() + seconds
+    counts = {"downloads": 0, "bytes": 0, "probe_timeouts": 0}
+    probes = []
+
+    async def slow_client(index):
+        while time.monotonic() < stop:
+            try:
+                size = await _get(port, f"/files/{module_names[index % len(module_names)]}/", slow=True)
+                counts["bytes"] += size
+                counts["downloads"] += 1
+            except OSError:
+                await asyncio.sleep(0.1)
+
+    async def probe():
+        while time.monotonic() < stop:
+            start = time.perf_counter()
+            try:
+                await _get(port, f"/versions/{module_names[len(probes) % len(module_names)]}", timeout=max(0.1, stop - time.monotonic()))
+                probes.append(time.perf_counter() - start)
+            except (OSError, asyncio.TimeoutError):
+                counts["probe_timeouts"] += 1
+            await asyncio.sleep(0.05)
+
+    await asyncio.gather(probe(), *(slow_client(i) for i in range(slow_clients)))
+    return counts, sorted(probes)
+
+def _wait_for_port(port, process, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("The server exited during startup")
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError("The server did not start")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--slow-clients', type=int, default=200)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--flask-threads', type=int, default=16, help="worker threads of the WSGI server running the Flask app")
+    parser.add_argument('--modules', type=int, default=10)
+    # archives larger than the socket send buffers, otherwise the kernel buffers a download and frees the thread early
+    parser.add_argument('--files', type=int, default=64)
+    parser.add_argument('--file-size', type=int, default=131072)
+    parser.add_argument('--serve', choices=['flask', 'asgi'], help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        _serve(args.serve, args.port, args.flask_threads)
+        return
+
+    print(f"{'server':<8}{'downloads':>11}{'MB/s':>8}{'probe p50 ms':>14}{'probe p99 ms':>14}{'probes':>8}{'timeouts':>10}")
+    with tempfile.TemporaryDirectory() as tmp:
+        module_names = generate_tree(os.path.join(tmp, 'c_cpp_modules'), args.modules, 1, args.files, args.file_size)
+        env = dict(os.environ, PYTHONPATH=REPO_DIR, CUL_DATABASE_URL=f"sqlite:///{os.path.join(tmp, 'bench.db')}",
+                   CUL_ARTIFACT_CACHE_DIR=os.path.join(tmp, 'artifact_cache'), CUL_INDEX_REFRESH_SECONDS="0")
+        os.environ.update(env)
+        os.chdir(tmp)
+        from app import app
+        _seed_database(app, module_names)
+
+        for kind in ('flask', 'asgi'):
+            port = _free_port()
+            process = subprocess.Popen([sys.executable, '-m', 'benchmarks.bench_asgi', '--serve', kind, '--port', str(port),
+                                        '--flask-threads', str(args.flask_threads)], cwd=tmp, env=env)
+            try:
+                _wait_for_port(port, process)
+                counts, probes = asyncio.run(_load(port, module_names, args.slow_clients, args.seconds))
+            finally:
+                process.terminate()
+                process.wait()
+            p50 = f"{probes[len(probes) // 2] * 1000:.1f}" if probes else "n/a"
+            p99 = f"{probes[min(len(probes) - 1, len(probes) * 99 // 100)] * 1000:.1f}" if probes else "n/a"
+            print(f"{kind:<8}{counts['downloads']:>11}{counts['bytes'] / args.seconds / 1e6:>8.1f}{p50:>14}{p99:>14}{len(probes):>8}{counts['probe_timeouts']:>10}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+'''
+Measures the authentication paths of the registry through the Flask test client: password logins, profile views with and without the profile cache, and CLI requests that check a password hash every time versus requests sending an API token.
+
+Usage: python -m benchmarks.bench_auth [--users N] [--modules N] [--requests N]
+'''
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+from werkzeug.security import generate_password_hash, check_password_hash
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+PASSWORD = "bench-password"
+
+def _percentile(values, percent):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))] if values else 0
+
+def _seed(app, users, modules):
+    from database import db
+    from models import User, Module
+    from db_config import create_schema
+    create_schema(app)
+    password_hash = generate_password_hash(PASSWORD)
+    with app.app_context():
+        db.session.add_all(User(email=f"user{u}@bench", password=password_hash, first_name="bench", username=f"user{u}") for u in range(users))
+        db.session.add_all(Module(module_name=f"module_{u}_{m}", module_url="x", associated_user=f"user{u}@bench") for u in range(users) for m in range(modules))
+        db.session.commit()
+
+def _measure(label, requests, call):
+    latencies = []
+    wall_start = time.perf_counter()
+    for i in range(requests):
+        start = time.perf_counter()
+        call(i)
+        latencies.append(time.perf_counter() - start)
+    wall = time.perf_counter() - wall_start
+    print(f"{label:<32}{requests / wall:>10.0f}{_percentile(latencies, 50) * 1000:>10.2f}"
+          f"{_percentile(latencies, 95) * 1000:>10.2f}{_percentile(latencies, 99) * 1000:>10.2f}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--modules', type=int, default=20, help="modules published by every user")
+    parser.add_argument('--requests', type=int, default=300)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ.setdefault("CUL_DATABASE_URL", f"sqlite:///{os.path.join(tmp, 'bench.db')}")
+        os.chdir(tmp)
+        from app import app
+        from database import db
+        from models import User
+        import auth
+        _seed(app, args.users, args.modules)
+        client = app.test_client()
+        email = lambda i: f"user{i % args.users}@bench"
+
+        def check(response, status=200):
+            response.get_data()
+            if response.status_code != status:
+                raise RuntimeError(f"{response.request.path} returned {response.status_code}")
+
+        def profile(i):
+            with client.session_transaction() as session:
+                session['email'] = email(i)
+            check(client.get('/profile'))
+
+        def password_request(i):
+            # what a CLI pays when it sends its password with every request, the session only carries the checked user
+            with app.app_context():
+                password_hash = db.session.query(User.password).filter_by(email=email(i)).scalar()
+                check_password_hash(password_hash, PASSWORD)
+            with client.session_transaction() as session:
+                session['email'] = email(i)
+            check(client.get('/tokens'))
+
+        tokens = []
+        for u in range(args.users):
+            response = client.post('/tokens', json={"email": email(u), "password": PASSWORD})
+            tokens.append(response.get_json()["token"])
+        with client.session_transaction() as session:
+            session.clear()
+
+        print(f"{'path':<32}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+        _measure("POST / (login)", args.requests, lambda i: check(client.post('/', data={"email": email(i), "password": PASSWORD}), 302))
+        cache_seconds = auth.PROFILE_CACHE_SECONDS
+        auth.PROFILE_CACHE_SECONDS = 0
+        _measure("GET /profile (uncached)", args.requests, profile)
+        auth.PROFILE_CACHE_SECONDS = cache_seconds
+        _measure("GET /profile (cached)", args.requests, profile)
+        _measure("password per request", args.requests, password_request)
+        with client.session_transaction() as session:
+            session.clear()
+        _measure("bearer token", args.requests, lambda i: check(client.get('/tokens', headers={"Authorization": f"Bearer {tokens[i % args.users]}"})))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+'''
+Measures the disk and page cache savings of the content-addressed blob store on a synthetic registry with many versions, where only a fraction of the files change from one version to the next. Disk usage counts every inode once, so files hard linked to the same blob are only counted once. The page cache footprint is the number of distinct bytes that have to be cached to serve every version.
+
+Usage: python -m benchmarks.bench_blob_store [--modules N] [--versions N] [--files N] [--file-size BYTES] [--churn FRACTION]
+'''
+
+import os
+import time
+import argparse
+import tempfile
+
+from benchmarks.synthetic import generate_tree
+
+def _usage(*dirs):
+    '''
+    Returns (allocated bytes on disk, distinct file bytes) of the given directories, counting every inode once.
+    '''
+    seen = set()
+    disk, distinct = 0, 0
+    for base_dir in dirs:
+        for root, subdirs, files in os.walk(base_dir):
+            for file in files:
+                stat = os.stat(os.path.join(root, file))
+                if (stat.st_dev, stat.st_ino) in seen:
+                    continue
+                seen.add((stat.st_dev, stat.st_ino))
+                disk += stat.st_blocks * 512
+                distinct += stat.st_size
+    return disk, distinct
+
+def _mb(value):
+    return f"{value / 1024 / 1024:.2f} MB"
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--modules', type=int, default=20)
+    parser.add_argument('--versions', type=int, default=20)
+    parser.add_argument('--files', type=int, default=20)
+    parser.add_argument('--file-size', type=int, default=8192)
+    parser.add_argument('--churn', type=float, default=0.2, help="fraction of files changed by each new version")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        generate_tree(os.path.join(tmp, 'c_cpp_modules'), args.modules, args.versions, args.files, args.file_size, churn=args.churn)
+        # the registry modules resolve c_cpp_modules and the blob store relative to the working directory
+        os.environ.setdefault("CUL_BLOB_DIR", os.path.join(tmp, 'blob_store'))
+        os.environ.setdefault("CUL_INDEX_REFRESH_SECONDS", "0")
+        os.chdir(tmp)
+        from migrate_blob_store import migrate
+
+        disk_before, cache_before = _usage('c_cpp_modules')
+        start = time.perf_counter()
+        totals = migrate()
+        elapsed = time.perf_counter() - start
+        disk_after, cache_after = _usage('c_cpp_modules', os.environ["CUL_BLOB_DIR"])
+
+    print(f"{args.modules} modules x {args.versions} versions x {args.files} files of {args.file_size} bytes, churn {args.churn}")
+    print(f"migration: {totals['files']} files in {elapsed:.2f} s, {totals['new_blobs']} distinct blobs")
+    print(f"{'':<20}{'before':>14}{'after':>14}{'saved':>10}")
+    print(f"{'disk usage':<20}{_mb(disk_before):>14}{_mb(disk_after):>14}{1 - disk_after / disk_before:>10.1%}")
+    print(f"{'page cache bytes':<20}{_mb(cache_before):>14}{_mb(cache_after):>14}{1 - cache_after / cache_before:>10.1%}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+'''
+Compares the compression modes archives can be served with: bytes sent versus server CPU time per request, for small, medium and large synthetic modules. "precompressed" pays the deflate cost once when the artifact is built, the per-request cost is only reading it from disk.
+
+Usage: python -m benchmarks.bench_compression [--repeat N]
+'''
+
+import os
+import time
+import argparse
+import tempfile
+
+import artifact_cache
+from compression import parse_compression, PRECOMPRESSED
+from zip_stream import stream_directory_zip
+from benchmarks.synthetic import generate_tree
+
+SIZES = [
+    ("small", 5, 2 * 1024),
+    ("medium", 50, 16 * 1024),
+    ("large", 200, 64 * 1024),
+]
+MODES = ["stored", "deflate:1", "deflate:6", "deflate:9"]
+
+def _cpu(produce, repeat):
+    best = None
+    total = 0
+    for _ in range(repeat):
+        start = time.process_time()
+        total = sum(len(chunk) for chunk in produce())
+        elapsed = time.process_time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, total
+
+def _read_artifact(path):
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(64 * 1024), b''):
+            yield chunk
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        artifact_cache.CACHE_DIR = os.path.join(tmp, 'artifact_cache')
+        print(f"{'module':<8}{'mode':<16}{'bytes':>12}{'ratio':>8}{'cpu ms/request':>16}{'build cpu ms':>14}")
+        for label, files, file_size in SIZES:
+            base_dir = os.path.join(tmp, label)
+            generate_tree(base_dir, modules=1, versions=1, files=files, file_size=file_size)
+            module_dir = os.path.join(base_dir, 'bench_module_0', '1.0.0')
+            stored_size = None
+            for value in MODES:
+                mode = parse_compression(value)
+                cpu, size = _cpu(lambda: stream_directory_zip(module_dir, mode.compress_type, mode.level), args.repeat)
+                stored_size = stored_size or size
+                print(f"{label:<8}{mode.name:<16}{size:>12}{size / stored_size:>8.2f}{cpu * 1000:>16.2f}{'-':>14}")
+
+            start = time.process_time()
+            path = artifact_cache.get_artifact(label, '1.0.0', module_dir, compression=PRECOMPRESSED)
+            build = time.process_time() - start
+            cpu, size = _cpu(lambda: _read_artifact(path), args.repeat)
+            print(f"{label:<8}{PRECOMPRESSED.name:<16}{size:>12}{size / stored_size:>8.2f}{cpu * 1000:>16.2f}{build * 1000:>14.2f}")
+
+if __name__ == '__main__':
+    main()
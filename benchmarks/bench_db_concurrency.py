@@ -0,0 +1,105 @@
+'''
+Measures reader throughput while writes happen, with SQLite's defaults (rollback journal) versus the settings applied by db_config (WAL, busy_timeout, synchronous=NORMAL, pooled connections). Reader threads run the queries of a profile view (the user and their modules) while a writer thread keeps adding and removing modules like uploads and deletes do.
+
+Usage: python -m benchmarks.bench_db_concurrency [--readers N] [--seconds S] [--modules N]
+'''
+
+import os
+import time
+import argparse
+import tempfile
+import threading
+from sqlalchemy import create_engine, event, select, insert, delete
+from sqlalchemy.exc import OperationalError
+
+import db_config
+from database import db
+from models import User, Module
+
+USERS = 1000
+
+def _engine(path, tuned):
+    url = f"sqlite:///{path}"
+    if not tuned:
+        return create_engine(url, connect_args={"check_same_thread": False})
+    engine = create_engine(url, **db_config.engine_options(url))
+    event.listen(engine, "connect", db_config.set_sqlite_pragmas)
+    return engine
+
+def _seed(engine, modules):
+    db.metadata.create_all(engine)
+    with engine.begin() as conn:
+        conn.execute(insert(User.__table__), [{"email": f"user{u}@bench", "password": "x", "first_name": "bench", "username": f"user{u}"} for u in range(USERS)])
+        conn.execute(insert(Module.__table__), [{"module_name": f"module_{m}", "module_url": "x", "associated_user": f"user{m % USERS}@bench"} for m in range(modules)])
+
+def _percentile(values, percent):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))] if values else 0
+
+def _run(engine, readers, seconds):
+    stop = threading.Event()
+    latencies = []
+    counts = {"reads": 0, "read_errors": 0, "writes": 0, "write_errors": 0}
+    lock = threading.Lock()
+
+    def reader(index):
+        email = f"user{index % USERS}@bench"
+        own = []
+        while not stop.is_set():
+            start = time.perf_counter()
+            try:
+                with engine.connect() as conn:
+                    conn.execute(select(User.__table__).where(User.__table__.c.email == email)).first()
+                    conn.execute(select(Module.__table__.c.module_name).where(Module.__table__.c.associated_user == email)).all()
+                own.append(time.perf_counter() - start)
+            except OperationalError:
+                with lock:
+                    counts["read_errors"] += 1
+        with lock:
+            counts["reads"] += len(own)
+            latencies.extend(own)
+
+    def writer():
+        n = 0
+        while not stop.is_set():
+            name = f"uploaded_{n}"
+            try:
+                with engine.begin() as conn:
+                    conn.execute(insert(Module.__table__).values(module_name=name, module_url="x", associated_user="user0@bench"))
+                with engine.begin() as conn:
+                    conn.execute(delete(Module.__table__).where(Module.__table__.c.module_name == name))
+                counts["writes"] += 2
+            except OperationalError:
+                counts["write_errors"] += 1
+            n += 1
+
+    threads = [threading.Thread(target=reader, args=(i,)) for i in range(readers)] + [threading.Thread(target=writer)]
+    for thread in threads:
+        thread.start()
+    time.sleep(seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    return counts, latencies
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--readers', type=int, default=8)
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--modules', type=int, default=10000)
+    args = parser.parse_args()
+
+    print(f"{'settings':<10}{'reads/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'writes/s':>10}{'errors':>8}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for label, tuned in (("default", False), ("tuned", True)):
+            engine = _engine(os.path.join(tmp, f"{label}.db"), tuned)
+            _seed(engine, args.modules)
+            counts, latencies = _run(engine, args.readers, args.seconds)
+            engine.dispose()
+            errors = counts["read_errors"] + counts["write_errors"]
+            print(f"{label:<10}{counts['reads'] / args.seconds:>10.0f}{_percentile(latencies, 50) * 1000:>10.2f}"
+                  f"{_percentile(latencies, 95) * 1000:>10.2f}{_percentile(latencies, 99) * 1000:>10.2f}"
+                  f"{counts['writes'] / args.seconds:>10.0f}{errors:>8}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,203 @@
+'''
+Load test of the registry HTTP endpoints. A synthetic c_cpp_modules tree is generated in a temporary directory, the Flask app is driven through its test client and through a local threaded WSGI server, and throughput plus p50/p95/p99 latency are reported for every endpoint. Results are written as JSON (by default to benchmarks/results/<commit>.json) so that runs of different commits can be compared with --compare.
+
+Usage: python -m benchmarks.bench_endpoints [--modules N] [--versions N] [--files N] [--file-size BYTES]
+                                            [--requests N] [--concurrency N] [--driver test_client|wsgi|both]
+                                            [--output PATH] [--compare PATH]
+'''
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import threading
+import subprocess
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from benchmarks.synthetic import generate_tree
+
+def _commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+def _percentile(sorted_values, percent):
+    if not sorted_values:
+        return None
+    index = max(0, min(len(sorted_values) - 1, int(round(percent / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+def _summary(latencies, wall):
+    latencies = sorted(latencies)
+    return {
+        "requests": len(latencies),
+        "throughput_rps": round(len(latencies) / wall, 2) if wall else None,
+        "p50_ms": round(_percentile(latencies, 50) * 1000, 3),
+        "p95_ms": round(_percentile(latencies, 95) * 1000, 3),
+        "p99_ms": round(_percentile(latencies, 99) * 1000, 3),
+    }
+
+def _seed_database(app, module_names):
+    '''
+    Adds the bench user and the synthetic modules to the benchmark database and imports their metadata, like an upgraded deployment after running import_modules.py.
+    '''
+    from database import db
+    from models import User, Module
+    from metadata_store import import_tree
+    from db_config import create_schema
+    create_schema(app)
+    with app.app_context():
+        if User.query.get('bench@bench.bench') is None:
+            db.session.add(User(email='bench@bench.bench', password='x', first_name='bench', username='bench'))
+        existing = {name for name, in db.session.query(Module.module_name)}
+        db.session.add_all(Module(module_name=name, module_url='x', associated_user='bench@bench.bench') for name in module_names if name not in existing)
+        db.session.commit()
+        import_tree()
+
+def _scenarios(module_names, versions):
+    '''
+    Returns the requests of every benchmarked endpoint as (endpoint, method, url builder, form data) tuples.
+    '''
+    rng = random.Random(1)
+    pick = lambda: rng.choice(module_names)
+    version = lambda: f"1.0.{rng.randrange(versions)}"
+    return [
+        ("/files", "GET", lambda: f"/files/{pick()}/{version()}", None),
+        ("/versions", "GET", lambda: f"/versions/{pick()}", None),
+        ("/latest_version", "GET", lambda: f"/latest_version/{pick()}", None),
+        ("/modules", "GET", lambda: "/modules", None),
+        ("/info", "GET", lambda: f"/info/{pick()}/{version()}", None),
+        ("/main_page (search)", "POST", lambda: "/main_page", lambda: {"module_name": pick()[:-1]}),
+    ]
+
+def _run_test_client(app, scenarios, requests):
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['email'] = 'bench@bench.bench'
+    results = {}
+    for endpoint, method, url, form in scenarios:
+        latencies = []
+        wall_start = time.perf_counter()
+        for _ in range(requests):
+            start = time.perf_counter()
+            response = client.open(url(), method=method, data=form() if form else None)
+            response.get_data()
+            latencies.append(time.perf_counter() - start)
+            if response.status_code >= 400:
+                raise RuntimeError(f"{endpoint} returned {response.status_code}")
+        results[endpoint] = _summary(latencies, time.perf_counter() - wall_start)
+    return results
+
+def _run_wsgi(app, scenarios, requests, concurrency):
+    from werkzeug.serving import make_server, WSGIRequestHandler
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_request(self, *args, **kwargs):
+            pass
+
+    server = make_server('127.0.0.1', 0, app, threaded=True, request_handler=QuietHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_port}"
+    cookie = app.session_interface.get_signing_serializer(app).dumps({'email': 'bench@bench.bench'})
+    headers = {"Cookie": f"{app.config['SESSION_COOKIE_NAME']}={cookie}"}
+
+    def fetch(method, path, data):
+        body = urllib.parse.urlencode(data).encode() if data else None
+        request = urllib.request.Request(base_url + path, data=body, method=method, headers=headers)
+        start = time.perf_counter()
+        with urllib.request.urlopen(request) as response:
+            response.read()
+        return time.perf_counter() - start
+
+    results = {}
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for endpoint, method, url, form in scenarios:
+                calls = [(method, url(), form() if form else None) for _ in range(requests)]
+                wall_start = time.perf_counter()
+                latencies = list(executor.map(lambda call: fetch(*call), calls))
+                results[endpoint] = _summary(latencies, time.perf_counter() - wall_start)
+    finally:
+        server.shutdown()
+    return results
+
+def _print(results):
+    for driver, endpoints in results.items():
+        print(f"\n[{driver}]")
+        print(f"{'endpoint':<22}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+        for endpoint, stats in endpoints.items():
+            print(f"{endpoint:<22}{stats['throughput_rps']:>10}{stats['p50_ms']:>10}{stats['p95_ms']:>10}{stats['p99_ms']:>10}")
+
+def _compare(baseline_path, results):
+    with open(baseline_path, 'r') as file:
+        baseline = json.load(file)
+    print(f"\nCompared to {baseline_path} (commit {baseline.get('commit')}), negative is faster:")
+    print(f"{'driver':<12}{'endpoint':<22}{'p50':>10}{'p95':>10}{'req/s':>10}")
+    for driver, endpoints in results.items():
+        for endpoint, stats in endpoints.items():
+            old = baseline.get('results', {}).get(driver, {}).get(endpoint)
+            if not old:
+                continue
+            change = lambda key: f"{(stats[key] - old[key]) / old[key] * 100:+.1f}%" if old[key] else "n/a"
+            print(f"{driver:<12}{endpoint:<22}{change('p50_ms'):>10}{change('p95_ms'):>10}{change('throughput_rps'):>10}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--modules', type=int, default=200)
+    parser.add_argument('--versions', type=int, default=3)
+    parser.add_argument('--files', type=int, default=10)
+    parser.add_argument('--file-size', type=int, default=8192)
+    parser.add_argument('--requests', type=int, default=200, help="requests per endpoint and driver")
+    parser.add_argument('--concurrency', type=int, default=8, help="client threads used against the WSGI server")
+    parser.add_argument('--driver', choices=['test_client', 'wsgi', 'both'], default='both')
+    parser.add_argument('--output', help="where to write the JSON results, defaults to benchmarks/results/<commit>.json")
+    parser.add_argument('--compare', help="JSON results of a previous run to compare against")
+    args = parser.parse_args()
+
+    commit = _commit()
+    output = os.path.abspath(args.output or os.path.join(REPO_DIR, 'benchmarks', 'results', f"{commit}.json"))
+    compare = os.path.abspath(args.compare) if args.compare else None
+
+    with tempfile.TemporaryDirectory() as tmp:
+        module_names = generate_tree(os.path.join(tmp, 'c_cpp_modules'), args.modules, args.versions, args.files, args.file_size)
+        # every module resolves c_cpp_modules relative to the working directory
+        os.environ.setdefault("CUL_ARTIFACT_CACHE_DIR", os.path.join(tmp, 'artifact_cache'))
+        os.environ.setdefault("CUL_DATABASE_URL", f"sqlite:///{os.path.join(tmp, 'bench.db')}")
+        os.chdir(tmp)
+        from app import app
+        _seed_database(app, module_names)
+
+        scenarios = _scenarios(module_names, args.versions)
+        results = {}
+        if args.driver in ('test_client', 'both'):
+            results['test_client'] = _run_test_client(app, scenarios, args.requests)
+        if args.driver in ('wsgi', 'both'):
+            results['wsgi'] = _run_wsgi(app, scenarios, args.requests, args.concurrency)
+
+    report = {
+        "commit": commit,
+        "timestamp": time.strftime('%Y-%m-%dT%H:%M:%S'),
+        "python": sys.version.split()[0],
+        "params": {k: v for k, v in vars(args).items() if k not in ('output', 'compare')},
+        "results": results,
+    }
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, 'w') as file:
+        json.dump(report, file, indent=4)
+
+    _print(results)
+    print(f"\nResults written to {output}")
+    if compare:
+        _compare(compare, results)
+
+if __name__ == '__main__':
+    main()
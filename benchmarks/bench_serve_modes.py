@@ -0,0 +1,77 @@
+'''
+Compares the ways a module version can be served as a zip archive: the old in-memory BytesIO archive, the artifact cache (cold and warm) and the streaming writer. Reports total time, time to first byte and peak Python memory for each.
+
+Usage: python -m benchmarks.bench_serve_modes [--files N] [--file-size BYTES] [--repeat N]
+'''
+
+import os
+import io
+import time
+import zipfile
+import argparse
+import tempfile
+import tracemalloc
+
+import artifact_cache
+from zip_stream import stream_directory_zip
+from benchmarks.synthetic import generate_tree
+
+def _in_memory(module_dir):
+    zip_stream = io.BytesIO()
+    with zipfile.ZipFile(zip_stream, 'w') as zipf:
+        for root, dirs, files in os.walk(module_dir):
+            for file in files:
+                file_path = os.path.join(root, file)
+                zipf.write(file_path, os.path.relpath(file_path, module_dir))
+    yield zip_stream.getvalue()
+
+def _cached(module_dir):
+    path = artifact_cache.get_artifact("bench_module_0", "1.0.0", module_dir)
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(64 * 1024), b''):
+            yield chunk
+
+def _measure(produce, module_dir):
+    tracemalloc.start()
+    start = time.perf_counter()
+    first_byte = None
+    total = 0
+    for chunk in produce(module_dir):
+        if first_byte is None:
+            first_byte = time.perf_counter() - start
+        total += len(chunk)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, first_byte, peak, total
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--files', type=int, default=50)
+    parser.add_argument('--file-size', type=int, default=1024 * 1024)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        base_dir = os.path.join(tmp, 'c_cpp_modules')
+        generate_tree(base_dir, modules=1, versions=1, files=args.files, file_size=args.file_size)
+        module_dir = os.path.join(base_dir, 'bench_module_0', '1.0.0')
+        artifact_cache.CACHE_DIR = os.path.join(tmp, 'artifact_cache')
+
+        modes = [
+            ("in-memory", _in_memory),
+            ("cache (cold)", _cached),
+            ("cache (warm)", _cached),
+            ("stream", stream_directory_zip),
+        ]
+        print(f"{args.files} files x {args.file_size} bytes")
+        print(f"{'mode':<14}{'total ms':>12}{'ttfb ms':>12}{'peak MiB':>12}{'bytes':>14}")
+        for name, produce in modes:
+            runs = []
+            for _ in range(1 if name == "cache (cold)" else args.repeat):
+                runs.append(_measure(produce, module_dir))
+            elapsed, first_byte, peak, total = min(runs)
+            print(f"{name:<14}{elapsed * 1000:>12.1f}{first_byte * 1000:>12.2f}{peak / 2**20:>12.2f}{total:>14}")
+
+if __name__ == '__main__':
+    main()
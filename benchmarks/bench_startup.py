@@ -0,0 +1,83 @@
+'''
+Measures the startup of a multi-worker deployment on a synthetic registry: the time of every startup phase of wsgi.py, and the memory of forked workers when the metadata is preloaded once in the parent (gunicorn --preload) versus loaded by every worker after the fork. Memory is the private (not shared) memory of each worker from /proc/<pid>/smaps_rollup, so this benchmark needs Linux.
+
+Usage: python -m benchmarks.bench_startup [--modules N] [--versions N] [--workers N]
+'''
+
+import os
+import sys
+import argparse
+import tempfile
+import subprocess
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from benchmarks.synthetic import generate_tree
+
+# runs in a fresh interpreter per mode, so that the two modes do not share imports or loaded data
+WORKER_SCRIPT = '''
+import os, sys, time
+preload = sys.argv[1] == "preload"
+workers = int(sys.argv[2])
+
+def private_kb():
+    with open("/proc/self/smaps_rollup") as file:
+        return sum(int(line.split()[1]) for line in file if line.startswith(("Private_Clean", "Private_Dirty")))
+
+start = time.perf_counter()
+if preload:
+    import wsgi
+    app = wsgi.app
+else:
+    from app import app
+parent_seconds = time.perf_counter() - start
+
+pipes = []
+for _ in range(workers):
+    read_fd, write_fd = os.pipe()
+    if os.fork() == 0:
+        os.close(read_fd)
+        worker_start = time.perf_counter()
+        if not preload:
+            from startup import preload as load
+            load(app)
+        # the first search of a worker, after it every worker has the index it needs
+        app.test_client().get("/search?q=bench_module")
+        os.write(write_fd, f"{private_kb()} {time.perf_counter() - worker_start}".encode())
+        os._exit(0)
+    os.close(write_fd)
+    pipes.append(read_fd)
+results = [os.read(fd, 100).decode().split() for fd in pipes]
+for _ in range(workers):
+    os.wait()
+print(parent_seconds, sum(int(kb) for kb, seconds in results), max(float(seconds) for kb, seconds in results))
+'''
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--modules', type=int, default=3000)
+    parser.add_argument('--versions', type=int, default=3)
+    parser.add_argument('--workers', type=int, default=4)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        generate_tree(os.path.join(tmp, 'c_cpp_modules'), args.modules, args.versions, 1, 256)
+        env = dict(os.environ, PYTHONPATH=REPO_DIR, CUL_DATABASE_URL=f"sqlite:///{os.path.join(tmp, 'bench.db')}",
+                   CUL_ARTIFACT_CACHE_DIR=os.path.join(tmp, 'artifact_cache'), CUL_INDEX_REFRESH_SECONDS="0")
+        # create the schema once, outside of the measured runs
+        subprocess.run([sys.executable, '-c', 'from app import app; from db_config import create_schema; create_schema(app)'],
+                       cwd=tmp, env=env, check=True)
+
+        output = subprocess.run([sys.executable, '-c', 'import wsgi'], cwd=tmp, env=env, check=True, capture_output=True, text=True).stdout
+        print(output.strip().splitlines()[-1])
+
+        print(f"\n{'mode':<14}{'parent s':>10}{'slowest worker s':>18}{'private MB, all workers':>26}")
+        for mode in ('per-worker', 'preload'):
+            output = subprocess.run([sys.executable, '-c', WORKER_SCRIPT, 'preload' if mode == 'preload' else 'lazy', str(args.workers)],
+                                    cwd=tmp, env=env, check=True, capture_output=True, text=True).stdout
+            parent_seconds, private_kb, worker_seconds = output.strip().splitlines()[-1].split()
+            print(f"{mode:<14}{float(parent_seconds):>10.2f}{float(worker_seconds):>18.2f}{int(private_kb) / 1024:>26.1f}")
+
+if __name__ == '__main__':
+    main()
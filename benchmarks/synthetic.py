@@ -0,0 +1,77 @@
+'''
+This file generates synthetic c_cpp_modules trees for the benchmarks. The layout matches the real registry: one directory per module with a versions.json file and one directory per version containing module_info.json and source files.
+'''
+
+import os
+import json
+import random
+
+def generate_tree(base_dir, modules=10, versions=3, files=5, file_size=4096, seed=0, churn=1.0):
+    '''
+    Writes a synthetic registry tree into base_dir. File contents look like C source so that compression ratios are realistic.
+
+    Args:
+        base_dir: The directory to create the modules in (the equivalent of c_cpp_modules)
+        modules: The number of modules
+        versions: The number of versions per module
+        files: The number of source files per version
+        file_size: The approximate size of each source file in bytes
+        seed: The seed of the random generator, the same seed always produces the same tree
+        churn: The fraction of source files that change from one version to the next, the others are copied unchanged
+
+    Returns:
+        module names: the list of generated module names
+
+    Raises:
+        OSError: If the tree cannot be written
+    '''
+    rng = random.Random(seed)
+    words = ["int", "return", "static", "const", "char", "void", "for", "while", "if", "else", "size_t", "buffer", "count", "index", "value"]
+    module_names = []
+    for m in range(modules):
+        module_name = f"bench_module_{m}"
+        module_names.append(module_name)
+        version_entries = []
+        requires = {}
+        for v in range(versions):
+            version = f"1.0.{v}"
+            version_dir = os.path.join(base_dir, module_name, version)
+            os.makedirs(version_dir, exist_ok=True)
+            deps = [f"bench_module_{m - 1}==1.0.{v}"] if m > 0 else []
+            requires[version] = deps
+            for f in range(files):
+                if v > 0 and churn < 1 and rng.random() >= churn:
+                    previous = os.path.join(base_dir, module_name, f"1.0.{v - 1}", f"file_{f}.c")
+                    with open(previous, 'r') as source, open(os.path.join(version_dir, f"file_{f}.c"), 'w') as file:
+                        file.write(source.read())
+                    continue
+                lines = []
+                length = 0
+                while length < file_size:
+                    line = " ".join(rng.choice(words) for _ in range(8)) + ";\n"
+                    lines.append(line)
+                    length += len(line)
+                with open(os.path.join(version_dir, f"file_{f}.c"), 'w') as file:
+                    file.write("".join(lines)[:file_size])
+            module_info = {
+                "name": module_name,
+                "version": version,
+                "description": f"Synthetic module {m}",
+                "author": "bench",
+                "license": "MIT",
+                "keywords": ["bench"],
+                "main": "file_0.c",
+                "requires": deps,
+            }
+            with open(os.path.join(version_dir, 'module_info.json'), 'w') as file:
+                json.dump(module_info, file, indent=4)
+            version_entries.append({"version": version, "path": f"{module_name}/{version}"})
+        versions_data = {
+            "versions": version_entries,
+            "latest": version_entries[-1]["version"],
+            "latest_path": version_entries[-1]["path"],
+            "requires": requires,
+        }
+        with open(os.path.join(base_dir, module_name, 'versions.json'), 'w') as file:
+            json.dump(versions_data, file, indent=4)
+    return module_names
@@ -0,0 +1,264 @@
+'''
+This file contains the content-addressed blob store. File contents are stored once under the sha256 of their contents and their executable bit, and every version is described by a manifest listing its files with their size, hash and modification time. The files of a stored version directory are replaced by hard links to their blobs, so identical files of different versions (or modules) share one copy on disk and in the page cache, while git, the registry index and the archive builders keep seeing the usual c_cpp_modules layout.
+
+A blob and the version files linked to it are one inode and share its mode, so a file is only linked to a blob with the same permissions (a link would otherwise change the mode of the file, its tree hash and its git status), and writing to such a file in place also changes the blob. Blobs are therefore never trusted blindly: a manifest entry is only used while its version file still has the recorded size and modification time, and an existing blob is hashed again before another file is linked to it.
+
+Backends (CUL_STORAGE_BACKEND):
+    filesystem: files and manifests are read from the version directories, hashing them on demand (default)
+    blobs: versions are stored in the blob store when they are uploaded or updated, manifests and single files are read from it
+'''
+
+import os
+import json
+import stat
+import shutil
+import hashlib
+import threading
+from artifact_cache import get_manifest
+import registry_index
+
+BASE_DIR = "c_cpp_modules"
+BLOB_DIR = os.environ.get("CUL_BLOB_DIR", "blob_store")
+STORAGE_BACKEND = os.environ.get("CUL_STORAGE_BACKEND", "filesystem")
+if STORAGE_BACKEND not in ("filesystem", "blobs"):
+    raise ValueError("CUL_STORAGE_BACKEND must be 'filesystem' or 'blobs'.")
+
+_lock = threading.Lock()
+_manifests = {}  # manifest path -> (mtime, parsed manifest)
+
+def blob_path(digest, executable):
+    '''
+    Returns the path of the blob holding the contents with the given sha256 hex digest, e.g. objects/ab/cdef... for a regular file and objects/ab/cdef....x for an executable one.
+    '''
+    return os.path.join(BLOB_DIR, 'objects', digest[:2], digest[2:] + ('.x' if executable else ''))
+
+def _manifest_path(module_name, version):
+    return os.path.join(BLOB_DIR, 'manifests', module_name, f"{version}.json")
+
+def _tmp_name(path):
+    return f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+def _link(source, target):
+    '''
+    Atomically replaces target with a hard link to source. Returns False if the file system does not allow it (e.g. the blob store is on another device), target is left untouched then.
+    '''
+    tmp_path = _tmp_name(target)
+    try:
+        os.link(source, tmp_path)
+    except OSError:
+        return False
+    try:
+        os.replace(tmp_path, target)
+    except OSError:
+        os.remove(tmp_path)
+        return False
+    return True
+
+def _hash_file(path):
+    file_hash = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(65536), b''):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+def _is_executable(st_mode):
+    return bool(st_mode & 0o111)
+
+def put_file(file_path, digest, executable):
+    '''
+    Stores the contents of a file in the blob store. The file is hard linked into the store when possible and copied otherwise. An existing blob with the same digest and executable bit is hashed again first, and replaced by the file if it was modified or chmod'ed in place through one of its links. Blobs keep the mode of the file, a linked blob shares its inode with the version file and a chmod would change the working tree too.
+
+    Args:
+        file_path: The path of the file
+        digest: The sha256 hex digest of its contents
+        executable: Whether any execute bit of the file is set
+
+    Returns:
+        stored: True if a new blob was created or a modified one replaced
+
+    Raises:
+        OSError: If the file cannot be read or the blob cannot be written
+    '''
+    path = blob_path(digest, executable)
+    if os.path.exists(path) and (os.path.samefile(path, file_path) or
+                                 (_is_executable(os.stat(path).st_mode) == executable and _hash_file(path) == digest)):
+        return False
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if not _link(file_path, path):
+        tmp_path = _tmp_name(path)
+        try:
+            shutil.copy2(file_path, tmp_path)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    return True
+
+def store_version(module_name, version):
+    '''
+    Stores every file of a version directory in the blob store, replaces the files with hard links to blobs of the same permissions and writes the manifest of the version. The mode of every file is left as it is.
+
+    Args:
+        module_name: The name of the module
+        version: The version of the module
+
+    Returns:
+        stats: a dictionary with the number of files and bytes of the version, the new blobs and bytes added to the store, and the files that now share a blob
+
+    Raises:
+        OSError: If a file cannot be read or written
+    '''
+    module_dir = os.path.join(BASE_DIR, module_name, version)
+    tree_hash, files = get_manifest(module_dir)
+    stats = {"files": 0, "bytes": 0, "new_blobs": 0, "new_bytes": 0, "linked": 0}
+    entries = []
+    for rel_path, (size, digest, executable) in files.items():
+        file_path = os.path.join(module_dir, rel_path)
+        stats["files"] += 1
+        stats["bytes"] += size
+        if put_file(file_path, digest, executable):
+            stats["new_blobs"] += 1
+            stats["new_bytes"] += size
+        path = blob_path(digest, executable)
+        if os.path.samefile(path, file_path) or (
+                stat.S_IMODE(os.stat(path).st_mode) == stat.S_IMODE(os.stat(file_path).st_mode) and _link(path, file_path)):
+            stats["linked"] += 1
+        entries.append({"path": rel_path, "size": size, "sha256": digest, "executable": executable,
+                        "mtime_ns": os.stat(file_path).st_mtime_ns})
+
+    manifest = {
+        "module": module_name,
+        "version": version,
+        "tree_hash": tree_hash,
+        "files": entries,
+    }
+    manifest_path = _manifest_path(module_name, version)
+    os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+    tmp_path = _tmp_name(manifest_path)
+    with open(tmp_path, 'w') as file:
+        json.dump(manifest, file)
+    os.replace(tmp_path, manifest_path)
+    return stats
+
+def store_module(module_name):
+    '''
+    Stores every version of a module and removes the manifests of versions that no longer exist. Called after a module is uploaded or updated when the blobs backend is used.
+
+    Args:
+        module_name: The name of the module
+
+    Returns:
+        stats: the per-version stats of store_version, summed
+
+    Raises:
+        OSError: If a file cannot be read or written
+        json.JSONDecodeError: If the versions.json file could not be decoded
+    '''
+    totals = {"files": 0, "bytes": 0, "new_blobs": 0, "new_bytes": 0, "linked": 0}
+    versions = []
+    for item in (registry_index.get_versions_data(module_name) or {}).get('versions', []):
+        version = item.get('version')
+        if registry_index.version_exists(module_name, version):
+            versions.append(version)
+            for key, value in store_version(module_name, version).items():
+                totals[key] += value
+    manifest_dir = os.path.join(BLOB_DIR, 'manifests', module_name)
+    if os.path.isdir(manifest_dir):
+        for file in os.listdir(manifest_dir):
+            if file.endswith('.json') and file[:-5] not in versions:
+                os.remove(os.path.join(manifest_dir, file))
+    return totals
+
+def remove_module(module_name):
+    '''
+    Removes the manifests of a deleted module. Its blobs are reclaimed by collect_garbage once no other version uses them.
+    '''
+    shutil.rmtree(os.path.join(BLOB_DIR, 'manifests', module_name), ignore_errors=True)
+
+def read_manifest(module_name, version):
+    '''
+    Returns the stored manifest of a version, re-reading the file only when it changed.
+
+    Args:
+        module_name: The name of the module
+        version: The version of the module
+
+    Returns:
+        manifest: {"module", "version", "tree_hash", "files": [{"path", "size", "sha256", "executable", "mtime_ns"}]}, or None if the version is not stored
+
+    Raises:
+        None
+    '''
+    path = _manifest_path(module_name, version)
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+    cached = _manifests.get(path)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    try:
+        with open(path, 'r') as file:
+            manifest = json.load(file)
+    except (OSError, json.JSONDecodeError) as e:
+        print(f"Error reading the manifest of '{module_name}' version {version}: {e}")
+        return None
+    with _lock:
+        _manifests[path] = (mtime, manifest)
+    return manifest
+
+def is_current(module_name, version, item):
+    '''
+    Returns True if the version file of a manifest entry still has the size, modification time and executable bit recorded when the version was stored, i.e. neither the file nor the blob it is linked to was written, replaced or chmod'ed since. Costs a single stat.
+
+    Args:
+        module_name: The name of the module
+        version: The version of the module
+        item: A {"path", "size", "sha256", "executable", "mtime_ns"} entry of the manifest of the version
+
+    Returns:
+        current: False if the entry can no longer be trusted, the version directory has to be read instead
+
+    Raises:
+        None
+    '''
+    try:
+        file_stat = os.stat(os.path.join(BASE_DIR, module_name, version, *item['path'].split('/')))
+    except OSError:
+        return False
+    return (file_stat.st_size == item['size'] and file_stat.st_mtime_ns == item.get('mtime_ns')
+            and _is_executable(file_stat.st_mode) == item.get('executable'))
+
+def collect_garbage():
+    '''
+    Deletes the blobs that no manifest refers to anymore.
+
+    Args:
+        None
+
+    Returns:
+        removed: a (blob count, bytes) tuple
+
+    Raises:
+        None
+    '''
+    referenced = set()
+    manifests_dir = os.path.join(BLOB_DIR, 'manifests')
+    for root, dirs, files in os.walk(manifests_dir):
+        for file in files:
+            try:
+                with open(os.path.join(root, file), 'r') as manifest_file:
+                    referenced.update(blob_path(item['sha256'], item['executable']) for item in json.load(manifest_file)['files'])
+            except (OSError, ValueError, KeyError) as e:
+                # an unreadable manifest could refer to any blob, keep everything
+                print(f"Not collecting garbage, cannot read manifest '{file}': {e}")
+                return 0, 0
+    count, size = 0, 0
+    for root, dirs, files in os.walk(os.path.join(BLOB_DIR, 'objects')):
+        for file in files:
+            path = os.path.join(root, file)
+            if path not in referenced and not file.endswith('.tmp'):
+                size += os.path.getsize(path)
+                os.remove(path)
+                count += 1
+    return count, size
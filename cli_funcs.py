@@ -1,11 +1,18 @@
-import os
 import json
-import io
-from database import db
-from models import Module
-from flask import jsonify
+from flask import jsonify, request, Response
+import registry_index
+from http_cache import not_modified, add_validators
+from module_search import search_modules, SEARCH_LIMIT
+from version_utils import parse_requirement, best_match
+from dependency_resolver import resolve, select_version, ResolutionError
+from serve_files_cli import send_combined_zip
+from ingestion import get_job
+import mirror
+from module_listing import get_listing
+from auth import current_user_email, list_tokens
 
 BASE_DIR = "c_cpp_modules"
+MAX_BATCH_SIZE = 500
 
 def get_latest_version_cli(module_name):
     '''
@@ -22,62 +29,61 @@ def get_latest_version_cli(module_name):
         json.JSONDecodeError: If an error occurs while decoding the versions.json file
         Exception: If any error occurs
     '''
-    versions_file_path = os.path.join(BASE_DIR, module_name, 'versions.json')
-    
-    # Check if the module directory exists
-    if not os.path.exists(os.path.join(BASE_DIR, module_name)):
+    # Check if the module directory exists, a mirror asks its upstream registries for modules it does not have
+    if not registry_index.module_exists(module_name):
+        if mirror.ENABLED:
+            return mirror.serve('latest_version', module_name)
         return jsonify({"error": f"Module '{module_name}' not found."}), 404
 
-    # Check if the versions.json file exists
-    if not os.path.exists(versions_file_path):
-        return jsonify({"error": "The versions.json file is missing for the specified module."}), 404
+    # Answer conditional requests before the metadata is read
+    etag, last_modified = registry_index.get_validators(module_name)
+    cached_response = not_modified(etag, last_modified)
+    if cached_response:
+        return cached_response
 
     try:
-        with open(versions_file_path, 'r') as file:
-            data = json.load(file)
-            return jsonify({"latest": data.get('latest')})
+        data = registry_index.get_versions_data(module_name)
+        # Check if the versions.json file exists
+        if data is None:
+            return jsonify({"error": "The versions.json file is missing for the specified module."}), 404
+        return add_validators(jsonify({"latest": data.get('latest')}), etag, last_modified)
     except json.JSONDecodeError:
         return jsonify({"error": "Error decoding the versions.json file."}), 500
     except Exception as e:
         print(f"An error occurred: {e}")
         return jsonify({"error": "An error occurred."}), 500
 
-def get_versions_cli(module_name):
+def lookup_module_versions(module_name):
     '''
-    Returns all the versions of the specified module. If the module is not found, returns an error message. If the versions.json file is missing, returns an error message. If any error occurs during the process, returns an error message.
+    Looks up all the versions of the specified module together with the author, description and license of its latest version. This is the lookup shared by the single and batch versions endpoints.
 
     Args:
         module_name: The name of the module
-    
+
     Returns:
-        all versions: if the module is found and the versions.json file exists
-        error message: if the module is not found, the versions.json file is missing, or any error occurs during the process
+        result: a (data, error message, status code) tuple, data is None if an error occurred
 
     Raises:
-        json.JSONDecodeError: If an error occurs while decoding the versions.json file
-        Exception: If any error occurs
+        None
     '''
-    versions_file_path = os.path.join(BASE_DIR, module_name, 'versions.json')
-    latest_version_path = None
-    data = None
     module_info = None
-    data_to_send = None
-    
-    # Check if the module directory exists
-    if not os.path.exists(os.path.join(BASE_DIR, module_name)):
-        return jsonify({"error": f"Module '{module_name}' not found."}), 404
 
-    # Check if the versions.json file exists
-    if not os.path.exists(versions_file_path):
-        return jsonify({"error": "The versions.json file is missing for the specified module."}), 404
+    # Check if the module directory exists
+    if not registry_index.module_exists(module_name):
+        return None, f"Module '{module_name}' not found.", 404
 
     try:
-        with open(versions_file_path, 'r') as file:
-            data = json.load(file)
-            latest_version_path = os.path.join(BASE_DIR, data.get('latest_path'),'module_info.json')
-            
-        with open(latest_version_path, 'r') as file:
-            module_info = json.load(file)
+        data = registry_index.get_versions_data(module_name)
+        # Check if the versions.json file exists
+        if data is None:
+            return None, "The versions.json file is missing for the specified module.", 404
+
+        latest = registry_index.split_path(data.get('latest_path'))
+        if latest:
+            module_info = registry_index.get_module_info(*latest)
+        if module_info is None:
+            print(f"An error occurred: module_info.json of the latest version of '{module_name}' could not be found")
+            return None, "An error occurred.", 500
 
         data_to_send = {
             "all_versions": data,
@@ -85,19 +91,245 @@ def get_versions_cli(module_name):
             "description": module_info.get('description'),
             "license": module_info.get('license'),
         }
-        return jsonify(data_to_send)
+        return data_to_send, None, 200
     except json.JSONDecodeError:
-        return jsonify({"error": "Error decoding the versions.json file."}), 500
+        return None, "Error decoding the versions.json file.", 500
     except Exception as e:
         print(f"An error occurred: {e}")
-        return jsonify({"error": "An error occurred."}), 500
+        return None, "An error occurred.", 500
+
+def get_versions_cli(module_name):
+    '''
+    Returns all the versions of the specified module. If the module is not found, returns an error message. If the versions.json file is missing, returns an error message. If any error occurs during the process, returns an error message.
+
+    Args:
+        module_name: The name of the module
+    
+    Returns:
+        all versions: if the module is found and the versions.json file exists
+        error message: if the module is not found, the versions.json file is missing, or any error occurs during the process
+
+    Raises:
+        None
+    '''
+    # Check if the module directory exists, a mirror asks its upstream registries for modules it does not have
+    if not registry_index.module_exists(module_name):
+        if mirror.ENABLED:
+            return mirror.serve('versions', module_name)
+        return jsonify({"error": f"Module '{module_name}' not found."}), 404
+
+    # Answer conditional requests before the metadata is read
+    etag, last_modified = registry_index.get_validators(module_name)
+    cached_response = not_modified(etag, last_modified)
+    if cached_response:
+        return cached_response
+
+    data_to_send, error, status = lookup_module_versions(module_name)
+    if error:
+        return jsonify({"error": error}), status
+    return add_validators(jsonify(data_to_send), etag, last_modified)
+
+def get_batch_versions_cli():
+    '''
+    Returns the versions of many modules in one response. The request body is a JSON object with a "modules" list of requirement strings, e.g. {"modules": ["test_module_6", "test_module_7>=1.0.1"]}. For every module the response contains the latest version, all versions, author, description and license, plus the highest version satisfying the constraint if one was given. Modules that cannot be looked up get an error entry instead, they do not fail the whole request.
+
+    Args:
+        None
+
+    Returns:
+        modules: a JSON object mapping every requirement to its module data or error
+        error message: if the request body is not a JSON object with a list of requirement strings
+
+    Raises:
+        None
+    '''
+    body = request.get_json(silent=True)
+    requirements = body.get('modules') if isinstance(body, dict) else None
+    if not isinstance(requirements, list) or not all(isinstance(r, str) for r in requirements):
+        return jsonify({"error": "The request body must be a JSON object with a 'modules' list of strings."}), 400
+    if len(requirements) > MAX_BATCH_SIZE:
+        return jsonify({"error": f"At most {MAX_BATCH_SIZE} modules can be requested at once."}), 400
+
+    lookups = {}
+    results = {}
+    for requirement in requirements:
+        try:
+            module_name, operator, version = parse_requirement(requirement)
+        except ValueError as e:
+            results[requirement] = {"error": str(e)}
+            continue
+        if module_name not in lookups:
+            lookups[module_name] = lookup_module_versions(module_name)
+        data, error, status = lookups[module_name]
+        if error:
+            results[requirement] = {"error": error}
+            continue
+        available = [item['version'] for item in data['all_versions'].get('versions', [])]
+        result = {"latest": data['all_versions'].get('latest'), **data}
+        if operator:
+            result["resolved"] = best_match(available, operator, version)
+        results[requirement] = result
+    return jsonify({"modules": results})
 
 def get_module_names_cli():
-    """Fetch all module names from the 'module' table using SQLAlchemy."""
+    '''
+    Returns the names of the modules in the registry. Without query parameters the response is the plain list of every name. With the 'limit', 'cursor' or 'prefix' query parameters the names are paged in alphabetical order: the response is {"modules": [...], "next_cursor": ...} and the next page is requested with cursor=next_cursor until it is null.
+
+    Args:
+        None
+
+    Returns:
+        module names: the list of names, or a page of names
+        error message: if the limit is invalid (400) or the database query failed (500)
+
+    Raises:
+        None
+    '''
+    limit = request.args.get('limit')
+    try:
+        limit = int(limit) if limit is not None else None
+    except ValueError:
+        return jsonify({"error": "The 'limit' query parameter must be an integer."}), 400
     try:
-        modules = Module.query.all()  # Fetch all module records
-        module_list = [m.module_name for m in modules]  # Convert to dicts
-        return jsonify(module_list)  # Return as JSON
+        body, etag = get_listing(request.args.get('cursor'), limit, request.args.get('prefix'))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         print(f"Database error: {e}")
-        return jsonify({"error": "Database query failed"}), 500
\ No newline at end of file
+        return jsonify({"error": "Database query failed"}), 500
+    cached_response = not_modified(etag)
+    if cached_response:
+        return cached_response
+    return add_validators(Response(body, mimetype='application/json'), etag)
+
+def search_modules_cli():
+    '''
+    Returns the modules that fuzzily match the query given in the 'q' query parameter, best match first, together with their versions. The number of results can be limited with the 'limit' query parameter.
+
+    Args:
+        None
+
+    Returns:
+        search results: a list of {"module", "score", "versions"} objects
+        error message: if the query is missing or the limit is not a positive integer
+
+    Raises:
+        None
+    '''
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({"error": "The 'q' query parameter is required."}), 400
+    try:
+        limit = int(request.args.get('limit', SEARCH_LIMIT))
+    except ValueError:
+        limit = 0
+    if limit <= 0:
+        return jsonify({"error": "The 'limit' query parameter must be a positive integer."}), 400
+    return jsonify(search_modules(query, min(limit, SEARCH_LIMIT)))
+
+def resolve_dependencies_cli():
+    '''
+    Resolves the transitive dependencies of a list of requirements in one request. The request body is a JSON object with a "modules" list of requirement strings, e.g. {"modules": ["test_module_5", "test_module_7==1.0.0"]}. If "archive" is true in the body or the 'archive' query parameter is set, a single zip archive of all resolved modules is sent instead of the JSON result.
+
+    Args:
+        None
+
+    Returns:
+        resolved modules: a JSON object with a "resolved" list of {"module", "version"} objects, dependencies first
+        zip file: the combined archive of all resolved modules, if requested
+        error message: if the body is invalid (400), a module or version is missing (404), or the requirements contain a cycle or conflict (409)
+
+    Raises:
+        None
+    '''
+    body = request.get_json(silent=True)
+    requirements = body.get('modules') if isinstance(body, dict) else None
+    if not isinstance(requirements, list) or not all(isinstance(r, str) for r in requirements):
+        return jsonify({"error": "The request body must be a JSON object with a 'modules' list of strings."}), 400
+    if len(requirements) > MAX_BATCH_SIZE:
+        return jsonify({"error": f"At most {MAX_BATCH_SIZE} modules can be requested at once."}), 400
+
+    try:
+        resolved = resolve(requirements)
+    except ResolutionError as e:
+        status = {"not_found": 404, "invalid": 400}.get(e.kind, 409)
+        return jsonify({"error": str(e), "kind": e.kind, "details": e.details}), status
+    except Exception as e:
+        print(f"An error occurred: {e}")
+        return jsonify({"error": "An error occurred."}), 500
+
+    if body.get('archive') or request.args.get('archive') in ('1', 'true'):
+        return send_combined_zip(resolved, "resolved_modules.zip")
+    return jsonify({"resolved": [{"module": module_name, "version": version} for module_name, version in resolved]})
+
+def get_bundle_cli():
+    '''
+    Sends several modules as a single zip archive. The request body is a JSON object with a "modules" list of requirement strings, e.g. {"modules": ["test_module_6==1.0.0", "test_module_7"]}. A bare module name selects the latest version. Unlike /resolve, dependencies are not added to the bundle.
+
+    Args:
+        None
+
+    Returns:
+        zip file: the archive with every requested version stored under <module>/<version>/
+        error message: if the body is invalid (400) or a module or version is missing (404)
+
+    Raises:
+        None
+    '''
+    body = request.get_json(silent=True)
+    requirements = body.get('modules') if isinstance(body, dict) else None
+    if not isinstance(requirements, list) or not requirements or not all(isinstance(r, str) for r in requirements):
+        return jsonify({"error": "The request body must be a JSON object with a non-empty 'modules' list of strings."}), 400
+    if len(requirements) > MAX_BATCH_SIZE:
+        return jsonify({"error": f"At most {MAX_BATCH_SIZE} modules can be requested at once."}), 400
+
+    nodes = []
+    try:
+        for requirement in requirements:
+            node = select_version(requirement)
+            if not registry_index.version_exists(*node):
+                return jsonify({"error": f"Module '{node[0]}' with version {node[1]} not found."}), 404
+            if node not in nodes:
+                nodes.append(node)
+    except ResolutionError as e:
+        status = 404 if e.kind == "not_found" else 400
+        return jsonify({"error": str(e)}), status
+    return send_combined_zip(nodes, "bundle.zip")
+
+def get_job_status_cli(job_id):
+    '''
+    Returns the state of an upload or update job so that the web UI and the CLI can poll it until it has finished.
+
+    Args:
+        job_id: The id of the job
+
+    Returns:
+        job: the job's id, kind, module_name, status (queued, running, succeeded or failed), error, versions and timestamps
+        error message: if there is no such job
+
+    Raises:
+        None
+    '''
+    job = get_job(job_id)
+    if job is None:
+        return jsonify({"error": f"Job '{job_id}' not found."}), 404
+    return jsonify(job)
+
+def get_tokens_cli():
+    '''
+    Returns the API tokens of the authenticated user, without their secret part.
+
+    Args:
+        None
+
+    Returns:
+        tokens: a list of {"token_id", "name", "created"} objects
+        error message: if the request is not authenticated
+
+    Raises:
+        None
+    '''
+    email = current_user_email()
+    if email is None:
+        return jsonify({"error": "Authentication required"}), 401
+    return jsonify(list_tokens(email))
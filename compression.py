@@ -0,0 +1,83 @@
+'''
+This file contains the compression modes module archives can be served with and their negotiation. A deployment picks a default with CUL_COMPRESSION, clients can ask for another mode with the 'compression' (and 'level') query parameters or with an Accept header such as "application/zip; compression=deflate; level=9".
+
+Modes:
+    stored: no compression, cheapest for the server
+    deflate / deflate:N: deflate at level N (0-9), compressed while serving
+    precompressed: deflate at level 9, built once into the artifact cache and served from disk
+'''
+
+import os
+import zipfile
+from collections import namedtuple
+from flask import request
+from werkzeug.http import parse_options_header
+
+DEFAULT_DEFLATE_LEVEL = 6
+
+# name: used in etags and responses, compress_type/level: passed to the zip writers, precompressed: always served from the artifact cache
+CompressionMode = namedtuple('CompressionMode', ['name', 'compress_type', 'level', 'precompressed'])
+
+STORED = CompressionMode('stored', zipfile.ZIP_STORED, None, False)
+PRECOMPRESSED = CompressionMode('precompressed', zipfile.ZIP_DEFLATED, 9, True)
+
+def parse_compression(value, level=None):
+    '''
+    Returns the compression mode described by value.
+
+    Args:
+        value: "stored", "deflate", "deflate:N" or "precompressed"
+        level: The deflate level, overrides the one given in value
+
+    Returns:
+        compression mode: a CompressionMode
+
+    Raises:
+        ValueError: If the mode or level is invalid
+    '''
+    name, _, inline_level = (value or '').strip().lower().partition(':')
+    if name == 'stored':
+        return STORED
+    if name == 'precompressed':
+        return PRECOMPRESSED
+    if name == 'deflate':
+        level = level if level is not None else (inline_level or DEFAULT_DEFLATE_LEVEL)
+        try:
+            level = int(level)
+        except ValueError:
+            level = -1
+        if not 0 <= level <= 9:
+            raise ValueError("The deflate level must be an integer between 0 and 9.")
+        return CompressionMode(f'deflate{level}', zipfile.ZIP_DEFLATED, level, False)
+    raise ValueError(f"Unknown compression '{value}', expected stored, deflate or precompressed.")
+
+DEFAULT_COMPRESSION = parse_compression(os.environ.get("CUL_COMPRESSION", "stored"))
+BUNDLE_COMPRESSION = parse_compression(os.environ.get("CUL_BUNDLE_COMPRESSION", "deflate"))
+
+def _from_accept_header():
+    for item in request.headers.get('Accept', '').split(','):
+        mimetype, options = parse_options_header(item)
+        if mimetype == 'application/zip' and 'compression' in options:
+            return options['compression'], options.get('level')
+    return None, None
+
+def negotiate_compression(default=None):
+    '''
+    Returns the compression mode requested by the client, the query parameters take precedence over the Accept header.
+
+    Args:
+        default: The mode used when the client does not ask for one, DEFAULT_COMPRESSION if None
+
+    Returns:
+        compression mode: a CompressionMode
+
+    Raises:
+        ValueError: If the client asked for an invalid mode or level
+    '''
+    value = request.args.get('compression')
+    level = request.args.get('level')
+    if value is None:
+        value, level = _from_accept_header()
+    if value is None:
+        return default or DEFAULT_COMPRESSION
+    return parse_compression(value, level)
@@ -0,0 +1,133 @@
+'''
+This file contains the database configuration of the registry. The database url and the connection pool are read from the environment, and SQLite connections are switched to WAL mode with a busy timeout, so that readers (logins, profile views, metadata lookups) keep running while an upload writes instead of serializing on the rollback journal.
+'''
+
+import os
+import threading
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from database import db
+
+DATABASE_URL = os.environ.get("CUL_DATABASE_URL", "sqlite:///cul_db.db")
+SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get("CUL_SQLITE_BUSY_TIMEOUT_MS", 5000))
+SQLITE_SYNCHRONOUS = os.environ.get("CUL_SQLITE_SYNCHRONOUS", "NORMAL").upper()
+POOL_SIZE = int(os.environ.get("CUL_DB_POOL_SIZE", 10))
+MAX_OVERFLOW = int(os.environ.get("CUL_DB_MAX_OVERFLOW", 20))
+POOL_TIMEOUT = int(os.environ.get("CUL_DB_POOL_TIMEOUT", 30))
+POOL_RECYCLE = int(os.environ.get("CUL_DB_POOL_RECYCLE", 1800))
+CREATE_SCHEMA = os.environ.get("CUL_CREATE_SCHEMA", "1") == "1"
+
+_schema_lock = threading.Lock()
+
+def is_sqlite(url):
+    '''
+    Returns True if the database url points to SQLite.
+    '''
+    return make_url(url).get_backend_name() == 'sqlite'
+
+def _is_sqlite_file(url):
+    return is_sqlite(url) and make_url(url).database not in (None, '', ':memory:')
+
+def engine_options(url):
+    '''
+    Returns the SQLAlchemy engine options used for the database url.
+
+    Args:
+        url: The database url
+
+    Returns:
+        options: the keyword arguments passed to create_engine
+
+    Raises:
+        None
+    '''
+    if is_sqlite(url) and not _is_sqlite_file(url):
+        # an in-memory database lives in a single shared connection
+        return {}
+    if is_sqlite(url):
+        # a file database serves several threads, every connection waits busy_timeout for a lock before failing
+        return {
+            "pool_size": POOL_SIZE,
+            "max_overflow": MAX_OVERFLOW,
+            "pool_timeout": POOL_TIMEOUT,
+            "connect_args": {"check_same_thread": False, "timeout": SQLITE_BUSY_TIMEOUT_MS / 1000},
+        }
+    return {
+        "pool_size": POOL_SIZE,
+        "max_overflow": MAX_OVERFLOW,
+        "pool_timeout": POOL_TIMEOUT,
+        "pool_recycle": POOL_RECYCLE,
+        "pool_pre_ping": True,
+    }
+
+def set_sqlite_pragmas(dbapi_connection, connection_record=None):
+    '''
+    Enables WAL mode, the busy timeout and the synchronous level on a new SQLite connection. Registered as a "connect" listener of the engine.
+    '''
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+        cursor.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+    finally:
+        cursor.close()
+
+def configure_database(app):
+    '''
+    Points the app at the configured database and binds the db object to it. Replaces the hardcoded SQLite url that app.py used to set.
+
+    Args:
+        app: The flask app
+
+    Returns:
+        None
+
+    Raises:
+        ValueError: If CUL_SQLITE_SYNCHRONOUS is not a valid synchronous level
+    '''
+    if SQLITE_SYNCHRONOUS not in ('OFF', 'NORMAL', 'FULL', 'EXTRA'):
+        raise ValueError("CUL_SQLITE_SYNCHRONOUS must be OFF, NORMAL, FULL or EXTRA.")
+    app.config.setdefault('SQLALCHEMY_DATABASE_URI', DATABASE_URL)
+    url = app.config['SQLALCHEMY_DATABASE_URI']
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', engine_options(url))
+    db.init_app(app)
+    if _is_sqlite_file(url):
+        with app.app_context():
+            event.listen(db.engine, "connect", set_sqlite_pragmas)
+
+def create_schema(app):
+    '''
+    Creates the tables that do not exist yet. Run once per deployment (flask --app app init-db, by wsgi.py at startup or by ensure_schema on the first request) instead of on every import of the app.
+
+    Args:
+        app: The flask app
+
+    Returns:
+        None
+
+    Raises:
+        sqlalchemy.exc.OperationalError: If the database cannot be reached
+    '''
+    import models  # registers the tables of the registry on db.metadata
+    with app.app_context():
+        db.create_all()
+
+def ensure_schema(app):
+    '''
+    Creates the tables that do not exist yet the first time it is called for an app, later calls return at once. Called before the first request of an app started without wsgi.py (Vercel, flask run, gunicorn app:app) and by the startup of wsgi.py, whose forked workers inherit that the schema exists.
+
+    Args:
+        app: The flask app
+
+    Returns:
+        None
+
+    Raises:
+        sqlalchemy.exc.OperationalError: If the database cannot be reached, the next call tries again
+    '''
+    if app.extensions.get('cul_schema_created'):
+        return
+    with _schema_lock:
+        if not app.extensions.get('cul_schema_created'):
+            create_schema(app)
+            app.extensions['cul_schema_created'] = True
@@ -0,0 +1,123 @@
+'''
+This file contains the server-side dependency resolver. The dependency graph is read from the "requires" lists of the module_info.json files held by the registry index, and the transitive closure of every (module, version) node is memoized until the index changes.
+'''
+
+import json
+import threading
+import registry_index
+from version_utils import parse_requirement, best_match
+
+_lock = threading.Lock()
+_generation = None
+_closures = {}  # (module, version) -> tuple of (module, version) pairs, dependencies first
+
+class ResolutionError(Exception):
+    '''
+    Raised when a set of requirements cannot be resolved. kind is one of "not_found", "invalid", "cycle" or "conflict", details holds the offending requirement, cycle or conflicting versions.
+    '''
+
+    def __init__(self, message, kind, details=None):
+        super().__init__(message)
+        self.kind = kind
+        self.details = details
+
+def _available_versions(module_name):
+    try:
+        data = registry_index.get_versions_data(module_name)
+    except json.JSONDecodeError:
+        raise ResolutionError(f"The versions.json file of '{module_name}' could not be decoded.", "invalid", module_name)
+    if data is None:
+        raise ResolutionError(f"Module '{module_name}' not found.", "not_found", module_name)
+    return data, [item['version'] for item in data.get('versions', [])]
+
+def select_version(requirement):
+    '''
+    Returns the (module, version) node a requirement string points to. A bare module name selects the latest version, a constraint selects the highest version satisfying it.
+
+    Args:
+        requirement: A string such as "test_module_4" or "test_module_4==1.0.0"
+
+    Returns:
+        node: a (module name, version) tuple
+
+    Raises:
+        ResolutionError: If the requirement is invalid or no version of the module satisfies it
+    '''
+    try:
+        module_name, operator, version = parse_requirement(requirement)
+    except ValueError as e:
+        raise ResolutionError(str(e), "invalid", requirement)
+    data, available = _available_versions(module_name)
+    selected = data.get('latest') if operator is None else best_match(available, operator, version)
+    if selected is None or selected not in available:
+        raise ResolutionError(f"No version of '{module_name}' satisfies '{requirement}'.", "not_found", requirement)
+    return module_name, selected
+
+def _requires(node):
+    try:
+        module_info = registry_index.get_module_info(*node)
+    except json.JSONDecodeError:
+        raise ResolutionError(f"The module_info.json file of '{node[0]}=={node[1]}' could not be decoded.", "invalid", f"{node[0]}=={node[1]}")
+    if module_info is None:
+        raise ResolutionError(f"Module '{node[0]}' with version {node[1]} not found.", "not_found", f"{node[0]}=={node[1]}")
+    return module_info.get('requires') or []
+
+def _merge(selected, order, closure):
+    '''
+    Adds the nodes of a closure to the selection, failing if a module is already selected at a different version.
+    '''
+    for module_name, version in closure:
+        chosen = selected.get(module_name)
+        if chosen is None:
+            selected[module_name] = version
+            order.append((module_name, version))
+        elif chosen != version:
+            raise ResolutionError(f"Conflicting versions of '{module_name}' are required: {chosen} and {version}.",
+                                  "conflict", {"module": module_name, "versions": sorted([chosen, version])})
+
+def _closure(node, stack):
+    '''
+    Returns the transitive closure of a node, dependencies first and the node itself last.
+    '''
+    cached = _closures.get(node)
+    if cached is not None:
+        return cached
+    if node in stack:
+        cycle = stack[stack.index(node):] + [node]
+        raise ResolutionError("Dependency cycle detected: " + " -> ".join(f"{m}=={v}" for m, v in cycle), "cycle",
+                              [f"{m}=={v}" for m, v in cycle])
+    stack.append(node)
+    selected = {}
+    order = []
+    for requirement in _requires(node):
+        _merge(selected, order, _closure(select_version(requirement), stack))
+    stack.pop()
+    _merge(selected, order, [node])
+    closure = tuple(order)
+    _closures[node] = closure
+    return closure
+
+def resolve(requirements):
+    '''
+    Resolves a list of requirements into the full set of module versions needed to install them.
+
+    Args:
+        requirements: A list of requirement strings such as ["test_module_5", "test_module_7==1.0.0"]
+
+    Returns:
+        resolved: a list of (module name, version) tuples, every module listed after its dependencies
+
+    Raises:
+        ResolutionError: If a module or version is missing, the graph contains a cycle or two different versions of the same module are required
+    '''
+    global _generation
+    with _lock:
+        current = registry_index.generation()
+        if current != _generation:
+            _closures.clear()
+            _generation = current
+        selected = {}
+        order = []
+        for requirement in requirements:
+            _merge(selected, order, _closure(select_version(requirement), []))
+        return order
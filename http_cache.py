@@ -0,0 +1,58 @@
+'''
+This file contains the helpers used to answer conditional GET requests (If-None-Match / If-Modified-Since) with 304 Not Modified and to attach ETag / Last-Modified headers to responses.
+'''
+
+from datetime import datetime, timezone
+from flask import request, Response
+
+def _to_datetime(timestamp):
+    if timestamp is None:
+        return None
+    return datetime.fromtimestamp(int(timestamp), timezone.utc)
+
+def not_modified(etag, last_modified=None):
+    '''
+    Checks the validators sent by the client against the current ones. If-None-Match takes precedence over If-Modified-Since, as required by RFC 9110.
+
+    Args:
+        etag: The current etag of the resource, or None
+        last_modified: The current modification time of the resource as a unix timestamp, or None
+
+    Returns:
+        304 response: if the client copy is still valid
+        None: if the full response has to be sent
+
+    Raises:
+        None
+    '''
+    if etag is None and last_modified is None:
+        return None
+    modified = _to_datetime(last_modified)
+    if request.if_none_match:
+        if not request.if_none_match.contains_weak(etag):
+            return None
+    elif modified is None or request.if_modified_since is None or modified > request.if_modified_since:
+        return None
+    response = Response(status=304)
+    return add_validators(response, etag, last_modified)
+
+def add_validators(response, etag, last_modified=None):
+    '''
+    Sets the ETag and Last-Modified headers of a response.
+
+    Args:
+        response: The response to update
+        etag: The etag of the resource, or None
+        last_modified: The modification time of the resource as a unix timestamp, or None
+
+    Returns:
+        response: the same response, for chaining
+
+    Raises:
+        None
+    '''
+    if etag is not None:
+        response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = _to_datetime(last_modified)
+    return response
@@ -0,0 +1,17 @@
+'''
+One-shot importer that copies the metadata of every module in c_cpp_modules into the ModuleVersion and Dependency tables and adds the indexes missing from databases created by an older version of the registry. Uploads and updates keep the tables in sync afterwards, so it only has to be run once after upgrading (or after modules were copied into c_cpp_modules by hand). Running it again is harmless.
+
+Usage: python import_modules.py
+'''
+
+from app import app
+from db_config import create_schema
+from metadata_store import import_tree
+
+if __name__ == '__main__':
+    create_schema(app)
+    with app.app_context():
+        imported, failed = import_tree()
+    print(f"Imported {len(imported)} modules.")
+    if failed:
+        print(f"Failed to import: {', '.join(failed)}")
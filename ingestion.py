@@ -0,0 +1,280 @@
+'''
+This file contains the background ingestion of modules. Uploads (git clone) and updates (git pull) are queued as jobs and run on a small worker pool, so the request that submitted them returns immediately. A job clones or pulls the repository, validates versions.json and every module_info.json, records the module and its versions in the database, refreshes the registry index and pre-builds the archives. Jobs are stored in the database, so their state can be polled with get_job from every worker process of the deployment and survives restarts. A job left queued or running by a process that is gone is reported as failed.
+'''
+
+import os
+import json
+import time
+import uuid
+import shutil
+import socket
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from database import db
+from models import Module, IngestionJob
+from artifact_cache import invalidate_module, prebuild_module
+from metadata_store import sync_module
+import module_listing
+import blob_store
+from auth import invalidate_profile
+import registry_index
+
+BASE_DIR = "c_cpp_modules"
+INGEST_WORKERS = int(os.environ.get("CUL_INGEST_WORKERS", "2"))
+GIT_TIMEOUT = int(os.environ.get("CUL_GIT_TIMEOUT_SECONDS", "600"))
+MAX_JOBS = 1000  # finished jobs kept for polling, the oldest are forgotten first
+
+_lock = threading.Lock()
+_executor = None
+
+class IngestionError(Exception):
+    '''
+    Raised by a job step when the module cannot be ingested, the message is shown to the user.
+    '''
+
+def _get_executor():
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=INGEST_WORKERS, thread_name_prefix="ingestion")
+        return _executor
+
+def _git(*args):
+    try:
+        result = subprocess.run(['git', *args], capture_output=True, text=True, timeout=GIT_TIMEOUT,
+                                env={**os.environ, 'GIT_TERMINAL_PROMPT': '0'})
+    except subprocess.TimeoutExpired:
+        raise IngestionError(f"git {args[0]} timed out after {GIT_TIMEOUT} seconds.")
+    if result.returncode != 0:
+        raise IngestionError(f"git {args[0]} failed: {result.stderr.strip()}")
+    return result.stdout.strip()
+
+def validate_module(module_dir):
+    '''
+    Checks that a cloned module has the layout the registry serves: a versions.json listing the versions and a directory with a module_info.json for each of them.
+
+    Args:
+        module_dir: The path of the module directory
+
+    Returns:
+        versions: the versions listed in versions.json
+
+    Raises:
+        IngestionError: If the layout or a metadata file is invalid
+    '''
+    try:
+        with open(os.path.join(module_dir, 'versions.json'), 'r') as file:
+            versions_data = json.load(file)
+    except FileNotFoundError:
+        raise IngestionError("versions.json not found in the repository.")
+    except json.JSONDecodeError as e:
+        raise IngestionError(f"versions.json is not valid JSON: {e}")
+    entries = versions_data.get('versions') if isinstance(versions_data, dict) else None
+    if not isinstance(entries, list) or not entries:
+        raise IngestionError("versions.json must contain a non-empty 'versions' list.")
+    versions = [entry.get('version') if isinstance(entry, dict) else None for entry in entries]
+    if versions_data.get('latest') not in versions:
+        raise IngestionError(f"The latest version '{versions_data.get('latest')}' is not listed in versions.json.")
+    for version in versions:
+        if not isinstance(version, str) or not version or not os.path.isdir(os.path.join(module_dir, version)):
+            raise IngestionError(f"Version '{version}' has no directory in the repository.")
+        try:
+            with open(os.path.join(module_dir, version, 'module_info.json'), 'r') as file:
+                json.load(file)
+        except FileNotFoundError:
+            raise IngestionError(f"module_info.json not found for version '{version}'.")
+        except json.JSONDecodeError as e:
+            raise IngestionError(f"module_info.json of version '{version}' is not valid JSON: {e}")
+    return versions
+
+def _refresh(app, module_name):
+    invalidate_module(module_name)
+    registry_index.invalidate(module_name)
+    with app.app_context():
+        sync_module(module_name)
+    if blob_store.STORAGE_BACKEND == "blobs":
+        blob_store.store_module(module_name)
+    prebuild_module(module_name)
+
+def _upload(app, job, module_url, associated_user):
+    module_name = job['module_name']
+    module_dir = os.path.join(BASE_DIR, module_name)
+    if os.path.exists(module_dir):
+        raise IngestionError("Module already exists")
+    try:
+        _git('clone', '--', module_url, module_dir)
+        job['versions'] = validate_module(module_dir)
+        with app.app_context():
+            if Module.query.filter_by(module_name=module_name).first():
+                raise IngestionError("Module already exists")
+            db.session.add(Module(module_name=module_name, module_url=module_url, associated_user=associated_user))
+            db.session.commit()
+        module_listing.invalidate()
+        invalidate_profile(associated_user)
+    except Exception:
+        shutil.rmtree(module_dir, ignore_errors=True)
+        raise
+    _refresh(app, module_name)
+
+def _update(app, job):
+    module_dir = os.path.join(BASE_DIR, job['module_name'])
+    previous_head = _git('-C', module_dir, 'rev-parse', 'HEAD')
+    _git('-C', module_dir, 'pull', '--ff-only')
+    try:
+        job['versions'] = validate_module(module_dir)
+    except IngestionError:
+        # keep serving the last good revision
+        _git('-C', module_dir, 'reset', '--hard', previous_head)
+        raise
+    _refresh(app, job['module_name'])
+
+def _worker_id():
+    # computed per call, workers forked from a preloading parent have their own pid
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+def _is_orphaned(job):
+    '''
+    Returns True if an unfinished job belongs to a process of this host that no longer exists, e.g. a worker that was restarted while the job ran. Jobs of other hosts cannot be checked and are trusted.
+    '''
+    if job.status not in ("queued", "running") or os.name != 'posix':
+        return False
+    host, _, pid = job.worker.rpartition(':')
+    if host != socket.gethostname() or not pid.isdigit() or int(pid) == os.getpid():
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return True
+    except OSError:
+        pass
+    return False
+
+def _fail_orphaned(job):
+    job.status = "failed"
+    job.error = "The job was interrupted by a restart of the registry, please submit it again."
+    job.finished = time.time()
+
+def _job_dict(job):
+    return {"id": job.job_id, "kind": job.kind, "module_name": job.module_name, "status": job.status, "error": job.error,
+            "versions": json.loads(job.versions) if job.versions is not None else None,
+            "created": job.created, "started": job.started, "finished": job.finished}
+
+def _save(app, job_id, **fields):
+    with app.app_context():
+        IngestionJob.query.filter_by(job_id=job_id).update(fields)
+        db.session.commit()
+
+def _run(job, step, app, *args):
+    _save(app, job['id'], status="running", started=time.time())
+    fields = {"status": "succeeded"}
+    try:
+        step(app, job, *args)
+    except Exception as e:
+        print(e)
+        fields = {"status": "failed", "error": str(e)}
+    finally:
+        fields["versions"] = json.dumps(job['versions']) if job['versions'] is not None else None
+        fields["finished"] = time.time()
+        _save(app, job['id'], **fields)
+
+def _submit(kind, module_name, step, app, *args):
+    job = {"id": uuid.uuid4().hex, "module_name": module_name, "versions": None}
+    with _lock, app.app_context():
+        for other in IngestionJob.query.filter(IngestionJob.module_name == module_name, IngestionJob.status.in_(("queued", "running"))):
+            if not _is_orphaned(other):
+                raise IngestionError(f"A job for '{module_name}' is already queued or running.")
+            _fail_orphaned(other)
+        db.session.add(IngestionJob(job_id=job['id'], kind=kind, module_name=module_name, status="queued",
+                                    worker=_worker_id(), created=time.time()))
+        # finished jobs beyond the newest MAX_JOBS are forgotten
+        old_ids = [row.job_id for row in db.session.query(IngestionJob.job_id).filter(IngestionJob.finished.isnot(None))
+                   .order_by(IngestionJob.created.desc()).offset(MAX_JOBS)]
+        if old_ids:
+            IngestionJob.query.filter(IngestionJob.job_id.in_(old_ids)).delete(synchronize_session=False)
+        db.session.commit()
+    try:
+        _get_executor().submit(_run, job, step, app, *args)
+    except RuntimeError as e:
+        _save(app, job['id'], status="failed", error=str(e), finished=time.time())
+    return job['id']
+
+def module_name_from_url(module_url):
+    '''
+    Returns the module name of a repository url, e.g. "repo" for https://github.com/username/repo or /srv/git/repo.git.
+    '''
+    name = module_url.rstrip('/').split('/')[-1]
+    return name[:-4] if name.endswith('.git') else name
+
+def submit_upload(app, module_url, associated_user):
+    '''
+    Queues the upload of a module: the repository is cloned into c_cpp_modules, validated and added to the database.
+
+    Args:
+        app: The flask app, the job uses its app context to access the database
+        module_url: The url of the git repository
+        associated_user: The email of the user uploading the module
+
+    Returns:
+        job id: the id to poll the job with
+
+    Raises:
+        IngestionError: If the url has no usable module name or a job for the same module is already queued or running
+    '''
+    module_name = module_name_from_url(module_url)
+    if module_name in ('', '.', '..'):
+        raise IngestionError("The url does not name a repository.")
+    return _submit("upload", module_name, _upload, app, module_url, associated_user)
+
+def submit_update(app, module_name):
+    '''
+    Queues the update of a module: the latest changes are pulled and validated, an update that fails validation is rolled back.
+
+    Args:
+        app: The flask app
+        module_name: The name of the module
+
+    Returns:
+        job id: the id to poll the job with
+
+    Raises:
+        IngestionError: If a job for the same module is already queued or running
+    '''
+    return _submit("update", module_name, _update, app)
+
+def get_job(job_id):
+    '''
+    Returns the state of a job, or None if the job is unknown. Must be called inside an app context.
+
+    Args:
+        job_id: The id returned by submit_upload or submit_update
+
+    Returns:
+        job: a dictionary with id, kind, module_name, status (queued, running, succeeded or failed), error, versions and the created/started/finished timestamps
+        None: if there is no such job
+
+    Raises:
+        None
+    '''
+    job = db.session.get(IngestionJob, job_id)
+    if job is None:
+        return None
+    if _is_orphaned(job):
+        _fail_orphaned(job)
+        db.session.commit()
+    return _job_dict(job)
+
+def wait_for_job(job_id, timeout=None):
+    '''
+    Blocks until a job has finished or timeout seconds have passed and returns its state, mainly useful for scripts and benchmarks. Must be called inside an app context.
+    '''
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while True:
+        # a new session per poll, so that the updates of the worker thread are seen
+        db.session.remove()
+        job = get_job(job_id)
+        if job is None or job['finished'] is not None:
+            return job
+        if deadline is not None and time.monotonic() >= deadline:
+            return job
+        time.sleep(0.05)
@@ -0,0 +1,95 @@
+'''
+This file contains the database copy of the module metadata. Every version of a module is a ModuleVersion row holding its module_info.json, the versions.json of the module and the cache validators, and every requirement in a "requires" list is a Dependency row. The rows are written when a module is ingested or imported and removed when it is deleted, so the metadata of the registry can be queried with SQL (e.g. the modules of an owner or the modules requiring another one). The metadata endpoints do not read them: they answer from the in-memory registry index (registry_index.py), which has the same data without a database round trip and also covers modules changed on disk since their rows were written.
+'''
+
+import json
+from database import db
+from models import Module, ModuleVersion, Dependency
+from version_utils import parse_requirement
+import registry_index
+
+def sync_module(module_name):
+    '''
+    Replaces the rows of a module with its current metadata from the registry index. Must be called inside an app context, after the module was invalidated in the registry index.
+
+    Args:
+        module_name: The name of the module
+
+    Returns:
+        count: the number of versions stored, 0 if the module or its versions.json no longer exists
+
+    Raises:
+        json.JSONDecodeError: If versions.json or a module_info.json file could not be decoded, the existing rows are left untouched
+    '''
+    try:
+        ModuleVersion.query.filter_by(module_name=module_name).delete()
+        Dependency.query.filter_by(module_name=module_name).delete()
+        data = registry_index.get_versions_data(module_name)
+        if data is None:
+            db.session.commit()
+            return 0
+        etag, last_modified = registry_index.get_validators(module_name)
+        module = Module.query.filter_by(module_name=module_name).first()
+        owner = module.associated_user if module else None
+        versions_json = json.dumps(data)
+        count = 0
+        for position, item in enumerate(data.get('versions', [])):
+            version = item.get('version')
+            module_info = registry_index.get_module_info(module_name, version)
+            if module_info is None:
+                continue
+            db.session.add(ModuleVersion(
+                module_name=module_name, version=version, position=position, path=item.get('path'),
+                is_latest=version == data.get('latest'), owner=owner, author=module_info.get('author'),
+                description=module_info.get('description'), license=module_info.get('license'),
+                info=json.dumps(module_info), versions_json=versions_json, etag=etag, last_modified=last_modified))
+            for requirement in module_info.get('requires') or []:
+                try:
+                    requires_name = parse_requirement(requirement)[0]
+                except ValueError:
+                    requires_name = requirement
+                db.session.add(Dependency(module_name=module_name, version=version, requirement=requirement, requires_name=requires_name))
+            count += 1
+        db.session.commit()
+        return count
+    except Exception:
+        db.session.rollback()
+        raise
+
+def remove_module(module_name):
+    '''
+    Deletes the rows of a module. Must be called inside an app context.
+    '''
+    ModuleVersion.query.filter_by(module_name=module_name).delete()
+    Dependency.query.filter_by(module_name=module_name).delete()
+    db.session.commit()
+
+def import_tree():
+    '''
+    Imports every module found in c_cpp_modules into the database and adds the indexes that db.create_all does not add to tables created by an older version of the registry. Must be called inside an app context.
+
+    Args:
+        None
+
+    Returns:
+        result: an (imported, failed) tuple of module name lists
+
+    Raises:
+        None
+    '''
+    for table in (Module.__table__, ModuleVersion.__table__, Dependency.__table__):
+        for index in table.indexes:
+            try:
+                index.create(db.engine, checkfirst=True)
+            except Exception as e:
+                print(f"Could not create index {index.name}: {e}")
+    registry_index.invalidate()
+    imported, failed = [], []
+    for module_name in sorted(registry_index.list_modules()):
+        try:
+            sync_module(module_name)
+            imported.append(module_name)
+        except Exception as e:
+            print(f"Could not import '{module_name}': {e}")
+            failed.append(module_name)
+    return imported, failed
@@ -0,0 +1,292 @@
+'''
+This file contains the instrumentation of the registry: per-route request counts and latency histograms, bytes served, zip build time, filesystem reads and SQLAlchemy query counts/time. Everything is kept in process memory and rendered in the Prometheus text format by render_metrics. It also contains a sampling profiler that can be started and stopped at runtime.
+'''
+
+import os
+import sys
+import time
+import threading
+from collections import Counter
+from flask import request, g, jsonify, Response
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+PROFILER_ENABLED = os.environ.get("CUL_ENABLE_PROFILER", "0") == "1"
+
+_lock = threading.Lock()
+_requests = Counter()  # (route, method, status) -> count
+_latency = {}  # (route, method) -> histogram
+_bytes = Counter()  # route -> bytes sent
+_fs_reads = Counter()  # kind -> count
+_db = {"queries": 0, "seconds": 0.0}
+
+def _new_histogram():
+    return {"buckets": [0] * len(LATENCY_BUCKETS), "sum": 0.0, "count": 0}
+
+def _observe(histogram, value):
+    for i, bound in enumerate(LATENCY_BUCKETS):
+        if value <= bound:
+            histogram["buckets"][i] += 1
+    histogram["sum"] += value
+    histogram["count"] += 1
+
+_zip_builds = _new_histogram()  # time spent building zip archives
+
+def record_fs_read(kind, count=1):
+    '''
+    Counts files read from disk, kind tells what was read (e.g. "metadata_json", "archive_source").
+    '''
+    with _lock:
+        _fs_reads[kind] += count
+
+def record_zip_build(seconds):
+    '''
+    Records the time it took to build one zip archive.
+    '''
+    with _lock:
+        _observe(_zip_builds, seconds)
+
+def record_request(route, method, status, seconds):
+    '''
+    Records one request in the per-route request counts and latency histograms. Called by the Flask request hooks and by the ASGI app, whose requests do not run them.
+    '''
+    with _lock:
+        _requests[(route, method, str(status))] += 1
+        histogram = _latency.get((route, method))
+        if histogram is None:
+            histogram = _latency[(route, method)] = _new_histogram()
+        _observe(histogram, seconds)
+
+def record_bytes(route, count):
+    '''
+    Counts response body bytes sent for a route.
+    '''
+    with _lock:
+        _bytes[route] += count
+
+def _count_bytes(iterable, route):
+    '''
+    Wraps the body of a streamed response to count the bytes that are actually sent.
+    '''
+    try:
+        for chunk in iterable:
+            record_bytes(route, len(chunk))
+            yield chunk
+    finally:
+        if hasattr(iterable, 'close'):
+            iterable.close()
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['query_start'].pop()
+    with _lock:
+        _db["queries"] += 1
+        _db["seconds"] += elapsed
+
+def _before_request():
+    g.metrics_start = time.perf_counter()
+
+def _after_request(response):
+    start = g.pop('metrics_start', None)
+    if start is None:
+        return response
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    record_request(route, request.method, response.status_code, time.perf_counter() - start)
+    if response.content_length is not None:
+        record_bytes(route, response.content_length)
+    elif response.is_streamed:
+        response.response = _count_bytes(response.response, route)
+    return response
+
+def init_metrics(app):
+    '''
+    Registers the request hooks that record per-route metrics on the app.
+
+    Args:
+        app: The flask app
+
+    Returns:
+        None
+
+    Raises:
+        None
+    '''
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+
+def _labels(**labels):
+    escape = lambda value: str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join(f'{key}="{escape(value)}"' for key, value in labels.items()) + '}'
+
+def _histogram_lines(name, histogram, **labels):
+    lines = []
+    for bound, count in zip(LATENCY_BUCKETS, histogram["buckets"]):
+        lines.append(f"{name}_bucket{_labels(**labels, le=bound)} {count}")
+    lines.append(f"{name}_bucket{_labels(**labels, le='+Inf')} {histogram['count']}")
+    suffix = _labels(**labels) if labels else ''
+    lines.append(f"{name}_sum{suffix} {histogram['sum']}")
+    lines.append(f"{name}_count{suffix} {histogram['count']}")
+    return lines
+
+def render_metrics(extra=None):
+    '''
+    Returns every metric in the Prometheus text exposition format.
+
+    Args:
+        extra: An optional dictionary of additional counters, e.g. the artifact cache stats, exported as cul_<key>
+
+    Returns:
+        metrics: the exposition text
+
+    Raises:
+        None
+    '''
+    with _lock:
+        lines = ["# HELP cul_http_requests_total Requests handled, by route, method and status.",
+                 "# TYPE cul_http_requests_total counter"]
+        for (route, method, status), count in sorted(_requests.items()):
+            lines.append(f"cul_http_requests_total{_labels(route=route, method=method, status=status)} {count}")
+
+        lines += ["# HELP cul_http_request_duration_seconds Time spent handling requests, by route and method.",
+                  "# TYPE cul_http_request_duration_seconds histogram"]
+        for (route, method), histogram in sorted(_latency.items()):
+            lines += _histogram_lines("cul_http_request_duration_seconds", histogram, route=route, method=method)
+
+        lines += ["# HELP cul_http_response_bytes_total Response body bytes sent, by route.",
+                  "# TYPE cul_http_response_bytes_total counter"]
+        for route, count in sorted(_bytes.items()):
+            lines.append(f"cul_http_response_bytes_total{_labels(route=route)} {count}")
+
+        lines += ["# HELP cul_zip_build_seconds Time spent building zip archives.",
+                  "# TYPE cul_zip_build_seconds histogram"]
+        lines += _histogram_lines("cul_zip_build_seconds", _zip_builds)
+
+        lines += ["# HELP cul_fs_reads_total Files read from disk, by kind.",
+                  "# TYPE cul_fs_reads_total counter"]
+        for kind, count in sorted(_fs_reads.items()):
+            lines.append(f"cul_fs_reads_total{_labels(kind=kind)} {count}")
+
+        lines += ["# HELP cul_db_queries_total SQL statements executed.",
+                  "# TYPE cul_db_queries_total counter",
+                  f"cul_db_queries_total {_db['queries']}",
+                  "# HELP cul_db_query_seconds_total Time spent executing SQL statements.",
+                  "# TYPE cul_db_query_seconds_total counter",
+                  f"cul_db_query_seconds_total {_db['seconds']}"]
+
+    for key, value in sorted((extra or {}).items()):
+        lines += [f"# TYPE cul_{key} gauge", f"cul_{key} {value}"]
+    return "\n".join(lines) + "\n"
+
+_profiler = {"thread": None, "stop": None, "samples": Counter(), "started": None, "interval": None}
+
+def _sample(stop, interval):
+    own = threading.get_ident()
+    while not stop.wait(interval):
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}")
+                frame = frame.f_back
+            with _lock:
+                _profiler["samples"][';'.join(reversed(stack))] += 1
+
+def start_profiler(interval=0.01):
+    '''
+    Starts sampling the stacks of every thread every interval seconds. Samples from a previous run are discarded.
+
+    Args:
+        interval: The sampling interval in seconds
+
+    Returns:
+        started: False if the profiler was already running
+
+    Raises:
+        None
+    '''
+    with _lock:
+        if _profiler["thread"] is not None:
+            return False
+        stop = threading.Event()
+        thread = threading.Thread(target=_sample, args=(stop, interval), name="sampling-profiler", daemon=True)
+        _profiler.update(thread=thread, stop=stop, samples=Counter(), started=time.time(), interval=interval)
+    thread.start()
+    return True
+
+def stop_profiler():
+    '''
+    Stops the sampling profiler, the collected samples are kept until the next start.
+
+    Args:
+        None
+
+    Returns:
+        stopped: False if the profiler was not running
+
+    Raises:
+        None
+    '''
+    with _lock:
+        thread, stop = _profiler["thread"], _profiler["stop"]
+        _profiler["thread"] = None
+    if thread is None:
+        return False
+    stop.set()
+    thread.join()
+    return True
+
+def profiler_report(limit=50):
+    '''
+    Returns the most frequently sampled stacks in the folded format understood by flamegraph tools ("frame;frame;frame count" per line).
+
+    Args:
+        limit: The number of stacks to return
+
+    Returns:
+        report: the folded stacks, most frequent first
+
+    Raises:
+        None
+    '''
+    with _lock:
+        running = _profiler["thread"] is not None
+        samples = _profiler["samples"].most_common(limit)
+        total = sum(_profiler["samples"].values())
+    header = f"# running={running} interval={_profiler['interval']} samples={total}\n"
+    return header + "".join(f"{stack} {count}\n" for stack, count in samples)
+
+def profiler_control():
+    '''
+    Starts, stops or reports the sampling profiler. Only available when CUL_ENABLE_PROFILER=1. A POST with action=start (and an optional interval in seconds) or action=stop controls it, a GET returns the folded stacks collected so far.
+
+    Args:
+        None
+
+    Returns:
+        report: the folded stacks, for GET requests
+        status: whether the profiler changed state, for POST requests
+        error message: if the profiler is disabled (404) or the action is invalid (400)
+
+    Raises:
+        None
+    '''
+    if not PROFILER_ENABLED:
+        return jsonify({"error": "Not found."}), 404
+    if request.method == 'GET':
+        return Response(profiler_report(request.args.get('limit', 50, type=int)), mimetype='text/plain')
+    action = request.values.get('action')
+    if action == 'start':
+        interval = request.values.get('interval', 0.01, type=float)
+        if not 0.001 <= interval <= 1:
+            return jsonify({"error": "The interval must be between 0.001 and 1 second."}), 400
+        return jsonify({"started": start_profiler(interval)})
+    if action == 'stop':
+        return jsonify({"stopped": stop_profiler()})
+    return jsonify({"error": "The action must be 'start' or 'stop'."}), 400
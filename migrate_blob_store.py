@@ -0,0 +1,56 @@
+'''
+Moves every module in c_cpp_modules into the content-addressed blob store: the files of each version are stored once by hash, replaced by hard links to their blobs and described by a manifest. Run it once before switching a deployment to CUL_STORAGE_BACKEND=blobs, uploads and updates store new versions afterwards. Running it again is harmless, --gc also deletes the blobs of removed modules and versions. Afterwards every module cloned from git is checked for a clean working tree, since a file whose mode or contents changed would make the next update (git pull --ff-only) fail.
+
+Usage: python migrate_blob_store.py [--gc]
+'''
+
+import os
+import sys
+import subprocess
+import registry_index
+import blob_store
+
+def migrate():
+    '''
+    Stores every module of the registry and returns the summed stats of blob_store.store_module.
+    '''
+    totals = {"files": 0, "bytes": 0, "new_blobs": 0, "new_bytes": 0, "linked": 0}
+    registry_index.invalidate()
+    for module_name in sorted(registry_index.list_modules()):
+        try:
+            for key, value in blob_store.store_module(module_name).items():
+                totals[key] += value
+        except Exception as e:
+            print(f"Could not store '{module_name}': {e}")
+    return totals
+
+def dirty_checkouts():
+    '''
+    Returns the modules cloned from git whose working tree has local changes, as a dictionary of module name -> git status --porcelain lines.
+    '''
+    dirty = {}
+    for module_name in sorted(registry_index.list_modules()):
+        module_dir = os.path.join(blob_store.BASE_DIR, module_name)
+        if not os.path.isdir(os.path.join(module_dir, '.git')):
+            continue
+        try:
+            result = subprocess.run(['git', '-C', module_dir, 'status', '--porcelain'], capture_output=True, text=True, check=True)
+        except (OSError, subprocess.CalledProcessError) as e:
+            print(f"Could not check the working tree of '{module_name}': {e}")
+            continue
+        if result.stdout.strip():
+            dirty[module_name] = result.stdout.splitlines()
+    return dirty
+
+if __name__ == '__main__':
+    totals = migrate()
+    print(f"Stored {totals['files']} files ({totals['bytes']} bytes) of which {totals['new_blobs']} blobs ({totals['new_bytes']} bytes) were new.")
+    print(f"{totals['linked']} files now share their blob.")
+    if '--gc' in sys.argv[1:]:
+        count, size = blob_store.collect_garbage()
+        print(f"Removed {count} unused blobs ({size} bytes).")
+    dirty = dirty_checkouts()
+    for module_name, lines in dirty.items():
+        print(f"'{module_name}' has local changes, its next update will fail: {', '.join(line.strip() for line in lines)}")
+    if dirty:
+        sys.exit(1)
@@ -0,0 +1,392 @@
+'''
+This file contains the pull-through mirror mode. An instance configured with upstream registries (CUL_UPSTREAM_REGISTRIES, a comma separated list of base urls tried in order) answers /versions, /latest_version and /files from its own c_cpp_modules tree when it has the module or version, and otherwise from a disk cache of upstream responses. A cached response is used as is for CUL_MIRROR_TTL_SECONDS and then revalidated with If-None-Match, so an unchanged module costs the upstream a 304. Concurrent misses for the same url wait for a single upstream fetch, and a stale response is served while every upstream is unreachable.
+
+Responses are cached per url and Accept header (the compression of an archive is negotiated with it) and their bodies are named after the upstream etag, so a refreshed body never overwrites one a request is still sending. The cache is kept under CUL_MIRROR_MAX_BYTES by dropping the least recently used responses.
+'''
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import OrderedDict
+from email.utils import parsedate_to_datetime
+from flask import request, jsonify, send_file, Response
+from werkzeug.exceptions import RequestedRangeNotSatisfiable
+from werkzeug.http import unquote_etag, parse_options_header
+from http_cache import not_modified, add_validators
+
+UPSTREAM_REGISTRIES = [url.strip().rstrip('/') for url in os.environ.get("CUL_UPSTREAM_REGISTRIES", "").split(',') if url.strip()]
+MIRROR_DIR = os.environ.get("CUL_MIRROR_DIR", "mirror_cache")
+MIRROR_TTL = float(os.environ.get("CUL_MIRROR_TTL_SECONDS", 300))
+MIRROR_MAX_BYTES = int(os.environ.get("CUL_MIRROR_MAX_BYTES", 1024 * 1024 * 1024))
+UPSTREAM_TIMEOUT = float(os.environ.get("CUL_UPSTREAM_TIMEOUT_SECONDS", 10))
+ENABLED = bool(UPSTREAM_REGISTRIES)
+# a replaced or evicted body stays on disk this long, so that a request that just read its entry can still open it
+REMOVAL_GRACE_SECONDS = 60
+
+_lock = threading.Lock()
+_inflight = {}  # cache key -> threading.Event set when the upstream fetch of the leader finished
+_entries = OrderedDict()  # cache key -> body size in bytes, least recently used first
+_doomed = OrderedDict()  # body path -> time it was replaced or evicted, removed from disk after REMOVAL_GRACE_SECONDS
+_stats = {"hits": 0, "misses": 0, "revalidated": 0, "coalesced": 0, "upstream_fetches": 0, "stale_served": 0, "errors": 0, "evictions": 0}
+_loaded = False
+
+class MirrorError(Exception):
+    '''
+    Raised when no upstream registry could answer a request that is not cached.
+    '''
+
+def _count(key):
+    with _lock:
+        _stats[key] += 1
+
+def _cache_key(path, accept):
+    return hashlib.sha256(f"{path}\n{accept}".encode('utf-8')).hexdigest()
+
+def _meta_path(key):
+    return os.path.join(MIRROR_DIR, key[:2], f"{key}.json")
+
+def _body_path(key, entry):
+    return os.path.join(MIRROR_DIR, key[:2], entry["body"])
+
+def _body_name(key, entry):
+    '''
+    Returns the file name of the body of an entry, derived from the upstream and etag of the response (the fetch time when there is no etag), e.g. <key>.<16 hex digits>.body.
+    '''
+    version = f"{entry['upstream']}\n{entry.get('etag') or repr(entry['fetched'])}"
+    return f"{key}.{hashlib.sha256(version.encode('utf-8')).hexdigest()[:16]}.body"
+
+def _read_entry(key):
+    try:
+        with open(_meta_path(key), 'r') as file:
+            entry = json.load(file)
+    except (OSError, ValueError):
+        return None
+    # entries written before bodies were named by content have no body name
+    return entry if isinstance(entry, dict) and entry.get("body") else None
+
+def _load_existing_entries():
+    '''
+    Registers the responses already present in the mirror directory (e.g. from a previous run), oldest access first, and removes the bodies no entry refers to. Must be called with the lock held.
+    '''
+    global _loaded
+    if _loaded:
+        return
+    found = []
+    if os.path.isdir(MIRROR_DIR):
+        for root, dirs, files in os.walk(MIRROR_DIR):
+            referenced = set()
+            for file in files:
+                if not file.endswith('.json'):
+                    continue
+                key = file[:-len('.json')]
+                entry = _read_entry(key)
+                try:
+                    if entry is None:
+                        os.remove(os.path.join(root, file))
+                        continue
+                    atime = os.stat(os.path.join(root, file)).st_atime
+                    size = os.path.getsize(_body_path(key, entry))
+                except OSError:
+                    continue
+                referenced.add(entry["body"])
+                found.append((atime, key, size))
+            for file in files:
+                path = os.path.join(root, file)
+                try:
+                    # a body another process just stored may not have its entry yet
+                    if file.endswith('.body') and file not in referenced and time.time() - os.stat(path).st_mtime > REMOVAL_GRACE_SECONDS:
+                        os.remove(path)
+                except OSError:
+                    pass
+    for atime, key, size in sorted(found):
+        _entries[key] = size
+    _loaded = True
+    _evict_locked()
+
+def _discard_locked(path):
+    '''
+    Drops a body file. It is only removed from disk REMOVAL_GRACE_SECONDS later, since fetch may have just returned its entry to a request that has not opened it yet. Must be called with the lock held.
+    '''
+    _doomed[path] = time.monotonic()
+    _doomed.move_to_end(path)
+    _remove_doomed_locked()
+
+def _remove_doomed_locked():
+    '''
+    Removes the dropped bodies whose grace period is over. Must be called with the lock held.
+    '''
+    while _doomed:
+        path, dropped = next(iter(_doomed.items()))
+        if time.monotonic() - dropped < REMOVAL_GRACE_SECONDS:
+            break
+        del _doomed[path]
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+def _evict_locked():
+    '''
+    Drops least recently used responses until the bodies fit in MIRROR_MAX_BYTES. The most recently used response is always kept so that it can still be served. Must be called with the lock held.
+    '''
+    total = sum(_entries.values())
+    while total > MIRROR_MAX_BYTES and len(_entries) > 1:
+        key, size = _entries.popitem(last=False)
+        total -= size
+        _stats["evictions"] += 1
+        entry = _read_entry(key)
+        try:
+            os.remove(_meta_path(key))
+        except OSError:
+            pass
+        if entry is not None:
+            _discard_locked(_body_path(key, entry))
+
+def _touch(key):
+    with _lock:
+        _load_existing_entries()
+        if key in _entries:
+            _entries.move_to_end(key)
+
+def _write_entry(key, entry, body_tmp_path=None, previous=None):
+    '''
+    Stores the metadata of a cached response, and its body if a new one was downloaded. The body is stored under its own name first so that the metadata never describes a body that is not on disk yet, the body of the previous entry is dropped once the metadata points to the new one.
+    '''
+    meta_path = _meta_path(key)
+    os.makedirs(os.path.dirname(meta_path), exist_ok=True)
+    if body_tmp_path is not None:
+        entry["body"] = _body_name(key, entry)
+        os.replace(body_tmp_path, _body_path(key, entry))
+    tmp_path = f"{meta_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'w') as file:
+        json.dump(entry, file)
+    os.replace(tmp_path, meta_path)
+    size = os.path.getsize(_body_path(key, entry))
+    with _lock:
+        _load_existing_entries()
+        if previous is not None and previous.get("body") and previous["body"] != entry["body"]:
+            _discard_locked(_body_path(key, previous))
+        _entries[key] = size
+        _entries.move_to_end(key)
+        _evict_locked()
+
+def _fetch_upstream(key, path, accept, entry):
+    '''
+    Asks the upstream registries for a url, in order, until one answers. The Accept header of the client is forwarded, and the cached etag is sent along when the entry came from that upstream.
+
+    Args:
+        key: The cache key of the url
+        path: The path and query string of the url
+        accept: The Accept header of the client, empty if it sent none
+        entry: The cached entry, or None
+
+    Returns:
+        result: a (new entry, temporary body path) tuple, (None, None) if the cached entry is still valid
+
+    Raises:
+        MirrorError: If every upstream failed
+    '''
+    not_found = None
+    errors = []
+    for upstream in UPSTREAM_REGISTRIES:
+        upstream_request = urllib.request.Request(upstream + path, headers={"User-Agent": "cul-mirror"})
+        if accept:
+            upstream_request.add_header('Accept', accept)
+        if entry and entry.get('upstream') == upstream and entry.get('etag'):
+            upstream_request.add_header('If-None-Match', entry['etag'])
+        _count("upstream_fetches")
+        try:
+            response = urllib.request.urlopen(upstream_request, timeout=UPSTREAM_TIMEOUT)
+        except urllib.error.HTTPError as e:
+            if e.code == 304:
+                return None, None
+            if e.code == 404:
+                # another upstream may have it, the first 404 is cached if none does
+                not_found = not_found or (upstream, e.headers, e.read())
+                continue
+            errors.append(f"{upstream}: {e.code}")
+            continue
+        except (urllib.error.URLError, OSError) as e:
+            errors.append(f"{upstream}: {e}")
+            continue
+
+        os.makedirs(os.path.join(MIRROR_DIR, key[:2]), exist_ok=True)
+        body_tmp_path = os.path.join(MIRROR_DIR, key[:2], f"{key}.{os.getpid()}.{threading.get_ident()}.tmp")
+        try:
+            with response, open(body_tmp_path, 'wb') as file:
+                shutil.copyfileobj(response, file)
+        except OSError as e:
+            if os.path.exists(body_tmp_path):
+                os.remove(body_tmp_path)
+            errors.append(f"{upstream}: {e}")
+            continue
+        return _new_entry(path, upstream, response.status, response.headers), body_tmp_path
+
+    if not_found is not None:
+        upstream, headers, body = not_found
+        body_tmp_path = os.path.join(MIRROR_DIR, key[:2], f"{key}.{os.getpid()}.{threading.get_ident()}.tmp")
+        os.makedirs(os.path.dirname(body_tmp_path), exist_ok=True)
+        with open(body_tmp_path, 'wb') as file:
+            file.write(body)
+        return _new_entry(path, upstream, 404, headers), body_tmp_path
+    raise MirrorError(f"No upstream registry answered {path}: {'; '.join(errors) or 'no upstream configured'}")
+
+def _new_entry(path, upstream, status, headers):
+    return {
+        "path": path,
+        "upstream": upstream,
+        "status": status,
+        "etag": headers.get('ETag'),
+        "last_modified": headers.get('Last-Modified'),
+        "content_type": headers.get('Content-Type'),
+        "content_disposition": headers.get('Content-Disposition'),
+        "fetched": time.time(),
+    }
+
+def _refresh(key, path, accept, entry):
+    try:
+        new_entry, body_tmp_path = _fetch_upstream(key, path, accept, entry)
+    except MirrorError as e:
+        _count("errors")
+        if entry is None:
+            raise
+        print(f"Serving a stale copy of {path}: {e}")
+        _count("stale_served")
+        return entry
+    if new_entry is None:
+        _count("revalidated")
+        entry["fetched"] = time.time()
+        _write_entry(key, entry)
+        return entry
+    # successful responses and 404s are cached, other upstream errors raise and are retried by the next request
+    _write_entry(key, new_entry, body_tmp_path, previous=entry)
+    return new_entry
+
+def fetch(path, accept=""):
+    '''
+    Returns the cached upstream response of a url, fetching or revalidating it first if needed. Responses are cached per Accept header, since the upstream negotiates the compression of archives with it. Only one thread of the process fetches a given url at a time, the others wait for it and read its result from the cache.
+
+    Args:
+        path: The path and query string of the url, e.g. /versions/test_module_6
+        accept: The Accept header of the client, forwarded to the upstream
+
+    Returns:
+        entry: the metadata of the cached response (status, etag, last_modified, content_type, content_disposition, fetched, body, key)
+
+    Raises:
+        MirrorError: If the url is not cached and no upstream registry answered
+    '''
+    key = _cache_key(path, accept)
+    entry = _read_entry(key)
+    if entry is not None and time.time() - entry["fetched"] < MIRROR_TTL:
+        _count("hits")
+        _touch(key)
+        return dict(entry, key=key)
+
+    with _lock:
+        event = _inflight.get(key)
+        leader = event is None
+        if leader:
+            event = _inflight[key] = threading.Event()
+    if not leader:
+        _count("coalesced")
+        event.wait(UPSTREAM_TIMEOUT * len(UPSTREAM_REGISTRIES) + 1)
+        entry = _read_entry(key)
+        if entry is None:
+            raise MirrorError(f"No upstream registry answered {path}")
+        return dict(entry, key=key)
+
+    _count("misses")
+    try:
+        return dict(_refresh(key, path, accept, entry), key=key)
+    finally:
+        with _lock:
+            del _inflight[key]
+        event.set()
+
+def _timestamp(http_date):
+    try:
+        return parsedate_to_datetime(http_date).timestamp() if http_date else None
+    except (TypeError, ValueError):
+        return None
+
+def _download_name(entry, module_name, version):
+    filename = parse_options_header(entry.get("content_disposition") or "")[1].get("filename")
+    return filename or f"{module_name}_{version or 'latest'}.zip"
+
+def serve(endpoint, module_name, version=None, archive=False):
+    '''
+    Answers a /versions, /latest_version or /files request for a module or version this instance does not have from the upstream registries. Must be called inside a request context, the query string of /files requests (the compression) and the Accept header are forwarded.
+
+    Args:
+        endpoint: 'versions', 'latest_version' or 'files'
+        module_name: The name of the module
+        version: The version of the module, None for the latest version
+        archive: Whether a cached zip file is returned as an archive dictionary instead of being sent, for the ASGI app
+
+    Returns:
+        response: the upstream response (json or zip file) from the mirror cache, 304 if the client copy is still valid
+        archive: if archive is set, a dictionary with the download_name, etag, last_modified, content_type and artifact_path (the cached body) of a zip file, like prepare_module_zip returns
+        error message: if no upstream registry answered (502)
+
+    Raises:
+        None
+    '''
+    path = f"/{endpoint}/{urllib.parse.quote(module_name, safe='')}"
+    if endpoint == 'files':
+        path += f"/{urllib.parse.quote(version, safe='')}" if version else "/"
+        if request.query_string:
+            path += f"?{request.query_string.decode('latin-1')}"
+    try:
+        entry = fetch(path, request.headers.get('Accept', ''))
+    except MirrorError as e:
+        print(e)
+        return jsonify({"error": f"Module '{module_name}' could not be fetched from the upstream registries."}), 502
+
+    body_path = os.path.abspath(_body_path(entry["key"], entry))
+    etag = unquote_etag(entry["etag"])[0] if entry.get("etag") else None
+    last_modified = _timestamp(entry.get("last_modified"))
+    if entry["status"] == 200:
+        cached_response = not_modified(etag, last_modified)
+        if cached_response:
+            cached_response.vary.add('Accept')
+            return cached_response
+    if entry["status"] == 200 and endpoint == 'files':
+        if archive:
+            return {
+                "download_name": _download_name(entry, module_name, version),
+                "etag": etag,
+                "last_modified": last_modified,
+                "content_type": entry.get("content_type") or 'application/zip',
+                "compression": None,
+                "module_dir": None,
+                "artifact_path": body_path,
+            }
+        try:
+            response = send_file(body_path, mimetype=entry.get("content_type") or 'application/zip',
+                                 etag=etag or False, last_modified=last_modified)
+        except RequestedRangeNotSatisfiable as e:
+            return e.get_response()
+        if entry.get("content_disposition"):
+            response.headers['Content-Disposition'] = entry["content_disposition"]
+        response.vary.add('Accept')
+        return response
+    with open(body_path, 'rb') as file:
+        response = Response(file.read(), status=entry["status"], content_type=entry.get("content_type") or 'application/json')
+    if entry["status"] == 200:
+        add_validators(response, etag, last_modified)
+    response.vary.add('Accept')
+    return response
+
+def get_mirror_stats():
+    '''
+    Returns the counters of the mirror: cache hits, misses, revalidations, coalesced requests, upstream fetches, stale responses served, failed fetches and evictions.
+    '''
+    with _lock:
+        return dict(_stats)
@@ -2,6 +2,7 @@
 This file contains all the database model used in the application.
 '''
 
+from datetime import datetime, timezone
 from database import db
 
 class User(db.Model):
@@ -16,9 +17,67 @@ class User(db.Model):
 
 class Module(db.Model):
     module_id = db.Column(db.Integer, primary_key=True)
-    module_name = db.Column(db.String(80), nullable=False)
+    module_name = db.Column(db.String(80), nullable=False, unique=True, index=True)
     module_url = db.Column(db.String(120), nullable=False)
-    associated_user = db.Column(db.String(80), db.ForeignKey('user.email'), nullable=False)
+    associated_user = db.Column(db.String(80), db.ForeignKey('user.email'), nullable=False, index=True)
+
+    def __repr__(self):
+        return f"<module_name: {self.module_name}\nmodule_url: {self.module_url}\nassociated_user: {self.associated_user}>"
+
+class ModuleVersion(db.Model):
+    __table_args__ = (db.UniqueConstraint('module_name', 'version'),)
+
+    version_id = db.Column(db.Integer, primary_key=True)
+    module_name = db.Column(db.String(80), nullable=False, index=True)
+    version = db.Column(db.String(40), nullable=False, index=True)
+    position = db.Column(db.Integer, nullable=False)  # order of the version in versions.json
+    path = db.Column(db.String(200), nullable=True)
+    is_latest = db.Column(db.Boolean, nullable=False, default=False)
+    owner = db.Column(db.String(80), nullable=True, index=True)
+    author = db.Column(db.String(80), nullable=True)
+    description = db.Column(db.Text, nullable=True)
+    license = db.Column(db.String(40), nullable=True)
+    info = db.Column(db.Text, nullable=False)  # module_info.json of the version
+    versions_json = db.Column(db.Text, nullable=False)  # versions.json of the module
+    etag = db.Column(db.String(32), nullable=False)
+    last_modified = db.Column(db.Integer, nullable=True)
+
+    def __repr__(self):
+        return f"<module_name: {self.module_name}\nversion: {self.version}>"
+
+class Dependency(db.Model):
+    __table_args__ = (db.Index('ix_dependency_module_version', 'module_name', 'version'),)
+
+    dependency_id = db.Column(db.Integer, primary_key=True)
+    module_name = db.Column(db.String(80), nullable=False)
+    version = db.Column(db.String(40), nullable=False)
+    requirement = db.Column(db.String(120), nullable=False)  # as written in module_info.json, e.g. "test_module_6==1.0.0"
+    requires_name = db.Column(db.String(80), nullable=False, index=True)
+
+    def __repr__(self):
+        return f"<module_name: {self.module_name}\nversion: {self.version}\nrequirement: {self.requirement}>"
+
+class ApiToken(db.Model):
+    token_id = db.Column(db.Integer, primary_key=True)
+    token_hash = db.Column(db.String(64), nullable=False, unique=True, index=True)  # sha256 of the token, the token itself is never stored
+    email = db.Column(db.String(80), db.ForeignKey('user.email'), nullable=False, index=True)
+    name = db.Column(db.String(80), nullable=True)
+    created = db.Column(db.DateTime, nullable=False, default=lambda: datetime.now(timezone.utc))
+
+    def __repr__(self):
+        return f"<token_id: {self.token_id}\nemail: {self.email}\nname: {self.name}>"
+
+class IngestionJob(db.Model):
+    job_id = db.Column(db.String(32), primary_key=True)
+    kind = db.Column(db.String(20), nullable=False)  # upload or update
+    module_name = db.Column(db.String(80), nullable=False, index=True)
+    status = db.Column(db.String(20), nullable=False, index=True)  # queued, running, succeeded or failed
+    error = db.Column(db.Text, nullable=True)
+    versions = db.Column(db.Text, nullable=True)  # JSON list of the versions found by the validation
+    worker = db.Column(db.String(120), nullable=False)  # host:pid of the process running the job
+    created = db.Column(db.Float, nullable=False, index=True)
+    started = db.Column(db.Float, nullable=True)
+    finished = db.Column(db.Float, nullable=True)
 
     def __repr__(self):
-        return f"<module_name: {self.module_name}\nmodule_url: {self.module_url}\nassociated_user: {self.associated_user}>"
\ No newline at end of file
+        return f"<job_id: {self.job_id}\nmodule_name: {self.module_name}\nstatus: {self.status}>"
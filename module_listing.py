@@ -0,0 +1,85 @@
+'''
+This file contains the module listing behind /modules. Only the module_name column is queried, pages are selected with a keyset cursor (the last name of the previous page) and a prefix range on the indexed module_name column, and the serialized responses are cached until a module is uploaded or deleted. Cached pages also expire after CUL_MODULES_CACHE_SECONDS, which bounds how stale other worker processes can be.
+'''
+
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from database import db
+from models import Module
+
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+CACHE_SECONDS = float(os.environ.get("CUL_MODULES_CACHE_SECONDS", 5))
+MAX_CACHED_PAGES = 1024
+
+_lock = threading.Lock()
+_pages = OrderedDict()  # (cursor, limit, prefix) -> (generation, created, body, etag)
+_generation = 0
+
+def invalidate():
+    '''
+    Drops every cached page, called after a module is added to or removed from the database.
+    '''
+    global _generation
+    with _lock:
+        _generation += 1
+        _pages.clear()
+
+def _query_all():
+    return [name for name, in db.session.query(Module.module_name)]
+
+def _query_page(cursor, limit, prefix):
+    query = db.session.query(Module.module_name)
+    if prefix:
+        # a range instead of LIKE so that the index on module_name is used
+        query = query.filter(Module.module_name >= prefix, Module.module_name < prefix + '\U0010ffff')
+    if cursor:
+        query = query.filter(Module.module_name > cursor)
+    names = [name for name, in query.order_by(Module.module_name).limit(limit + 1)]
+    next_cursor = names[limit - 1] if len(names) > limit else None
+    return {"modules": names[:limit], "next_cursor": next_cursor}
+
+def get_listing(cursor=None, limit=None, prefix=None):
+    '''
+    Returns the serialized module listing. Without a cursor, limit or prefix this is the plain list of every module name, otherwise a page of names in alphabetical order.
+
+    Args:
+        cursor: The next_cursor of the previous page, the page starts after it
+        limit: The number of names per page, at most MAX_PAGE_SIZE
+        prefix: Only names starting with this prefix are listed
+
+    Returns:
+        listing: a (json body, etag) tuple, a page body is {"modules": [...], "next_cursor": str or null}
+
+    Raises:
+        ValueError: If the limit is not between 1 and MAX_PAGE_SIZE
+    '''
+    paged = cursor is not None or limit is not None or prefix is not None
+    if paged:
+        limit = PAGE_SIZE if limit is None else limit
+        if not 1 <= limit <= MAX_PAGE_SIZE:
+            raise ValueError(f"The limit must be between 1 and {MAX_PAGE_SIZE}.")
+    key = (cursor, limit, prefix) if paged else None
+    now = time.monotonic()
+    with _lock:
+        generation = _generation
+        cached = _pages.get(key)
+        if cached is not None and cached[0] == generation and now - cached[1] < CACHE_SECONDS:
+            _pages.move_to_end(key)
+            return cached[2], cached[3]
+
+    data = _query_page(cursor, limit, prefix) if paged else _query_all()
+    body = json.dumps(data).encode('utf-8')
+    etag = hashlib.sha256(body).hexdigest()[:32]
+    with _lock:
+        # a page built while a module was added or removed is returned but not cached
+        if generation == _generation:
+            _pages[key] = (generation, now, body, etag)
+            _pages.move_to_end(key)
+            while len(_pages) > MAX_CACHED_PAGES:
+                _pages.popitem(last=False)
+    return body, etag
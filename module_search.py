@@ -0,0 +1,123 @@
+'''
+This file contains the fuzzy module search. The module names of the registry index are preprocessed once and a trigram index is built over them, so a search only scores the names that share at least one trigram with the query instead of every module in the registry. RapidFuzz is imported on the first search, not when the app is imported.
+'''
+
+import os
+import json
+import threading
+from collections import defaultdict
+import registry_index
+
+SCORE_CUTOFF = 70
+SEARCH_LIMIT = int(os.environ.get("CUL_SEARCH_LIMIT", 50))
+# below this many modules scoring every name is cheaper than pruning with the trigram index
+PRUNE_THRESHOLD = int(os.environ.get("CUL_SEARCH_PRUNE_THRESHOLD", 2000))
+
+_lock = threading.Lock()
+_generation = None
+# (module names, preprocessed module names in the same order, trigram -> list of indexes into the names), swapped as a whole
+_index = ([], [], {})
+
+def _grams(text):
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+def _ensure_index():
+    '''
+    Rebuilds the name list and trigram index if the registry index changed since they were built.
+    '''
+    global _generation, _index
+    from rapidfuzz.utils import default_process
+    current = registry_index.generation()
+    if current == _generation:
+        return
+    with _lock:
+        if current == _generation:
+            return
+        names = sorted(registry_index.list_modules())
+        processed = [default_process(name) for name in names]
+        trigrams = defaultdict(list)
+        for index, name in enumerate(processed):
+            for gram in _grams(name):
+                trigrams[gram].append(index)
+        _index = (names, processed, dict(trigrams))
+        _generation = current
+
+def build_index():
+    '''
+    Builds the trigram index of the current registry index, called by the preloading startup. Searches build it on first use otherwise.
+    '''
+    _ensure_index()
+
+def _candidates(index, query):
+    '''
+    Returns the indexes of the names worth scoring for the query, looked up in an (names, processed names, trigrams) index. All names are returned for small registries and for queries too short to produce a trigram.
+    '''
+    names, processed, trigrams = index
+    if len(names) < PRUNE_THRESHOLD or len(query) < 3:
+        return None
+    candidates = set()
+    for gram in _grams(query):
+        candidates.update(trigrams.get(gram, ()))
+    return candidates
+
+def normalize_query(query):
+    '''
+    Returns the query the way it is scored (lowercase, punctuation replaced by spaces, trimmed). Queries with the same normalized form have the same results.
+    '''
+    from rapidfuzz.utils import default_process
+    return default_process(query or "")
+
+def find_modules(query, limit=SEARCH_LIMIT):
+    '''
+    Returns the names of the modules that fuzzily match the query, best match first.
+
+    Args:
+        query: The (partial) module name to search for
+        limit: The maximum number of matches to return
+
+    Returns:
+        matches: a list of (module name, score) tuples with a score above SCORE_CUTOFF
+
+    Raises:
+        None
+    '''
+    _ensure_index()
+    query = normalize_query(query)
+    if not query:
+        return []
+    # one snapshot, a concurrent rebuild swaps in a new index without changing this one
+    index = _index
+    names, processed, trigrams = index
+    candidates = _candidates(index, query)
+    if candidates is None:
+        choices = processed
+    else:
+        choices = {position: processed[position] for position in candidates}
+    from rapidfuzz import process
+    matches = process.extract(query, choices, processor=None, score_cutoff=SCORE_CUTOFF, limit=limit)
+    return [(names[key], score) for choice, score, key in matches if score > SCORE_CUTOFF]
+
+def search_modules(query, limit=SEARCH_LIMIT):
+    '''
+    Returns the modules that fuzzily match the query together with their versions, read from the registry index.
+
+    Args:
+        query: The (partial) module name to search for
+        limit: The maximum number of modules to return
+
+    Returns:
+        results: a list of {"module", "score", "versions"} dictionaries, best match first. versions is None if the versions.json file of the module could not be loaded
+
+    Raises:
+        None
+    '''
+    results = []
+    for module_name, score in find_modules(query, limit):
+        try:
+            data = registry_index.get_versions_data(module_name)
+        except json.JSONDecodeError:
+            data = None
+        versions = [item['version'] for item in data.get('versions', [])] if data is not None else None
+        results.append({"module": module_name, "score": round(score, 2), "versions": versions})
+    return results
@@ -0,0 +1,61 @@
+'''
+This file contains the cache of rendered pages: the module info page (and its JSON variant) of every module version and the search results of every normalized query. A cached page is stored with the validator it was rendered for, the metadata etag of the module for info pages and the generation of the registry index for search pages, so an update or upload makes the next view render it again. Repeated views cost a dictionary lookup instead of reading module_info.json and rendering a template.
+'''
+
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+
+INFO_MAX_AGE = int(os.environ.get("CUL_INFO_MAX_AGE_SECONDS", 3600))
+SEARCH_MAX_AGE = int(os.environ.get("CUL_SEARCH_MAX_AGE_SECONDS", 60))
+MAX_CACHED_PAGES = 4096
+
+_lock = threading.Lock()
+_pages = OrderedDict()  # key -> (validator, body, etag), least recently used first
+_stats = {"hits": 0, "misses": 0}
+
+def get_page(key, validator, render):
+    '''
+    Returns a rendered page, rendering it only if it is not cached for the current validator.
+
+    Args:
+        key: The key of the page, e.g. ('info', module, version, 'html')
+        validator: A value that changes whenever the page would render differently, None disables caching
+        render: A function returning the body of the page as str or bytes, or None if there is no such page
+
+    Returns:
+        page: a (body bytes, etag) tuple, or None if render returned None
+
+    Raises:
+        Exception: Whatever render raises
+    '''
+    if validator is not None:
+        with _lock:
+            cached = _pages.get(key)
+            if cached is not None and cached[0] == validator:
+                _pages.move_to_end(key)
+                _stats["hits"] += 1
+                return cached[1], cached[2]
+
+    body = render()
+    if body is None:
+        return None
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    etag = hashlib.sha256(body).hexdigest()[:32]
+    with _lock:
+        _stats["misses"] += 1
+        if validator is not None:
+            _pages[key] = (validator, body, etag)
+            _pages.move_to_end(key)
+            while len(_pages) > MAX_CACHED_PAGES:
+                _pages.popitem(last=False)
+    return body, etag
+
+def get_page_stats():
+    '''
+    Returns the number of cached pages and the hit and miss counters.
+    '''
+    with _lock:
+        return dict(_stats, pages=len(_pages))
@@ -0,0 +1,284 @@
+'''
+This file contains the process-wide index of the module metadata stored in c_cpp_modules. The versions.json and module_info.json files of every module are parsed once and kept in memory. A background thread checks modification times and reloads only the modules that changed, and upload/update/delete invalidate modules explicitly, so lookups never touch the filesystem.
+'''
+
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import namedtuple
+from metrics import record_fs_read
+
+BASE_DIR = "c_cpp_modules"
+REFRESH_INTERVAL = float(os.environ.get("CUL_INDEX_REFRESH_SECONDS", 5))
+
+# versions: parsed versions.json, or None if the file is missing
+# versions_error: the exception raised while parsing versions.json, if any
+# infos: version directory name -> parsed module_info.json, None if the file is missing, or the exception raised while parsing it
+# signature: modification times used to detect changes
+# etag: hash of the raw versions.json and module_info.json contents, used as the validator of the metadata endpoints
+# last_modified: the latest modification time of those files, in seconds
+ModuleEntry = namedtuple('ModuleEntry', ['versions', 'versions_error', 'infos', 'signature', 'etag', 'last_modified'])
+
+_lock = threading.Lock()
+_modules = {}
+_generation = 0
+_loaded = False
+_watcher_pid = None
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+def _module_signature(module_name):
+    '''
+    Returns the modification times of a module directory, its versions.json file and the module_info.json file of each version. Two equal signatures mean the module does not need to be reloaded.
+    '''
+    module_dir = os.path.join(BASE_DIR, module_name)
+    versions = []
+    for version in sorted(os.listdir(module_dir)):
+        version_dir = os.path.join(module_dir, version)
+        if os.path.isdir(version_dir):
+            versions.append((version, _mtime(version_dir), _mtime(os.path.join(version_dir, 'module_info.json'))))
+    return (_mtime(module_dir), _mtime(os.path.join(module_dir, 'versions.json')), tuple(versions))
+
+def _load_json(path):
+    '''
+    Returns the parsed contents of a json file (None if it does not exist, or the exception raised while reading it) together with its raw bytes.
+    '''
+    if not os.path.exists(path):
+        return None, b''
+    raw = b''
+    try:
+        with open(path, 'rb') as file:
+            raw = file.read()
+        record_fs_read("metadata_json")
+        return json.loads(raw), raw
+    except (json.JSONDecodeError, OSError, UnicodeDecodeError) as e:
+        return e, raw
+
+def _load_module(module_name, signature=None):
+    '''
+    Reads the metadata of a single module from disk.
+    '''
+    if signature is None:
+        signature = _module_signature(module_name)
+    module_dir = os.path.join(BASE_DIR, module_name)
+    versions, raw = _load_json(os.path.join(module_dir, 'versions.json'))
+    etag = hashlib.sha256(raw)
+    versions_error = None
+    if isinstance(versions, Exception):
+        versions, versions_error = None, versions
+    infos = {}
+    for version, version_mtime, info_mtime in signature[2]:
+        infos[version], raw = _load_json(os.path.join(module_dir, version, 'module_info.json'))
+        etag.update(version.encode('utf-8') + b'\0' + raw)
+    mtimes = [signature[1]] + [info_mtime for version, version_mtime, info_mtime in signature[2]]
+    last_modified = max(m for m in mtimes if m is not None) // 10**9 if any(m is not None for m in mtimes) else None
+    return ModuleEntry(versions, versions_error, infos, signature, etag.hexdigest()[:32], last_modified)
+
+def _list_module_dirs():
+    if not os.path.isdir(BASE_DIR):
+        return []
+    return [d for d in os.listdir(BASE_DIR) if os.path.isdir(os.path.join(BASE_DIR, d))]
+
+def refresh():
+    '''
+    Checks every module for changes and reloads the ones whose signature differs from the indexed one. Modules that were removed from disk are dropped from the index.
+
+    Args:
+        None
+
+    Returns:
+        changed: True if anything in the index changed
+
+    Raises:
+        None
+    '''
+    global _generation, _loaded
+    changed = False
+    seen = set()
+    for module_name in _list_module_dirs():
+        seen.add(module_name)
+        try:
+            signature = _module_signature(module_name)
+            entry = _modules.get(module_name)
+            if entry is not None and entry.signature == signature:
+                continue
+            new_entry = _load_module(module_name, signature)
+        except OSError:
+            # the module disappeared while it was being read, the next refresh will drop it
+            continue
+        with _lock:
+            _modules[module_name] = new_entry
+            changed = True
+    with _lock:
+        for module_name in [m for m in _modules if m not in seen]:
+            del _modules[module_name]
+            changed = True
+        if changed:
+            _generation += 1
+        _loaded = True
+    return changed
+
+def invalidate(module_name=None):
+    '''
+    Reloads the specified module, or the whole index if no module is given. Called after a module is uploaded, updated or deleted so that the change is visible immediately instead of after the next background refresh.
+
+    Args:
+        module_name: The name of the module, or None to reload every module
+
+    Returns:
+        None
+
+    Raises:
+        None
+    '''
+    global _generation
+    if module_name is None:
+        with _lock:
+            _modules.clear()
+        refresh()
+        return
+    module_dir = os.path.join(BASE_DIR, module_name)
+    entry = None
+    if os.path.isdir(module_dir):
+        try:
+            entry = _load_module(module_name)
+        except OSError:
+            entry = None
+    with _lock:
+        if entry is None:
+            _modules.pop(module_name, None)
+        else:
+            _modules[module_name] = entry
+        _generation += 1
+
+def _watch():
+    while True:
+        time.sleep(REFRESH_INTERVAL)
+        try:
+            refresh()
+        except Exception as e:
+            print(f"Error refreshing the registry index: {e}")
+
+def _ensure_loaded():
+    '''
+    Loads the index on first use and starts the background refresh thread. The thread is restarted in forked worker processes, since threads do not survive a fork.
+    '''
+    global _watcher_pid
+    if _loaded and _watcher_pid == os.getpid():
+        return
+    with _lock:
+        start_watcher = _watcher_pid != os.getpid()
+        _watcher_pid = os.getpid()
+    if not _loaded:
+        refresh()
+    if start_watcher and REFRESH_INTERVAL > 0:
+        threading.Thread(target=_watch, name="registry-index-refresh", daemon=True).start()
+
+def generation():
+    '''
+    Returns a counter that changes every time the index changes. Caches built on top of the index use it to detect that they are stale.
+    '''
+    _ensure_loaded()
+    return _generation
+
+def list_modules():
+    '''
+    Returns the names of all modules in the registry.
+    '''
+    _ensure_loaded()
+    return list(_modules)
+
+def module_exists(module_name):
+    '''
+    Returns True if the module directory exists.
+    '''
+    _ensure_loaded()
+    return module_name in _modules
+
+def version_exists(module_name, version):
+    '''
+    Returns True if the version directory of the module exists.
+    '''
+    _ensure_loaded()
+    entry = _modules.get(module_name)
+    return entry is not None and version in entry.infos
+
+def split_path(rel_path):
+    '''
+    Splits a path from versions.json (e.g. "test_module_7/1.0.1") into a (module name, version) pair. Returns None if the path does not point to a version directory.
+    '''
+    if not rel_path:
+        return None
+    parts = os.path.normpath(rel_path).replace('\\', '/').split('/')
+    if len(parts) != 2:
+        return None
+    return parts[0], parts[1]
+
+def get_versions_data(module_name):
+    '''
+    Returns the parsed versions.json file of the specified module.
+
+    Args:
+        module_name: The name of the module
+
+    Returns:
+        versions data: the parsed versions.json, or None if the module or its versions.json file does not exist
+
+    Raises:
+        json.JSONDecodeError: If the versions.json file could not be decoded
+    '''
+    _ensure_loaded()
+    entry = _modules.get(module_name)
+    if entry is None:
+        return None
+    if entry.versions_error is not None:
+        raise entry.versions_error
+    return entry.versions
+
+def get_module_info(module_name, version):
+    '''
+    Returns the parsed module_info.json file of the specified module version.
+
+    Args:
+        module_name: The name of the module
+        version: The version of the module
+
+    Returns:
+        module info: the parsed module_info.json, or None if the version or its module_info.json file does not exist
+
+    Raises:
+        json.JSONDecodeError: If the module_info.json file could not be decoded
+    '''
+    _ensure_loaded()
+    entry = _modules.get(module_name)
+    if entry is None:
+        return None
+    info = entry.infos.get(version)
+    if isinstance(info, Exception):
+        raise info
+    return info
+
+def get_validators(module_name):
+    '''
+    Returns the cache validators of the metadata of the specified module.
+
+    Args:
+        module_name: The name of the module
+
+    Returns:
+        validators: an (etag, last modified timestamp) tuple, (None, None) if the module does not exist
+
+    Raises:
+        None
+    '''
+    _ensure_loaded()
+    entry = _modules.get(module_name)
+    if entry is None:
+        return None, None
+    return entry.etag, entry.last_modified
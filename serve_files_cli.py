@@ -1,17 +1,215 @@
 import os
 import json
-import io
+import zlib
 import zipfile
-from flask import send_file, jsonify
+import threading
+from collections import deque, OrderedDict
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, Future
+from flask import send_file, jsonify, request, Response
+from werkzeug.exceptions import RequestedRangeNotSatisfiable
+from werkzeug.utils import safe_join
+from artifact_cache import get_artifact, get_tree_validators, lookup_artifact, get_manifest, get_file_digest, get_delta_artifact, LAYOUT_VERSION, DELTA_VERSION
+from http_cache import not_modified, add_validators
+from zip_stream import stream_directory_zip, ZipStreamWriter, open_raw_entries, normalized_mode, FIXED_DATE_TIME
+from compression import negotiate_compression, BUNDLE_COMPRESSION
+import registry_index
+from metrics import record_fs_read
+import blob_store
+import mirror
 
 BASE_DIR = "c_cpp_modules"
+# "cache" serves prebuilt archives from the artifact cache, "stream" zips on the fly with bounded memory
+SERVE_MODE = os.environ.get("CUL_SERVE_MODE", "cache")
+BUNDLE_WORKERS = int(os.environ.get("CUL_BUNDLE_WORKERS", 4))
+MANIFEST_CACHE_SIZE = 256  # version manifests kept, keyed by module, version and tree hash
 
-def serve_latest_version(module_name):
+_executor = None
+_manifest_lock = threading.Lock()
+_manifests = OrderedDict()  # (module name, version, tree hash[, backend]) -> files of the manifest, least recently used first
+
+def prepare_module_zip(module_name, version, module_dir):
+    '''
+    Decides how the zip archive of a version directory is sent, using the serve mode configured for this deployment and the compression mode negotiated with the client. Precompressed archives and range requests are always sent from the artifact cache (the archive is built here if it is missing), whose archive has the same bytes as the streamed one. Must be called inside a request context, it is shared by the Flask app and the ASGI app.
+
+    Args:
+        module_name: The name of the module
+        version: The version of the module
+        module_dir: The path of the version directory
+
+    Returns:
+        archive: a dictionary with the download_name, etag, last_modified, compression, module_dir and artifact_path (None if the archive is streamed)
+        304 response: if the client already has the current archive
+        error message: if the client asked for an invalid compression mode
+
+    Raises:
+        OSError: If the version directory cannot be read
+    '''
+    try:
+        compression = negotiate_compression()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    # Answer conditional requests before anything is zipped, every compression mode and archive layout is a different representation
+    tree_hash, last_modified = get_tree_validators(module_dir)
+    etag = f"{tree_hash}-{compression.name}-v{LAYOUT_VERSION}"
+    cached_response = not_modified(etag, last_modified)
+    if cached_response:
+        cached_response.vary.add('Accept')
+        return cached_response
+
+    artifact_path = None
+    if SERVE_MODE != "stream" or compression.precompressed or request.range is not None:
+        # The cached archive is only zipped when the version directory changes
+        artifact_path = os.path.abspath(get_artifact(module_name, version, module_dir, tree_hash, compression))
+    return {
+        "download_name": f"{module_name}_{version}.zip",
+        "etag": etag,
+        "last_modified": last_modified,
+        "compression": compression,
+        "module_dir": module_dir,
+        "artifact_path": artifact_path,
+    }
+
+def send_module_zip(module_name, version, module_dir):
+    '''
+    Sends the zip archive of a version directory as decided by prepare_module_zip, so an interrupted download can be resumed with Range/If-Range and a large archive can be fetched in parallel ranges.
+
+    Args:
+        module_name: The name of the module
+        version: The version of the module
+        module_dir: The path of the version directory
+
+    Returns:
+        zip file: the archive as an attachment, either sent from the artifact cache or streamed chunk by chunk
+        206 response: the requested byte ranges of the cached archive
+        416 response: if the requested range lies outside the archive
+        304 response: if the client already has the current archive
+        error message: if the client asked for an invalid compression mode
+
+    Raises:
+        OSError: If the version directory cannot be read
+    '''
+    archive = prepare_module_zip(module_name, version, module_dir)
+    if not isinstance(archive, dict):
+        return archive
+
+    if archive['artifact_path'] is None:
+        compression = archive['compression']
+        response = Response(stream_directory_zip(module_dir, compression.compress_type, compression.level), mimetype='application/zip',
+                            headers={"Content-Disposition": f"attachment; filename={archive['download_name']}"})
+        response = add_validators(response, archive['etag'], archive['last_modified'])
+        response.accept_ranges = "bytes"
+    else:
+        # send_file answers Range and If-Range with 206/200
+        try:
+            response = send_file(archive['artifact_path'], as_attachment=True, download_name=archive['download_name'],
+                                 etag=archive['etag'], last_modified=archive['last_modified'])
+        except RequestedRangeNotSatisfiable as e:
+            return e.get_response()
+    response.vary.add('Accept')
+    return response
+
+def _compress_file(file_path, arcname, compression):
+    '''
+    Reads and compresses a single file. Runs on the bundle thread pool, zlib releases the GIL while compressing.
+    '''
+    stat = os.stat(file_path)
+    with open(file_path, 'rb') as file:
+        data = file.read()
+    record_fs_read("archive_source")
+    compressed = data
+    if compression.compress_type == zipfile.ZIP_DEFLATED:
+        compressor = zlib.compressobj(compression.level, zlib.DEFLATED, -15)
+        compressed = compressor.compress(data) + compressor.flush()
+    return [(arcname, compressed, zlib.crc32(data), len(data), compression.compress_type, FIXED_DATE_TIME, normalized_mode(stat.st_mode))]
+
+def _copy_artifact_entries(raw_entries, prefix):
+    '''
+    Yields the entries of a cached archive as they are, one at a time, so that they are copied into the bundle without being compressed again.
+    '''
+    record_fs_read("artifact")
+    for info, raw in raw_entries:
+        yield (os.path.join(prefix, info.filename), raw, info.CRC, info.file_size, info.compress_type, info.date_time, info.external_attr >> 16)
+
+def _bundle_tasks(nodes, compression):
+    '''
+    Yields, in archive order, the entries of every version whose archive is cached with the requested compression, or one task per file for the other versions. A cached archive is opened as soon as it is looked up, so that an eviction afterwards cannot take it away mid-bundle. If it is already gone, its files are compressed instead.
+    '''
+    for module_name, version in nodes:
+        module_dir = os.path.join(BASE_DIR, module_name, version)
+        prefix = os.path.join(module_name, version)
+        artifact_path = lookup_artifact(module_name, version, module_dir, compression=compression)
+        raw_entries = None
+        if artifact_path:
+            try:
+                raw_entries = open_raw_entries(artifact_path)
+            except (OSError, zipfile.BadZipFile) as e:
+                print(f"Compressing the files of '{module_name}' version {version}, its cached archive cannot be read: {e}")
+        if raw_entries is not None:
+            yield _copy_artifact_entries(raw_entries, prefix)
+            continue
+        for root, dirs, files in os.walk(module_dir):
+            for file in files:
+                file_path = os.path.join(root, file)
+                yield partial(_compress_file, file_path, os.path.join(prefix, os.path.relpath(file_path, module_dir)), compression)
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=BUNDLE_WORKERS, thread_name_prefix="bundle")
+    return _executor
+
+def _stream_combined_zip(nodes, compression):
+    '''
+    Yields one zip archive holding the files of several module versions, each under <module>/<version>/. Files are read and compressed on the bundle thread pool while earlier entries are being sent, at most twice as many tasks as workers are in flight so that memory stays bounded. Entries of cached archives are read one at a time when their turn comes.
+    '''
+    executor = _get_executor()
+    writer = ZipStreamWriter()
+    pending = deque()
+    tasks = _bundle_tasks(nodes, compression)
+    for task in tasks:
+        pending.append(executor.submit(task) if isinstance(task, partial) else task)
+        if len(pending) >= BUNDLE_WORKERS * 2:
+            yield from _write_entries(writer, pending.popleft())
+    while pending:
+        yield from _write_entries(writer, pending.popleft())
+    yield writer.finish()
+
+def _write_entries(writer, item):
+    entries = item.result() if isinstance(item, Future) else item
+    for entry in entries:
+        yield writer.add_precompressed(*entry)
+
+def send_combined_zip(nodes, download_name):
+    '''
+    Sends the files of several module versions as a single zip archive, streamed entry by entry. Every version is stored under <module>/<version>/ inside the archive. Versions that are already in the artifact cache with the negotiated compression are copied from their cached archive, the other files are read and compressed concurrently.
+
+    Args:
+        nodes: A list of (module name, version) tuples, every version directory must exist
+        download_name: The file name suggested to the client
+
+    Returns:
+        zip file: the combined archive as an attachment
+        error message: if the client asked for an invalid compression mode
+
+    Raises:
+        None
+    '''
+    try:
+        compression = negotiate_compression(BUNDLE_COMPRESSION)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return Response(_stream_combined_zip(nodes, compression), mimetype='application/zip',
+                    headers={"Content-Disposition": f"attachment; filename={download_name}"})
+
+def serve_latest_version(module_name, send=send_module_zip):
     '''
     Sends the latest version of the specified module as a zip file. If the module is not found, returns an error message. If the versions.json file is missing, returns an error message. If the latest module path is missing in the versions.json file, returns an error message. If the latest module path does not exist, returns an error message. If any error occurs during the process, returns an error message.
 
     Args:
         module_name: The name of the module
+        send: The function answering with the archive of the version, the ASGI app passes prepare_module_zip
     
     Returns:
         zip file: if the latest version of the module is found
@@ -21,53 +219,45 @@ def serve_latest_version(module_name):
         json.JSONDecodeError: If an error occurs while decoding the versions.json file
         Exception: If any other error occurs
     '''
-    versions_file_path = os.path.join(BASE_DIR, module_name, 'versions.json')
-    
-    # Check if the module directory exists
-    if not os.path.exists(os.path.join(BASE_DIR, module_name)):
+    # Check if the module directory exists, a mirror asks its upstream registries for modules it does not have
+    if not registry_index.module_exists(module_name):
+        if mirror.ENABLED:
+            # the ASGI app sends mirrored archives itself, like the archives of prepare_module_zip
+            return mirror.serve('files', module_name, archive=send is prepare_module_zip)
         return jsonify({"error": f"Module '{module_name}' not found."}), 404
 
-    # Check if the versions.json file exists
-    if not os.path.exists(versions_file_path):
-        return jsonify({"error": "The versions.json file is missing for the specified module."}), 404
-
     try:
-        with open(versions_file_path, 'r') as file:
-            data = json.load(file)
-            latest_path = data.get('latest_path')
-            version = data.get('latest')
-
-            if latest_path:
-                module_dir = os.path.join(BASE_DIR, latest_path)
-
-                if not os.path.exists(module_dir):
-                    return jsonify({"error": f"The latest module path '{latest_path}' does not exist."}), 404
-
-                # Create an in-memory zip file
-                zip_stream = io.BytesIO()
-                with zipfile.ZipFile(zip_stream, 'w') as zipf:
-                    for root, dirs, files in os.walk(module_dir):
-                        for file in files:
-                            file_path = os.path.join(root, file)
-                            zipf.write(file_path, os.path.relpath(file_path, module_dir))
-
-                zip_stream.seek(0)  # Go back to the start of the stream
-                return send_file(zip_stream, as_attachment=True, download_name=f"{module_name}_{version}.zip")
-            else:
-                return jsonify({"error": "The 'latest_path' key is missing in the versions.json file."}), 500
+        data = registry_index.get_versions_data(module_name)
+        # Check if the versions.json file exists
+        if data is None:
+            return jsonify({"error": "The versions.json file is missing for the specified module."}), 404
+
+        latest_path = data.get('latest_path')
+        version = data.get('latest')
+
+        if latest_path:
+            latest = registry_index.split_path(latest_path)
+            if not latest or not registry_index.version_exists(*latest):
+                return jsonify({"error": f"The latest module path '{latest_path}' does not exist."}), 404
+
+            module_dir = os.path.join(BASE_DIR, latest_path)
+            return send(module_name, version, module_dir)
+        else:
+            return jsonify({"error": "The 'latest_path' key is missing in the versions.json file."}), 500
     except json.JSONDecodeError:
         return jsonify({"error": "Error decoding the versions.json file."}), 500
     except Exception as e:
         print(f"An error occurred: {e}")
         return jsonify({"error": "An error occurred."}), 500
 
-def serve_specified_version(module_name, version):
+def serve_specified_version(module_name, version, send=send_module_zip):
     '''
     Sends the specified version of the specified module as a zip file. If the module is not found, returns an error message. If the specified version path does not exist, returns an error message. If any error occurs during the process, returns an error message.
 
     Args:
         module_name: The name of the module
         version: The version of the module
+        send: The function answering with the archive of the version, the ASGI app passes prepare_module_zip
 
     Returns:
         zip file: if the specified version of the module is found
@@ -77,24 +267,189 @@ def serve_specified_version(module_name, version):
         Exception: If any error occurs
     '''
     module_dir = os.path.join(BASE_DIR, module_name, version)
-    module_dir_wo_version = os.path.join(BASE_DIR, module_name)
-    # Check if the module directory exists
-    if not os.path.exists(module_dir_wo_version):
+    # Check if the module directory exists, a mirror asks its upstream registries for modules and versions it does not have
+    if not registry_index.version_exists(module_name, version) and mirror.ENABLED:
+        return mirror.serve('files', module_name, version, archive=send is prepare_module_zip)
+    if not registry_index.module_exists(module_name):
         return jsonify({"error": f"Module '{module_name}' not found."}), 404
-    if not os.path.exists(module_dir):
+    if not registry_index.version_exists(module_name, version):
         return jsonify({"error": f"Module '{module_name}' with version {version} not found."}), 404
 
     try:
-        # Create an in-memory zip file
-        zip_stream = io.BytesIO()
-        with zipfile.ZipFile(zip_stream, 'w') as zipf:
-            for root, dirs, files in os.walk(module_dir):
-                for file in files:
-                    file_path = os.path.join(root, file)
-                    zipf.write(file_path, os.path.relpath(file_path, module_dir))
-        
-        zip_stream.seek(0)  # Go back to the start of the stream
-        return send_file(zip_stream, as_attachment=True, download_name=f"{module_name}_{version}.zip")
+        return send(module_name, version, module_dir)
+    except Exception as e:
+        print(f"Error: {e}")
+        return jsonify({"error": "Error occurred while serving files."}), 500
+
+def _cached_files(key, build):
+    '''
+    Returns the files of a version manifest from the manifest cache, building them with build() on a miss. The key holds the tree hash, so a changed version gets a new entry.
+    '''
+    with _manifest_lock:
+        files = _manifests.get(key)
+        if files is not None:
+            _manifests.move_to_end(key)
+            return files
+    files = build()
+    with _manifest_lock:
+        _manifests[key] = files
+        while len(_manifests) > MANIFEST_CACHE_SIZE:
+            _manifests.popitem(last=False)
+    return files
+
+def _version_manifest(module_name, version):
+    '''
+    Returns the (tree hash, files) manifest of a version, files maps the relative path to (size, sha256, path of the file in the version directory). The version directory is hashed, only files that changed since the last request are read, so the manifest always describes what /files serves.
+    '''
+    module_dir = os.path.join(BASE_DIR, module_name, version)
+    tree_hash, files = get_manifest(module_dir)
+    # safe_join guards against paths leaving the version directory
+    return tree_hash, _cached_files((module_name, version, tree_hash),
+                                    lambda: {path: (size, sha256, safe_join(module_dir, path)) for path, (size, sha256, executable) in files.items()})
+
+def _stored_file(module_name, version, file_path):
+    '''
+    Returns the (sha256, blob path) of a file from the manifest stored by the blobs backend, or None if the backend is not used, the file is not in the stored manifest or its entry is no longer current.
+    '''
+    if blob_store.STORAGE_BACKEND != "blobs":
+        return None
+    manifest = blob_store.read_manifest(module_name, version)
+    if manifest is None:
+        return None
+    items = _cached_files((module_name, version, manifest['tree_hash'], 'blobs'), lambda: {item['path']: item for item in manifest['files']})
+    item = items.get(file_path)
+    if item is None or not blob_store.is_current(module_name, version, item):
+        return None
+    return item['sha256'], blob_store.blob_path(item['sha256'], item['executable'])
+
+def _version_file(module_name, version, file_path):
+    '''
+    Returns the (sha256, path to read the file from) of a single file of a version, or None if the version has no such file. With the blobs backend a current entry of the stored manifest is used, otherwise only the requested file is stat'ed instead of walking the whole version.
+    '''
+    stored = _stored_file(module_name, version, file_path)
+    if stored is not None:
+        return stored
+    module_dir = os.path.join(BASE_DIR, module_name, version)
+    # safe_join guards against paths leaving the version directory
+    path = safe_join(module_dir, file_path)
+    if path is None or not os.path.isfile(path):
+        return None
+    return get_file_digest(module_dir, file_path)[1], path
+
+def serve_version_manifest(module_name, version):
+    '''
+    Returns the manifest of a version: the path, size and sha256 of every file in it, so that the CLI can fetch single files and check their integrity without downloading the archive.
+
+    Args:
+        module_name: The name of the module
+        version: The version of the module
+
+    Returns:
+        manifest: {"module", "version", "tree_hash", "files": [{"path", "size", "sha256"}]}, with the tree hash as etag
+        304 response: if the client already has the current manifest
+        error message: if the module or version is not found, or the files cannot be read
+
+    Raises:
+        None
+    '''
+    if not registry_index.module_exists(module_name):
+        return jsonify({"error": f"Module '{module_name}' not found."}), 404
+    if not registry_index.version_exists(module_name, version):
+        return jsonify({"error": f"Module '{module_name}' with version {version} not found."}), 404
+
+    try:
+        tree_hash, files = _version_manifest(module_name, version)
+    except OSError as e:
+        print(f"Error: {e}")
+        return jsonify({"error": "Error occurred while reading the files."}), 500
+    cached_response = not_modified(tree_hash)
+    if cached_response:
+        return cached_response
+    return add_validators(jsonify({
+        "module": module_name,
+        "version": version,
+        "tree_hash": tree_hash,
+        "files": [{"path": path, "size": size, "sha256": sha256} for path, (size, sha256, file_path) in files.items()],
+    }), tree_hash)
+
+def serve_version_file(module_name, version, file_path):
+    '''
+    Sends a single file of a version, e.g. a header or module_info.json, without building an archive. With the blobs backend the file is read from its blob. The file is sent with send_file, which uses the server's sendfile support where available, supports Range requests and uses the file's sha256 as etag. Only the requested file is stat'ed, the rest of the version is not walked.
+
+    Args:
+        module_name: The name of the module
+        version: The version of the module
+        file_path: The path of the file relative to the version directory, with / separators
+
+    Returns:
+        file: the contents of the file
+        206/304/416 response: for range and conditional requests
+        error message: if the module, version or file is not found, or the file cannot be read
+
+    Raises:
+        None
+    '''
+    if not registry_index.module_exists(module_name):
+        return jsonify({"error": f"Module '{module_name}' not found."}), 404
+    if not registry_index.version_exists(module_name, version):
+        return jsonify({"error": f"Module '{module_name}' with version {version} not found."}), 404
+
+    try:
+        found = _version_file(module_name, version, file_path)
+        if found is None:
+            return jsonify({"error": f"File '{file_path}' not found in module '{module_name}' version {version}."}), 404
+        sha256, path = found
+        record_fs_read("single_file")
+        return send_file(os.path.abspath(path), download_name=os.path.basename(file_path), etag=sha256)
+    except RequestedRangeNotSatisfiable as e:
+        return e.get_response()
+    except OSError as e:
+        print(f"Error: {e}")
+        return jsonify({"error": "Error occurred while serving the file."}), 500
+
+def serve_version_delta(module_name, from_version, to_version):
+    '''
+    Sends the archive that upgrades a module from from_version to to_version: only the files that were added or changed, plus a .cul_delta.json entry listing the added, changed, removed and executable paths. A file whose executable bit changed is sent as changed. Clients apply it by extracting the archive over their copy of from_version (with the unix modes of the entries) and deleting the removed paths.
+
+    Args:
+        module_name: The name of the module
+        from_version: The version the client has
+        to_version: The version the client wants
+
+    Returns:
+        zip file: the delta archive as an attachment, with Range support
+        304 response: if the client already has the current delta
+        error message: if the module or a version is not found, the compression mode is invalid or any error occurs during the process
+
+    Raises:
+        None
+    '''
+    if not registry_index.module_exists(module_name):
+        return jsonify({"error": f"Module '{module_name}' not found."}), 404
+    for version in (from_version, to_version):
+        if not registry_index.version_exists(module_name, version):
+            return jsonify({"error": f"Module '{module_name}' with version {version} not found."}), 404
+    try:
+        compression = negotiate_compression()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    try:
+        from_hash = get_tree_validators(os.path.join(BASE_DIR, module_name, from_version))[0]
+        to_hash, last_modified = get_tree_validators(os.path.join(BASE_DIR, module_name, to_version))
+        etag = f"{from_hash[:32]}{to_hash[:32]}-{compression.name}-v{LAYOUT_VERSION}.{DELTA_VERSION}"
+        cached_response = not_modified(etag, last_modified)
+        if cached_response:
+            cached_response.vary.add('Accept')
+            return cached_response
+
+        artifact_path, summary = get_delta_artifact(module_name, from_version, to_version, compression)
+        response = send_file(os.path.abspath(artifact_path), as_attachment=True, etag=etag, last_modified=last_modified,
+                             download_name=f"{module_name}_{from_version}_to_{to_version}.zip")
+        response.vary.add('Accept')
+        return response
+    except RequestedRangeNotSatisfiable as e:
+        return e.get_response()
     except Exception as e:
         print(f"Error: {e}")
-        return jsonify({"error": "Error occurred while serving files."}), 500
\ No newline at end of file
+        return jsonify({"error": "Error occurred while serving files."}), 500
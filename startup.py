@@ -0,0 +1,75 @@
+'''
+This file contains the startup phases of a production deployment. The schema is created and the registry index, the artifact cache index and the search index are loaded once, in the parent process of a preforking server (gunicorn --preload, see wsgi.py), so that forked workers share these structures copy-on-write instead of every worker reading c_cpp_modules again. Every phase is timed, the times are printed and exported at /metrics.
+'''
+
+import os
+import gc
+import time
+from contextlib import contextmanager
+from database import db
+from db_config import CREATE_SCHEMA, ensure_schema
+import registry_index
+import artifact_cache
+import module_search
+
+PRELOAD_ARCHIVES = os.environ.get("CUL_PRELOAD_ARCHIVES", "0") == "1"
+
+_phases = {}  # phase -> seconds, in the order the phases ran
+
+@contextmanager
+def phase(name):
+    '''
+    Times a startup phase.
+    '''
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _phases[name] = time.perf_counter() - start
+
+def preload(app):
+    '''
+    Runs the startup phases: schema creation (unless CUL_CREATE_SCHEMA=0), the registry index, the artifact cache index, the search index and, with CUL_PRELOAD_ARCHIVES=1, the archives of every version. Database connections opened meanwhile are closed and the loaded objects are frozen out of the garbage collector, so that forked workers neither share connections nor copy the pages of the preloaded data when the collector runs.
+
+    Args:
+        app: The flask app
+
+    Returns:
+        phases: a dictionary of phase -> seconds
+
+    Raises:
+        Exception: If the schema cannot be created
+    '''
+    if CREATE_SCHEMA:
+        with phase("schema"):
+            ensure_schema(app)
+    with phase("registry_index"):
+        # refresh instead of a lookup, so that no watcher thread is started in the parent, every worker starts its own
+        registry_index.refresh()
+    with phase("artifact_index"):
+        artifact_cache.load_index()
+    with phase("search_index"):
+        module_search.build_index()
+    if PRELOAD_ARCHIVES:
+        with phase("archives"):
+            for module_name in registry_index.list_modules():
+                artifact_cache.prebuild_module(module_name)
+    with app.app_context():
+        db.engine.dispose()
+    with phase("gc_freeze"):
+        gc.collect()
+        gc.freeze()
+    return dict(_phases)
+
+def get_startup_times():
+    '''
+    Returns the duration of every startup phase that ran in this process, in seconds.
+    '''
+    return dict(_phases)
+
+def report():
+    '''
+    Prints the startup phases and their total duration.
+    '''
+    phases = ", ".join(f"{name} {seconds * 1000:.0f} ms" for name, seconds in _phases.items())
+    print(f"Startup finished in {sum(_phases.values()) * 1000:.0f} ms ({phases})")
@@ -0,0 +1,55 @@
+'''
+This file contains the helpers used to parse requirement strings such as "test_module_4==1.0.0" and to compare module versions (x.y.z).
+'''
+
+import re
+
+OPERATORS = ('==', '!=', '>=', '<=', '>', '<')
+_REQUIREMENT = re.compile(r'^\s*([^=!<>\s]+)\s*(?:(==|!=|>=|<=|>|<)\s*([^\s]+))?\s*$')
+
+def parse_requirement(requirement):
+    '''
+    Splits a requirement string into the module name, the operator and the version. A bare module name means any version.
+
+    Args:
+        requirement: A string such as "test_module_4", "test_module_4==1.0.0" or "test_module_4>=1.0"
+
+    Returns:
+        requirement: a (module name, operator, version) tuple, operator and version are None for a bare module name
+
+    Raises:
+        ValueError: If the requirement cannot be parsed
+    '''
+    match = _REQUIREMENT.match(requirement or '')
+    if not match:
+        raise ValueError(f"Invalid requirement '{requirement}'.")
+    return match.group(1), match.group(2), match.group(3)
+
+def version_key(version):
+    '''
+    Returns a sort key for a version string, numeric parts compare as numbers so that 1.0.10 sorts after 1.0.9.
+    '''
+    return tuple((0, int(part), '') if part.isdigit() else (1, 0, part) for part in str(version).split('.'))
+
+def satisfies(version, operator, target):
+    '''
+    Returns True if the version satisfies the constraint given by operator and target. A missing operator matches any version.
+    '''
+    if operator is None:
+        return True
+    a, b = version_key(version), version_key(target)
+    return {
+        '==': a == b,
+        '!=': a != b,
+        '>=': a >= b,
+        '<=': a <= b,
+        '>': a > b,
+        '<': a < b,
+    }[operator]
+
+def best_match(versions, operator, target):
+    '''
+    Returns the highest version out of versions that satisfies the constraint, or None if none does.
+    '''
+    matching = [v for v in versions if satisfies(v, operator, target)]
+    return max(matching, key=version_key) if matching else None
@@ -1,10 +1,19 @@
-from flask import request, render_template, redirect, url_for, session
+from flask import request, render_template, redirect, url_for, session, current_app, jsonify, Response
 from werkzeug.security import check_password_hash, generate_password_hash
 from database import db
 from models import User, Module
 import os
 import json
-from rapidfuzz import process
+from module_search import search_modules, normalize_query
+from artifact_cache import invalidate_module
+from ingestion import submit_upload, submit_update, module_name_from_url, IngestionError
+import metadata_store
+import module_listing
+import blob_store
+from auth import current_user_email, load_profile, invalidate_profile, create_token, revoke_token, revoke_all_tokens
+import registry_index
+from page_cache import get_page, INFO_MAX_AGE, SEARCH_MAX_AGE
+from http_cache import not_modified, add_validators
 
 BASE_DIR = "c_cpp_modules"
 
@@ -25,12 +34,12 @@ def login_webui():
     email = request.form.get('email')
     password = request.form.get('password')
 
-    user = User.query.filter_by(email=email).first()
-    if not user or not check_password_hash(user.password, password):
+    password_hash = db.session.query(User.password).filter_by(email=email).scalar()
+    if not password_hash or not check_password_hash(password_hash, password):
         return render_template('index.html', error="Invalid email or password")
 
     session['email'] = email
-    return redirect(url_for('main_page'))
+    return redirect(url_for('registry.main_page'))
 
 def signup_user_webui():
     '''
@@ -65,11 +74,11 @@ def signup_user_webui():
 
     db.session.add(user)
     db.session.commit()
-    return redirect(url_for('index'))
+    return redirect(url_for('registry.index'))
 
 def change_password_webui():
     '''
-    Changes the password of the user if the old password is correct. If the old password is incorrect, returns an error message.
+    Changes the password of the user if the old password is correct and revokes all of their API tokens, so that a leaked token does not survive the password change. If the old password is incorrect, returns an error message.
 
     Args:
         None
@@ -81,19 +90,47 @@ def change_password_webui():
     Raises:
         None
     '''
-    profile = User.query.filter_by(email=session.get('email')).first()
+    email = current_user_email()
+    user = User.query.filter_by(email=email).first()
+    if not user:
+        return redirect(url_for('registry.index'))
     old_password = request.form.get('old_password')
     new_password = request.form.get('new_password')
-    is_old_password_correct = check_password_hash(profile.password, old_password)
+    profile, modules = load_profile(email)
+    is_old_password_correct = check_password_hash(user.password, old_password)
     if not is_old_password_correct:
-        return render_template('profile.html', error="Old password is incorrect",profile=profile)
-    User.query.filter_by(email=session.get('email')).update({'password': generate_password_hash(new_password)})
+        return render_template('profile.html', error="Old password is incorrect", profile=profile, modules=modules)
+    user.password = generate_password_hash(new_password)
+    revoked = revoke_all_tokens(email)
     db.session.commit()
-    return render_template('profile.html', success="Password changed successfully", profile=profile)
+    success = "Password changed successfully" + (f", {revoked} API token(s) revoked" if revoked else "")
+    return render_template('profile.html', success=success, profile=profile, modules=modules)
+
+def _render_search_results(module_name_input):
+    '''
+    Renders the main page with the search results of a query.
+    '''
+    # Fuzzy search over the indexed module names, versions come from the registry index
+    search_results = search_modules(module_name_input)
+    
+    module_versions_dict = {}  # Dictionary to store module names and their versions
+
+    if search_results:
+        error = None
+        for result in search_results:
+            if result['versions'] is not None:
+                module_versions_dict[result['module']] = result['versions']
+            else:
+                error = "Some modules were found, but versions could not be loaded."
+
+        return render_template('main_page.html', module_versions=module_versions_dict, error=error)
+    else:
+        error = "No matching modules found."
+        return render_template('main_page.html', error=error)
 
 def main_page_webui():
     '''
-    Returns the main page if the user is logged in, else redirects to the index page
+    Returns the main page if the user is logged in, else redirects to the index page. Search results are rendered once per normalized query and served from the page cache until the registry changes.
 
     Args:
         None
@@ -105,38 +142,19 @@ def main_page_webui():
     Raises:
         None
     '''
-    if not session.get('email'):
-        return redirect(url_for('index'))
+    if not current_user_email():
+        return redirect(url_for('registry.index'))
     
     if request.method == 'POST':
         module_name_input = request.form.get('module_name')
-        
-        # List all directories (module names) from BASE_DIR
-        available_modules = [d for d in os.listdir(BASE_DIR) if os.path.isdir(os.path.join(BASE_DIR, d))]
-        
-        # Perform fuzzy search to get all matches
-        all_matches = process.extract(module_name_input, available_modules, limit=None)
-        
-        # Filter matches with a similarity score above 70
-        matched_modules = [match[0] for match in all_matches if match[1] > 70]
-        
-        module_versions_dict = {}  # Dictionary to store module names and their versions
-
-        if matched_modules:
-            error = None
-            for module_name in matched_modules:
-                versions_json = os.path.join(BASE_DIR, module_name, 'versions.json')
-                if os.path.exists(versions_json):
-                    with open(versions_json, 'r') as file:
-                        module_versions = json.load(file)
-                        module_versions_dict[module_name] = [item['version'] for item in module_versions.get('versions', [])]
-                else:
-                    error = "Some modules were found, but versions could not be loaded."
-
-            return render_template('main_page.html', module_versions=module_versions_dict, error=error)
-        else:
-            error = "No matching modules found."
-            return render_template('main_page.html', error=error)
+
+        # Identical queries share one rendered page until a module is uploaded, updated or deleted
+        body, etag = get_page(('search', normalize_query(module_name_input)), registry_index.generation(),
+                              lambda: _render_search_results(module_name_input))
+        response = Response(body, mimetype='text/html')
+        response.cache_control.private = True
+        response.cache_control.max_age = SEARCH_MAX_AGE
+        return response
     
     elif request.method == 'GET':
         return render_template('main_page.html')
@@ -144,15 +162,15 @@ def main_page_webui():
 
 def upload_modules_webui():
     '''
-    If the request method is GET, returns the upload modules page. If the request method is POST, clones the module from the provided github link and adds the module to the database. If the module already exists, returns an error message. If the module is not found at the provided url, returns an error message. If the module is cloned successfully and added to the database, redirects to the main page. If any error occurs during the process, returns an error message.
+    If the request method is GET, returns the upload modules page. If the request method is POST, queues a job that clones the module from the provided github link, validates it and adds the module to the database, the job can be polled at /jobs/<job_id>. If the module already exists or a job for it is already running, returns an error message.
 
     Args:
         None
     
     Returns:
         upload modules page: if the request method is GET
-        main page: if the module is cloned successfully and added to the database
-        upload modules page with error: if the module already exists or any error occurs during the process
+        upload modules page with the job id: if the upload was queued
+        upload modules page with error: if the module already exists or the upload cannot be queued
 
     Raises:
         None
@@ -160,23 +178,19 @@ def upload_modules_webui():
     if request.method == 'GET':
         return render_template('upload_modules.html')
     elif request.method == 'POST':
-        module_url = request.form.get('github_repo_link')
+        module_url = request.form.get('github_repo_link', '').strip()
         # assuming module_url is in the format: https://github.com/username/repo
-        module_name = module_url.split('/')[-1]
+        module_name = module_name_from_url(module_url)
         # check if the module already exists
         module = Module.query.filter_by(module_name=module_name).first()
         if module:
             return render_template('upload_modules.html', error="Module already exists")
-        # check if module exists at provided url
-
-        # clone the repo into the c_cpp_modules directory
-        cloned_status = os.system(f"git clone {module_url} {os.path.join(BASE_DIR, module_name)}")
-        if cloned_status != 0:
-            return render_template('upload_modules.html', error="Error cloning the repository")
-        module = Module(module_name=module_name, module_url=module_url, associated_user=session.get('email'))
-        db.session.add(module)
-        db.session.commit()
-        return render_template('main_page.html')
+        # the clone runs in the background, the job reports errors such as an invalid url or repository layout
+        try:
+            job_id = submit_upload(current_app._get_current_object(), module_url, current_user_email())
+        except IngestionError as e:
+            return render_template('upload_modules.html', error=str(e))
+        return render_template('upload_modules.html', success=f"Upload of {module_name} queued, check its status at /jobs/{job_id}")
 
 def delete_module_webui(module_id):
     '''
@@ -196,22 +210,27 @@ def delete_module_webui(module_id):
     if not module:
         return render_template('profile.html', error="Module not found")
     os.system(f"rm -rf {os.path.join(BASE_DIR, module.module_name)}")
+    invalidate_module(module.module_name)
+    registry_index.invalidate(module.module_name)
+    metadata_store.remove_module(module.module_name)
+    blob_store.remove_module(module.module_name)
     db.session.delete(module)
     db.session.commit()
-    profile = User.query.filter_by(email=session.get('email')).first()
-    modules = Module.query.filter_by(associated_user=session.get('email')).all()
+    module_listing.invalidate()
+    invalidate_profile(module.associated_user)
+    profile, modules = load_profile(current_user_email())
     return render_template('profile.html',profile=profile,modules=modules)
 
 def update_module_webui(module_id):
     '''
-    Updates the module by pulling the changes from the github repository. If the module is not found, returns an error message. If the module is updated successfully, redirects to the profile page. If any error occurs during the process, returns an error message.
+    Queues a job that pulls the changes from the github repository of the module and validates them, an update that fails validation is rolled back. If the module is not found or a job for it is already running, returns an error message.
 
     Args:
         module_id: The id of the module to be updated
 
     Returns:
-        profile page: if the module is updated successfully
-        profile page with error: if the module is not found or any error occurs during the process
+        profile page with the job id: if the update was queued
+        profile page with error: if the module is not found or the update cannot be queued
 
     Raises:
         None
@@ -219,50 +238,70 @@ def update_module_webui(module_id):
     module = Module.query.filter_by(module_id=module_id).first()
     if not module:
         return render_template('profile.html', error="Module not found")
-    os.system(f"cd {os.path.join(BASE_DIR, module.module_name)} && git pull")
-    profile = User.query.filter_by(email=session.get('email')).first()
-    modules = Module.query.filter_by(associated_user=session.get('email')).all()
-    return render_template('profile.html',profile=profile,modules=modules)
+    profile, modules = load_profile(current_user_email())
+    try:
+        job_id = submit_update(current_app._get_current_object(), module.module_name)
+    except IngestionError as e:
+        return render_template('profile.html', profile=profile, modules=modules, error=str(e))
+    return render_template('profile.html', profile=profile, modules=modules, success=f"Update of {module.module_name} queued, check its status at /jobs/{job_id}")
+
+def _render_module_info(module, version, as_json):
+    '''
+    Renders the info page of a module version, or its JSON variant. Returns None if the version does not exist.
+    '''
+    module_info = registry_index.get_module_info(module, version)
+    if module_info is None:
+        return None
+    deps = module_info.get('requires', [])
+    data = {
+        "ModuleName": module,
+        "Version": version,
+        "Author": module_info.get('author'),
+        "Description": module_info.get('description'),
+        "License": module_info.get('license'),
+        "Dependencies": {dep.split('==')[0]: dep.split('==')[1] for dep in deps} if deps else None,
+
+    }
+    if as_json:
+        return json.dumps(data)
+    return render_template('version_info.html', data=data)
 
 def get_module_info_webui(module, version):
     '''
-    Queries the database to get the module information. If the module is not found, returns an error message. If the module is found, returns the module information. If the module has dependencies, returns the dependencies as well. If any error occurs during the process, returns an error message.
+    Returns the information of a module version: author, description, license and dependencies. The page is rendered once per version and served from the page cache until the module changes, with an ETag and a long-lived Cache-Control header. CLI clients get the same data as JSON with ?format=json or "Accept: application/json".
 
     Args:
         module: The name of the module
         version: The version of the module
 
     Returns:
-        module information page: if the module is found
+        module information page: if the module is found, as JSON if requested
+        304 response: if the client copy is still valid
         error message: if the module is not found or any error occurs during the process
 
     Raises:
         None
     '''
-    module_info_file_path = os.path.join(BASE_DIR, module, version, 'module_info.json')
-    if not os.path.exists(module_info_file_path):
+    as_json = request.args.get('format') == 'json' or \
+        request.accept_mimetypes.best_match(['text/html', 'application/json']) == 'application/json'
+    # Published versions rarely change, the metadata etag of the module tells when they did
+    module_etag = registry_index.get_validators(module)[0]
+    page = get_page(('info', module, version, 'json' if as_json else 'html'), module_etag,
+                    lambda: _render_module_info(module, version, as_json))
+    if page is None:
+        if as_json:
+            return jsonify({"error": f"Module '{module}' with version {version} not found."}), 404
         return "<h1>Error 404: Module/Version not found.</h1>", 404
-    module_info = None
-    with open(module_info_file_path, 'r') as file:
-        module_info = json.load(file)
-    deps = module_info.get('requires', [])
-    data = {
-        "ModuleName": module,
-        "Version": version,
-        "Author": module_info.get('author'),
-        "Description": module_info.get('description'),
-        "License": module_info.get('license'),
-        "Dependencies": {dep.split('==')[0]: dep.split('==')[1] for dep in deps} if deps else None,
-
-    }
-    # print(data)
-    # print(jsonify(data))
-    # return jsonify(data)
-    return render_template('version_info.html', data=data)
+    body, etag = page
+    response = not_modified(etag) or add_validators(Response(body, mimetype='application/json' if as_json else 'text/html'), etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = INFO_MAX_AGE
+    response.vary.add('Accept')
+    return response
 
 def get_profile_webui():
     '''
-    Returns the profile page if the user is logged in, else redirects to the index page
+    Returns the profile page if the user is logged in (or sent an API token), else redirects to the index page. The profile and modules come from the per-user profile cache.
 
     Args:
         None
@@ -274,7 +313,64 @@ def get_profile_webui():
     Raises:
         None
     '''
+    email = current_user_email()
+    if email:
+        profile, modules = load_profile(email)
+        return render_template('profile.html',profile=profile,modules=modules)
+    return redirect(url_for('registry.index'))
+
+def create_token_webui():
+    '''
+    Creates an API token the CLI can send as "Authorization: Bearer <token>" instead of logging in with a password. A logged in user gets the token on the profile page, a CLI client posts its email and password (as JSON or form data) once and gets the token as JSON. An optional 'name' labels the token.
+
+    Args:
+        None
+
+    Returns:
+        profile page with the token: if the user is logged in
+        token: {"token_id", "token"} with status 201, for CLI clients
+        error message: if the email or password is invalid (401)
+
+    Raises:
+        None
+    '''
+    body = request.get_json(silent=True) or request.form
+    email = current_user_email()
+    if email is None:
+        email = body.get('email')
+        password_hash = db.session.query(User.password).filter_by(email=email).scalar() if email else None
+        if not password_hash or not check_password_hash(password_hash, body.get('password') or ''):
+            return jsonify({"error": "Invalid email or password"}), 401
+    token_id, token = create_token(email, body.get('name') or None)
+    if session.get('email'):
+        profile, modules = load_profile(email)
+        return render_template('profile.html', profile=profile, modules=modules, success=f"New API token {token_id}, copy it now, it is shown only once: {token}")
+    return jsonify({"token_id": token_id, "token": token}), 201
+
+def revoke_token_webui(token_id):
+    '''
+    Revokes one of the API tokens of the logged in (or token authenticated) user.
+
+    Args:
+        token_id: The id of the token
+
+    Returns:
+        profile page: for logged in users, with an error if the token was not found
+        status: {"revoked": true} for CLI clients
+        error message: if the request is not authenticated (401) or the token was not found (404)
+
+    Raises:
+        None
+    '''
+    email = current_user_email()
+    if email is None:
+        return jsonify({"error": "Authentication required"}), 401
+    revoked = revoke_token(email, token_id)
     if session.get('email'):
-        profile = User.query.filter_by(email=session.get('email')).first()
-        return render_template('profile.html',profile=profile,modules=Module.query.filter_by(associated_user=session.get('email')).all())
-    return redirect(url_for('index'))
+        profile, modules = load_profile(email)
+        if not revoked:
+            return render_template('profile.html', profile=profile, modules=modules, error="Token not found")
+        return render_template('profile.html', profile=profile, modules=modules, success=f"Token {token_id} revoked")
+    if not revoked:
+        return jsonify({"error": "Token not found"}), 404
+    return jsonify({"revoked": True})
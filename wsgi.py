@@ -0,0 +1,16 @@
+'''
+Production entry point of the registry. Importing it imports the app of app.py, creates the schema and preloads the registry metadata, the artifact cache index and the search index (see startup.py). With a preforking server this happens once in the parent process and the workers share the loaded data copy-on-write:
+
+    gunicorn --preload --workers 4 --threads 8 wsgi:app
+
+Without --preload every worker runs the phases itself. The time of every phase is printed and exported at /metrics as cul_startup_<phase>_seconds.
+'''
+
+from startup import phase, preload, report
+
+with phase("import"):
+    # importing app.py creates the app, so the process has a single app and a single database engine
+    from app import app
+
+preload(app)
+report()
@@ -0,0 +1,209 @@
+'''
+This file contains a minimal zip writer that produces an archive as a sequence of byte chunks. Local headers and file data are emitted while files are read and the central directory is emitted at the end, so the archive never has to be held in memory.
+'''
+
+import os
+import zlib
+import struct
+import zipfile
+from metrics import record_fs_read
+
+CHUNK_SIZE = 64 * 1024
+ZIP_MAX = 0xFFFFFFFF  # zip64 is not supported, every size and offset has to fit in 32 bits
+
+_FLAG_DATA_DESCRIPTOR = 0x08
+_FLAG_UTF8 = 0x800
+_VERSION = 20
+_VERSION_MADE_BY = (3 << 8) | _VERSION  # unix
+
+# every entry is written with the same timestamp and a normalized mode, so the bytes of an archive depend only on the paths,
+# contents and executable bits of its files, which is what the tree hash used as its etag covers. Touching or re-linking a
+# file must not change the archive behind an unchanged etag, or a resumed download would splice two different archives.
+FIXED_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+def normalized_mode(st_mode):
+    '''
+    Returns the unix mode stored for a regular file: 0o755 if any execute bit is set, 0o644 otherwise.
+    '''
+    return 0o100755 if st_mode & 0o111 else 0o100644
+
+def _dos_date_time(date_time):
+    '''
+    Converts a (year, month, day, hour, minute, second) tuple into the (time, date) pair used in zip headers.
+    '''
+    dos_date = ((max(date_time[0], 1980) - 1980) << 9) | (date_time[1] << 5) | date_time[2]
+    dos_time = (date_time[3] << 11) | (date_time[4] << 5) | (date_time[5] // 2)
+    return dos_time, dos_date
+
+class ZipStreamWriter:
+    '''
+    Builds a zip archive incrementally. Every method returns or yields the bytes that have to be sent next, nothing is buffered apart from the central directory records.
+    '''
+
+    def __init__(self):
+        self._offset = 0
+        self._central_directory = []
+
+    def _local_header(self, name, flags, compress_type, dos_time, dos_date, crc, compress_size, file_size):
+        return struct.pack('<IHHHHHIIIHH', 0x04034b50, _VERSION, flags, compress_type, dos_time, dos_date,
+                           crc, compress_size, file_size, len(name), 0) + name
+
+    def _record(self, name, flags, compress_type, dos_time, dos_date, crc, compress_size, file_size, header_offset, mode):
+        if compress_size > ZIP_MAX or file_size > ZIP_MAX or header_offset > ZIP_MAX:
+            raise ValueError("Archive too large, zip64 is not supported.")
+        self._central_directory.append(struct.pack(
+            '<IHHHHHHIIIHHHHHII', 0x02014b50, _VERSION_MADE_BY, _VERSION, flags, compress_type, dos_time, dos_date,
+            crc, compress_size, file_size, len(name), 0, 0, 0, 0, (mode & 0xFFFF) << 16, header_offset) + name)
+
+    def add_file(self, arcname, file_path, compress_type=zipfile.ZIP_STORED, compresslevel=None, chunk_size=CHUNK_SIZE):
+        '''
+        Yields the local header, the data and the data descriptor of a file read from disk in chunks of chunk_size bytes.
+
+        Args:
+            arcname: The name of the file inside the archive
+            file_path: The path of the file on disk
+            compress_type: zipfile.ZIP_STORED or zipfile.ZIP_DEFLATED
+            compresslevel: The deflate level, ignored for stored entries
+            chunk_size: The number of bytes read from disk at a time
+
+        Returns:
+            generator: yields the bytes of the entry
+
+        Raises:
+            OSError: If the file cannot be read
+            ValueError: If the archive outgrows the zip format without zip64
+        '''
+        stat = os.stat(file_path)
+        name = arcname.replace(os.sep, '/').encode('utf-8')
+        flags = _FLAG_DATA_DESCRIPTOR | _FLAG_UTF8
+        dos_time, dos_date = _dos_date_time(FIXED_DATE_TIME)
+        header_offset = self._offset
+
+        header = self._local_header(name, flags, compress_type, dos_time, dos_date, 0, 0, 0)
+        self._offset += len(header)
+        yield header
+
+        compressor = None
+        if compress_type == zipfile.ZIP_DEFLATED:
+            compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION if compresslevel is None else compresslevel, zlib.DEFLATED, -15)
+        crc = 0
+        file_size = 0
+        compress_size = 0
+        record_fs_read("archive_source")
+        with open(file_path, 'rb') as file:
+            for chunk in iter(lambda: file.read(chunk_size), b''):
+                crc = zlib.crc32(chunk, crc)
+                file_size += len(chunk)
+                if compressor:
+                    chunk = compressor.compress(chunk)
+                if chunk:
+                    compress_size += len(chunk)
+                    yield chunk
+        if compressor:
+            tail = compressor.flush()
+            compress_size += len(tail)
+            yield tail
+
+        descriptor = struct.pack('<IIII', 0x08074b50, crc, compress_size, file_size)
+        self._offset += compress_size + len(descriptor)
+        self._record(name, flags, compress_type, dos_time, dos_date, crc, compress_size, file_size, header_offset, normalized_mode(stat.st_mode))
+        yield descriptor
+
+    def add_precompressed(self, arcname, data, crc, file_size, compress_type, date_time=FIXED_DATE_TIME, mode=0o100644):
+        '''
+        Returns the local header and data of an entry whose compressed bytes, crc and size are already known, e.g. an entry copied out of another archive.
+
+        Args:
+            arcname: The name of the file inside the archive
+            data: The (possibly compressed) bytes of the entry
+            crc: The crc32 of the uncompressed contents
+            file_size: The size of the uncompressed contents
+            compress_type: The compression method the data was produced with
+            date_time: A (year, month, day, hour, minute, second) tuple, defaults to FIXED_DATE_TIME
+            mode: The unix file mode stored in the central directory
+
+        Returns:
+            bytes: the bytes of the entry
+
+        Raises:
+            ValueError: If the archive outgrows the zip format without zip64
+        '''
+        name = arcname.replace(os.sep, '/').encode('utf-8')
+        dos_time, dos_date = _dos_date_time(date_time)
+        header_offset = self._offset
+        header = self._local_header(name, _FLAG_UTF8, compress_type, dos_time, dos_date, crc, len(data), file_size)
+        self._record(name, _FLAG_UTF8, compress_type, dos_time, dos_date, crc, len(data), file_size, header_offset, mode)
+        self._offset += len(header) + len(data)
+        return header + data
+
+    def finish(self):
+        '''
+        Returns the central directory and the end of central directory record. No entries can be added afterwards.
+        '''
+        central_directory = b''.join(self._central_directory)
+        if self._offset > ZIP_MAX or len(self._central_directory) > 0xFFFF:
+            raise ValueError("Archive too large, zip64 is not supported.")
+        end_record = struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, len(self._central_directory), len(self._central_directory),
+                                 len(central_directory), self._offset, 0)
+        self._offset += len(central_directory) + len(end_record)
+        return central_directory + end_record
+
+def stream_directory_zip(module_dir, compress_type=zipfile.ZIP_STORED, compresslevel=None, chunk_size=CHUNK_SIZE):
+    '''
+    Yields a zip archive of a version directory chunk by chunk. Peak memory is bounded by chunk_size and the central directory, regardless of the size of the module. Files are added in sorted order, so the same directory always produces the same bytes.
+
+    Args:
+        module_dir: The path of the version directory
+        compress_type: zipfile.ZIP_STORED or zipfile.ZIP_DEFLATED
+        compresslevel: The deflate level, ignored for stored entries
+        chunk_size: The number of bytes read from disk at a time
+
+    Returns:
+        generator: yields the bytes of the archive
+
+    Raises:
+        OSError: If a file cannot be read
+        ValueError: If the archive outgrows the zip format without zip64
+    '''
+    writer = ZipStreamWriter()
+    for root, dirs, files in os.walk(module_dir):
+        # a fixed order makes the archive of an unchanged directory byte-for-byte identical across requests and processes
+        dirs.sort()
+        for file in sorted(files):
+            file_path = os.path.join(root, file)
+            yield from writer.add_file(os.path.relpath(file_path, module_dir), file_path, compress_type, compresslevel, chunk_size)
+    yield writer.finish()
+
+def open_raw_entries(zip_path):
+    '''
+    Opens an existing zip archive and returns its entries without decompressing them, so that they can be copied into another archive with ZipStreamWriter.add_precompressed. The archive is opened and its central directory read before this returns, so a missing or corrupt archive raises here, and the entries can still be read if the archive is removed afterwards.
+
+    Args:
+        zip_path: The path of the zip archive
+
+    Returns:
+        generator: yields (zipfile.ZipInfo, raw entry bytes) tuples one entry at a time, the archive is closed once it is exhausted or closed
+
+    Raises:
+        OSError: If the archive cannot be opened
+        zipfile.BadZipFile: If the archive is corrupt
+    '''
+    file = open(zip_path, 'rb')
+    try:
+        with zipfile.ZipFile(file) as zipf:
+            infos = zipf.infolist()
+    except Exception:
+        file.close()
+        raise
+    return _read_raw_entries(file, infos)
+
+def _read_raw_entries(file, infos):
+    with file:
+        for info in infos:
+            file.seek(info.header_offset)
+            header = file.read(30)
+            if header[:4] != b'PK\x03\x04':
+                raise zipfile.BadZipFile(f"Bad local header for '{info.filename}'.")
+            name_length, extra_length = struct.unpack('<HH', header[26:30])
+            file.seek(name_length + extra_length, os.SEEK_CUR)
+            yield info, file.read(info.compress_size)